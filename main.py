@@ -1,45 +1,68 @@
 import asyncio
 from webapp.config import Config
 from webapp.executor import Executor
-from hypercorn.config import Config as HypercornConfig
+from webapp.prober import Prober
+from webapp.service import Service, ServiceServer
+from webapp.worker import ApiWorkers, hypercorn_config
 from hypercorn.asyncio import serve
 from webapp.api import app
 import logging
 
+CONFIG_PATH = "config.toml"
 
-async def server(config, executor):
-    await executor.create_enviroment()
 
-    async def update_challenges():
-        while True:
-            try:
-                await asyncio.sleep(60 * 5)
-                await executor.create_enviroment()
-            except Exception as e:
-                log = logging.getLogger(__name__)
-                log.warning(f"Something went wrong while creating environment: {e}")
+async def server(config, executor, workers: ApiWorkers | None = None):
+    cluster = executor.cluster
+    await cluster.elect()
+    await executor.reserve_ports()
+    # In cluster mode only the leader syncs and runs the background loops,
+    # every replica serves the API and starts and stops instances
+    if cluster.leader:
+        await executor.create_enviroment()
 
-    app.extra = {
-        "config": config,
-        "executor": executor
-    }
+    prober = Prober(config, executor, **config.prober)
+    service = Service(config, executor, prober)
+
+    if workers is None:
+        app.extra = {
+            "config": config,
+            "service": service
+        }
+        api = [serve(app, hypercorn_config(config.api))]
+    else:
+        # The API runs in worker processes of its own, which reach the
+        # executor over a Unix socket
+        service_server = ServiceServer(service, workers.socket_path)
+        api = [service_server.run(), workers.run(service_server.listening)]
 
-    hypercorn = HypercornConfig()
-    hypercorn.bind = [f"{config.api['ip']}:{config.api['port']}"]
     await asyncio.gather(
-        serve(app, hypercorn),
-        update_challenges()
+        *api,
+        cluster.run(),
+        # Every replica keeps its config up to date, the leader syncs
+        executor.reloader.run(),
+        cluster.leading(prober.run),
+        executor.placement.run(),
+        cluster.leading(executor.pools.run),
+        cluster.leading(executor.lifetime.run),
+        cluster.leading(executor.reconciler.run)
     )
 
 
 def main():
     logging.basicConfig(level=logging.INFO)
 
-    config = Config("config.toml")
+    config = Config(CONFIG_PATH)
 
     executor = Executor(config)
 
-    asyncio.run(server(config, executor))
+    workers = None
+    if config.api.get("workers", 1) > 1:
+        workers = ApiWorkers(CONFIG_PATH, config.api)
+    try:
+        asyncio.run(server(config, executor, workers))
+    finally:
+        if workers is not None:
+            workers.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+# Load test of the /events stream.
+#
+# Serves the app with hypercorn on localhost, opens many concurrent /events
+# subscribers (one per connection, each following one user) and then flips
+# the state of every user's instance a few times. Reports how many
+# subscribers the process held, its memory, and how long events took to
+# reach the subscribers. The subscribers run in the same process as the
+# server, so the numbers are on the pessimistic side.
+#
+#   python test/bench_events.py [--subscribers 2000] [--users 200] [--rounds 5]
+import argparse
+import asyncio
+import base64
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from hypercorn.asyncio import serve
+from hypercorn.config import Config as HypercornConfig
+
+from fake import fake_config
+from webapp.api import app
+from webapp.challenge import Challenge
+from webapp.database import ChallengeState, Database
+from webapp.events import EventBus
+from webapp.executor import Executor
+from webapp.service import Service
+
+PORT = 8765
+AUTH = base64.b64encode(b"bench:bench").decode()
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+async def subscriber(user_id, subscribed, published, latencies):
+    reader, writer = await asyncio.open_connection("127.0.0.1", PORT)
+    writer.write(f"GET /events?user_id={user_id} HTTP/1.1\r\nHost: bench\r\n".encode() +
+                 f"Authorization: Basic {AUTH}\r\n\r\n".encode())
+    await writer.drain()
+    try:
+        while True:
+            line = await reader.readline()
+            if len(line) == 0:
+                return
+            if line.startswith(b": subscribed"):
+                subscribed.release()
+            elif line.startswith(b"data: "):
+                data = json.loads(line[6:])
+                sent = published.get((data["user_id"], data["state"]))
+                if sent is not None:
+                    latencies.append(time.perf_counter() - sent)
+    finally:
+        writer.close()
+
+
+async def bench(subscribers, users, rounds):
+    with tempfile.TemporaryDirectory() as tmp:
+        database = await asyncio.to_thread(Database, os.path.join(tmp, "bench.sqlite3"))
+        database.events = EventBus(queue_size=100, max_subscribers=subscribers)
+        for user in range(users):
+            await ChallengeState(database, "bench", f"u{user}").transition("running", create=True, port=2000)
+
+        challenge = Challenge("bench", "bench", "flag{bench}")
+        challenge.url = "http://{{IP}}:{{PORT}}"
+        config = fake_config(database, {"bench": challenge}, [])
+        app.extra = {"config": config, "service": Service(config, Executor(config))}
+
+        shutdown = asyncio.Event()
+        hypercorn = HypercornConfig()
+        hypercorn.bind = [f"127.0.0.1:{PORT}"]
+        hypercorn.backlog = subscribers
+        hypercorn.loglevel = "WARNING"
+        server = asyncio.create_task(serve(app, hypercorn, shutdown_trigger=shutdown.wait))
+        await asyncio.sleep(0.5)
+
+        subscribed = asyncio.Semaphore(0)
+        published = {}
+        latencies = []
+        start = time.perf_counter()
+        clients = [asyncio.create_task(subscriber(f"u{i % users}", subscribed, published, latencies))
+                   for i in range(subscribers)]
+        for _ in range(subscribers):
+            await subscribed.acquire()
+        elapsed = time.perf_counter() - start
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"subscribed {subscribers} in {elapsed:.2f}s ({subscribers / elapsed:.0f}/s), "
+              f"peak RSS {rss:.0f}MB")
+
+        expected = 0
+        start = time.perf_counter()
+        for r in range(rounds):
+            state = "starting" if r % 2 == 0 else "running"
+            for user in range(users):
+                published[(f"u{user}", state)] = time.perf_counter()
+            await asyncio.gather(*[ChallengeState(database, "bench", f"u{user}").set(state)
+                                   for user in range(users)])
+            expected += subscribers
+            # Let the subscribers drain before the same state comes up again
+            while len(latencies) < expected and time.perf_counter() - start < 60:
+                await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - start
+
+        print(f"delivered {len(latencies)} of {expected} events in {elapsed:.2f}s "
+              f"({len(latencies) / elapsed:.0f} events/s)")
+        print(f"latency p50 {statistics.median(latencies) * 1000:.1f}ms "
+              f"p99 {percentile(latencies, 0.99) * 1000:.1f}ms")
+
+        for client in clients:
+            client.cancel()
+        await asyncio.gather(*clients, return_exceptions=True)
+        shutdown.set()
+        await server
+        await database.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subscribers", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(bench(args.subscribers, args.users, args.rounds))
+
+
+if __name__ == "__main__":
+    main()
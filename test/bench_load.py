@@ -0,0 +1,233 @@
+#!/usr/bin/python3
+# Load test of the whole instancer against simulated servers.
+#
+# Drives the FastAPI app in-process (httpx ASGITransport) with the servers
+# replaced by test/fake.py, so it needs no network, SSH or Docker. Runs three
+# scenarios one after the other:
+#
+#   burst     every user starts a challenge at once, like the start of an event
+#   polling   clients keep asking for the status of random instances
+#   teardown  every instance is stopped again, one /stop per user or with
+#             /batch/stop (--batch-stop)
+#
+# and reports throughput, p50/p99 request latency, and how contended the
+# database was (time writes waited to be committed, commit batch sizes,
+# reads waiting for a pooled connection).
+#
+#   python test/bench_load.py [--users 1000] [--servers 4] [--challenges 10]
+#       [--concurrency 200] [--workers 16] [--max-queued 1000]
+#       [--duration 10] [--latency 0.005]
+#       [--start-latency 0.2] [--failure-rate 0.01] [--batch-stop]
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import httpx
+
+from fake import FakeBackend, fake_config, fake_servers
+from webapp import metrics
+from webapp.api import app
+from webapp.challenge import Challenge
+from webapp.database import Database
+from webapp.executor import Executor
+from webapp.service import Service, background_tasks
+
+AUTH = httpx.BasicAuth("bench", "bench")
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def histogram_percentile(histogram, fraction, *labels):
+    # Upper bound of the bucket the percentile falls in
+    series = histogram.values.get(labels)
+    if series is None:
+        return None
+    total = sum(series[:-1])
+    seen = 0
+    for bound, count in zip(histogram.buckets + (float("inf"),), series):
+        seen += count
+        if seen >= fraction * total:
+            return bound
+    return float("inf")
+
+
+def report_requests(name, latencies, elapsed, failures=0):
+    print(f"{name:<10} {len(latencies):6d} requests in {elapsed:6.2f}s  "
+          f"{len(latencies) / elapsed:8.1f} req/s  "
+          f"p50 {statistics.median(latencies) * 1000:7.1f}ms  "
+          f"p99 {percentile(latencies, 0.99) * 1000:7.1f}ms  "
+          f"errors {failures}")
+
+
+def report_database():
+    commits = metrics.DB_COMMIT_BATCH.count()
+    batched = metrics.DB_COMMIT_BATCH.values.get((), [0])[-1]
+    writes = metrics.DB_QUERIES.count("write")
+    parts = [f"{'':<10} db: {commits} commits"]
+    if commits > 0:
+        parts.append(f"{batched / commits:.1f} writes per commit")
+    if writes > 0:
+        parts.append(f"write until committed p50 <={histogram_percentile(metrics.DB_QUERIES, 0.5, 'write') * 1000:g}ms "
+                     f"p99 <={histogram_percentile(metrics.DB_QUERIES, 0.99, 'write') * 1000:g}ms")
+    reads = metrics.DB_QUERIES.count("fetch")
+    if reads > 0:
+        parts.append(f"{reads} reads p99 <={histogram_percentile(metrics.DB_QUERIES, 0.99, 'fetch') * 1000:g}ms")
+    hits = metrics.CACHE_LOOKUPS.get("hit")
+    lookups = hits + metrics.CACHE_LOOKUPS.get("miss")
+    if lookups > 0:
+        parts.append(f"cache hit ratio {hits / lookups:.2f}")
+    print(", ".join(parts))
+
+
+def reset_metrics():
+    for metric in metrics.REGISTRY:
+        metric.reset()
+
+
+async def drain(executor):
+    # Until every stop task and every queued start is done
+    while len(background_tasks) > 0 or len(executor.starts.jobs) > 0:
+        await asyncio.gather(*list(background_tasks), return_exceptions=True)
+        await asyncio.sleep(0.01)
+
+
+async def requests(client, paths, concurrency):
+    # Sends every request, at most `concurrency` at once
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = 0
+
+    async def one(method, path, body):
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.request(method, path, json=body, auth=AUTH)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                failures += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(*request) for request in paths])
+    return latencies, time.perf_counter() - start, failures
+
+
+async def burst(client, executor, users, challenges, concurrency):
+    reset_metrics()
+    assigned = {f"user{i}": challenges[i % len(challenges)] for i in range(users)}
+    start = time.perf_counter()
+    latencies, elapsed, failures = await requests(
+        client, [("GET", f"/start/{user}/{name}", None) for user, name in assigned.items()], concurrency)
+    report_requests("burst", latencies, elapsed, failures)
+    rejected = sum(count for (reason,), count in metrics.ADMISSIONS.values.items() if reason != "admitted")
+    if rejected > 0:
+        print(f"{'':<10} {rejected:.0f} starts rejected by admission control")
+
+    await drain(executor)
+    elapsed = time.perf_counter() - start
+    started = sum(metrics.STARTS.get(name, "started") for name in challenges)
+    total = histogram_percentile(metrics.START_PHASES, 0.99, "total")
+    print(f"{'':<10} {started:.0f} of {users} started in {elapsed:.2f}s "
+          f"({started / elapsed:.1f} starts/s), start p99 <={total}s")
+    report_database()
+    return assigned
+
+
+async def polling(client, assigned, concurrency, duration):
+    reset_metrics()
+    pairs = list(assigned.items())
+    rng = random.Random(1)
+    latencies = []
+    failures = 0
+    deadline = time.perf_counter() + duration
+
+    async def poller():
+        nonlocal failures
+        while time.perf_counter() < deadline:
+            user, name = rng.choice(pairs)
+            start = time.perf_counter()
+            response = await client.get(f"/status/{user}/{name}", auth=AUTH)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                failures += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[poller() for _ in range(concurrency)])
+    report_requests("polling", latencies, time.perf_counter() - start, failures)
+    report_database()
+
+
+async def teardown(client, executor, assigned, concurrency, batch):
+    reset_metrics()
+    start = time.perf_counter()
+    if batch:
+        paths = [("POST", "/batch/stop", {"challenge": name}) for name in sorted(set(assigned.values()))]
+    else:
+        paths = [("GET", f"/stop/{user}/{name}", None) for user, name in assigned.items()]
+    latencies, elapsed, failures = await requests(client, paths, concurrency)
+    report_requests("teardown", latencies, elapsed, failures)
+
+    await drain(executor)
+    elapsed = time.perf_counter() - start
+    left = len(await executor.config.database.instances())
+    print(f"{'':<10} {len(assigned) - left} of {len(assigned)} stopped in {elapsed:.2f}s, "
+          f"{left} rows left")
+    report_database()
+
+
+async def bench(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        database = await asyncio.to_thread(Database, os.path.join(tmp, "bench.sqlite3"))
+        challenges = {}
+        for i in range(args.challenges):
+            challenge = challenges[f"chal{i}"] = Challenge(f"chal{i}", f"category/chal{i}", "flag{bench}")
+            challenge.url = "http://{{IP}}:{{PORT}}"
+        config = fake_config(database, challenges, fake_servers(args.servers, max_sessions=args.sessions),
+                             admission={"workers": args.workers, "max_queued": args.max_queued})
+        executor = Executor(config)
+        executor.backend = FakeBackend(args.latency, args.start_latency, args.start_latency / 2,
+                                       args.failure_rate)
+        app.extra = {"config": config, "service": Service(config, executor)}
+        await executor.placement.refresh()
+
+        print(f"{args.users} users, {args.challenges} challenges on {args.servers} servers, "
+              f"command latency {args.latency * 1000:g}ms, run.sh {args.start_latency * 1000:g}ms, "
+              f"{args.failure_rate * 100:g}% failures")
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            assigned = await burst(client, executor, args.users, list(challenges), args.concurrency)
+            await polling(client, assigned, args.concurrency, args.duration)
+            await teardown(client, executor, assigned, args.concurrency, args.batch_stop)
+        print(f"{executor.backend.commands} commands sent, {executor.backend.failures} failed")
+        await database.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--servers", type=int, default=4)
+    parser.add_argument("--challenges", type=int, default=10)
+    parser.add_argument("--sessions", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--max-queued", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--start-latency", type=float, default=0.2)
+    parser.add_argument("--failure-rate", type=float, default=0.01)
+    parser.add_argument("--batch-stop", action="store_true")
+    args = parser.parse_args()
+    asyncio.run(bench(args))
+
+
+if __name__ == "__main__":
+    main()
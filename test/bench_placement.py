@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+# Simulation of the placement policies on a made up cluster.
+#
+# A burst of starts hits a set of servers of different sizes. Every start
+# takes a while before its containers show up in the snapshots, which is when
+# the old loadavg-min (comparing load averages as strings, on every start)
+# piled everything onto one server. Reports how the instances ended up spread
+# out and how overloaded the busiest server got.
+#
+#   python test/bench_placement.py [--starts 100] [--concurrency 50]
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from webapp.placement import POLICIES, Placement
+from webapp.server import Server
+
+# cpus, MB of memory, load average when idle
+SERVERS = [(4, 8192, 0.2), (8, 16384, 6.5), (8, 16384, 1.0), (16, 32768, 2.0), (2, 4096, 0.1)]
+
+
+class Node:
+    def __init__(self, cpus, memory, idle) -> None:
+        self.cpus = cpus
+        self.memory = memory * 1024
+        self.idle = idle
+        self.instances = []
+
+    @property
+    def load(self):
+        return self.idle + sum(load for load, _ in self.instances)
+
+    @property
+    def used(self):
+        return sum(memory for _, memory in self.instances)
+
+    def snapshot(self):
+        available = max(0, self.memory - self.used)
+        return (f"{self.load:.2f} 0.00 0.00 1/100 1000\n{self.cpus}\n" +
+                f"MemTotal: {self.memory} kB\nMemAvailable: {available} kB\n" +
+                f"{len(self.instances)}\n")
+
+    def utilisation(self):
+        return max(self.load / self.cpus, self.used / self.memory)
+
+
+class Cluster:
+    def __init__(self, latency) -> None:
+        self.latency = latency
+        self.servers = [Server(f"node{i}", "127.0.0.1", 22, "root", "/deployment")
+                        for i in range(len(SERVERS))]
+        self.nodes = {server.hostname: Node(*spec) for server, spec in zip(self.servers, SERVERS)}
+        self.config = self
+
+    async def run(self, server, cmd, timeout=None, lane=None):
+        await asyncio.sleep(self.latency)
+        return self.nodes[server.hostname].snapshot()
+
+
+async def legacy(cluster, _challenge):
+    # What get_available_server did before: fresh loadavg of every server,
+    # smallest one as a string
+    await asyncio.sleep(cluster.latency)
+    loads = [(server, f"{cluster.nodes[server.hostname].load:.2f}") for server in cluster.servers]
+    return min(loads, key=lambda l: l[1])[0]
+
+
+async def simulate(policy, starts, concurrency, start_time, interval, seed):
+    rng = random.Random(seed)
+    cluster = Cluster(latency=0.002)
+    placement = None
+    if policy != "legacy":
+        placement = Placement(cluster, {"policy": policy, "interval": interval})
+        await placement.refresh()
+        refresher = asyncio.create_task(placement.run())
+    semaphore = asyncio.Semaphore(concurrency)
+    decisions = []
+
+    async def start(i):
+        # Challenges differ in how heavy they are
+        cost = (rng.choice([0.05, 0.1, 0.3]), rng.choice([64, 256, 1024]) * 1024)
+        async with semaphore:
+            begin = time.perf_counter()
+            if placement is None:
+                server = await legacy(cluster, None)
+            else:
+                server = await placement.choose(None)
+            decisions.append(time.perf_counter() - begin)
+            await asyncio.sleep(start_time)
+            cluster.nodes[server.hostname].instances.append(cost)
+            if placement is not None:
+                placement.release(server)
+
+    await asyncio.gather(*[start(i) for i in range(starts)])
+    if placement is not None:
+        refresher.cancel()
+
+    nodes = cluster.nodes.values()
+    counts = [len(node.instances) for node in nodes]
+    utilisation = [node.utilisation() for node in nodes]
+    print(f"{policy:<14} instances {'/'.join(f'{c:>3}' for c in counts)}  "
+          f"max util {max(utilisation):5.2f}  stdev util {statistics.pstdev(utilisation):5.2f}  "
+          f"overloaded {sum(u > 1 for u in utilisation)}  "
+          f"decision {statistics.mean(decisions) * 1000:6.2f}ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--starts", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--start-time", type=float, default=0.05)
+    parser.add_argument("--interval", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=1337)
+    args = parser.parse_args()
+
+    print(f"servers (cpus/MB/idle load): {', '.join('/'.join(map(str, s)) for s in SERVERS)}")
+    for policy in ["legacy", *POLICIES]:
+        await simulate(policy, args.starts, args.concurrency, args.start_time,
+                       args.interval, args.seed)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+# Load test of the SSH executor backends.
+#
+# Runs the same burst of cheap commands through the Fabric and the asyncssh
+# backend and reports commands/sec and latency percentiles. Meant to be run
+# against the local test-server (see test-server/README.md):
+#
+#   python test/bench_ssh.py --config config.toml --commands 500 --concurrency 50
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+import tomllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from webapp.backend import AsyncSSHBackend, FabricBackend
+from webapp.server import parse_servers
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+async def bench(name, backend, servers, commands, concurrency, cmd):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = 0
+
+    async def one(i):
+        nonlocal failures
+        server = servers[i % len(servers)]
+        async with semaphore:
+            start = time.perf_counter()
+            result = await backend.run(server, cmd)
+            latencies.append(time.perf_counter() - start)
+            if result is None:
+                failures += 1
+
+    # Warm up connections so the numbers only cover running commands
+    await asyncio.gather(*[backend.run(server, "true") for server in servers])
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(commands)])
+    elapsed = time.perf_counter() - start
+
+    print(f"{name:<10} {commands / elapsed:8.1f} cmd/s  "
+          f"p50 {statistics.median(latencies) * 1000:7.1f}ms  "
+          f"p99 {percentile(latencies, 0.99) * 1000:7.1f}ms  "
+          f"failures {failures}")
+    await backend.close()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="config.toml")
+    parser.add_argument("--commands", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--cmd", default="cat /proc/loadavg")
+    args = parser.parse_args()
+
+    with open(args.config, "rb") as f:
+        data = tomllib.load(f)
+    keyfile = data["ssh"]["keyfile"]
+    servers = parse_servers(data["servers"])
+    for server in servers:
+        server.connect(keyfile)
+
+    await bench("fabric", FabricBackend(), servers,
+                args.commands, args.concurrency, args.cmd)
+    await bench("asyncssh", AsyncSSHBackend(keyfile), servers,
+                args.commands, args.concurrency, args.cmd)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
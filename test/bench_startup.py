@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+# Startup time of the instancer on a large synthetic challenge repo.
+#
+# Times reading config.toml into a Config the way main.py does (challenges,
+# servers, database). Runs four cases:
+#
+#   no index       the checker parses every challenge and the index is written
+#   index          nothing changed since, the challenges come from the index
+#   one changed    a single challenge.yml was edited, so the checker runs again
+#   legacy         parse_challenges on its own, what every start used to do
+#
+# The checker is generated as well: it reads a challenge.yml per challenge,
+# with --parse-cost seconds of extra work per challenge standing in for the
+# validation the real one does.
+#
+#   python test/bench_startup.py [--challenges 500] [--servers 50] [--files 20]
+#       [--parse-cost 0.001] [--rounds 3]
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from webapp.challenge import parse_challenges
+from webapp.config import Config
+
+CHECKER = """
+import os
+import time
+from types import SimpleNamespace
+from yaml import safe_load
+
+PARSE_COST = {parse_cost}
+
+
+class ChallengeSet:
+    def __init__(self, path):
+        self.challenges = {{}}
+        for category in sorted(os.listdir(path)):
+            if not os.path.isdir(os.path.join(path, category)):
+                continue
+            for name in sorted(os.listdir(os.path.join(path, category))):
+                with open(os.path.join(path, category, name, "challenge.yml")) as f:
+                    data = safe_load(f)
+                time.sleep(PARSE_COST)
+                self.challenges[data["uuid"]] = SimpleNamespace(
+                    uuid=data["uuid"], path=f"/challenges/{{category}}/{{name}}",
+                    flag={{data["flag"]: 1}}, url=[data["url"]])
+"""
+
+
+def write_challenge(repo, category, name, flag, files):
+    source = os.path.join(repo, category, name, "Source")
+    os.makedirs(source, exist_ok=True)
+    with open(os.path.join(repo, category, name, "challenge.yml"), "w") as f:
+        f.write(f"uuid: {name}\nflag: {flag}\nurl: http://{{{{IP}}}}:{{{{PORT}}}}\n")
+    for i in range(files):
+        with open(os.path.join(source, f"file-{i}"), "w") as f:
+            f.write(f"{name} {i}\n")
+
+
+def make_repo(repo, challenges, files, parse_cost):
+    os.makedirs(repo)
+    with open(os.path.join(repo, "checker.py"), "w") as f:
+        f.write(CHECKER.format(parse_cost=parse_cost))
+    for c in range(challenges):
+        write_challenge(repo, f"category-{c % 8}", f"chal-{c}", f"flag{{{c}}}", files)
+
+
+def write_config(tmp, repo, servers):
+    keyfile = os.path.join(tmp, "key")
+    open(keyfile, "w").close()
+    path = os.path.join(tmp, "config.toml")
+    with open(path, "w") as f:
+        f.write(f"""
+[api]
+ip = "127.0.0.1"
+port = 8000
+username = "bench"
+password = "bench"
+
+[database]
+path = "{os.path.join(tmp, 'bench.sqlite3')}"
+
+[docker]
+challenge_path = "{repo}"
+index = "{os.path.join(tmp, 'challenges.json')}"
+
+[ssh]
+keyfile = "{keyfile}"
+
+[servers.default]
+port = "22"
+user = "root"
+path = "/deployment"
+""")
+        for i in range(servers):
+            f.write(f'\n[servers.node{i}]\nip = "10.0.{i // 250}.{i % 250 + 1}"\n')
+    return path
+
+
+def fresh_checker():
+    # Every start is a new process, so the checker is imported again
+    sys.modules.pop("checker", None)
+
+
+def measure(name, rounds, setup, run):
+    samples = []
+    for _ in range(rounds):
+        setup()
+        begin = time.perf_counter()
+        result = run()
+        samples.append(time.perf_counter() - begin)
+    print(f"{name:<12} median {statistics.median(samples) * 1000:8.1f}ms  "
+          f"min {min(samples) * 1000:8.1f}ms  ({len(result)} challenges)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--challenges", type=int, default=500)
+    parser.add_argument("--servers", type=int, default=50)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--parse-cost", type=float, default=0.001)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        repo = os.path.join(tmp, "challenges")
+        make_repo(repo, args.challenges, args.files, args.parse_cost)
+        config_path = write_config(tmp, repo, args.servers)
+        index = os.path.join(tmp, "challenges.json")
+        print(f"{args.challenges} challenges of {args.files} files, {args.servers} servers, "
+              f"{args.parse_cost * 1000:g}ms checker work per challenge")
+
+        def no_index():
+            fresh_checker()
+            if os.path.exists(index):
+                os.remove(index)
+
+        edits = iter(range(args.rounds))
+
+        def one_changed():
+            fresh_checker()
+            write_challenge(repo, "category-0", "chal-0", f"flag{{edit-{next(edits)}}}", args.files)
+
+        measure("no index", args.rounds, no_index, lambda: Config(config_path).challenges)
+        measure("index", args.rounds, fresh_checker, lambda: Config(config_path).challenges)
+        measure("one changed", args.rounds, one_changed, lambda: Config(config_path).challenges)
+        measure("legacy", args.rounds, fresh_checker, lambda: parse_challenges(repo))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+# Micro-benchmark for the /status hot path.
+#
+# Compares the old access pattern (a fresh aiosqlite connection for each of
+# the five queries a /status request used to make) against the pooled
+# single-row fetch, and measures /status requests/sec end to end.
+#
+#   python test/bench_status.py [--requests 2000]
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import httpx
+from aiosqlite import connect
+
+from fake import fake_config
+from webapp.api import app
+from webapp.challenge import Challenge
+from webapp.database import ChallengeState, Database
+from webapp.executor import Executor
+from webapp.service import Service
+
+USERS = 100
+
+
+async def legacy_status(db_file, name, user_id):
+    # What /status did before: one connection per ChallengeState call.
+    for query in ["SELECT state, reason FROM challenges WHERE name=? AND user_id=? LIMIT 1",
+                  "SELECT port FROM challenges WHERE name=? AND user_id=? LIMIT 1",
+                  "SELECT state, reason FROM challenges WHERE name=? AND user_id=? LIMIT 1",
+                  "SELECT port FROM challenges WHERE name=? AND user_id=? LIMIT 1",
+                  "SELECT server FROM challenges WHERE name=? AND user_id=? LIMIT 1"]:
+        async with connect(db_file) as db:
+            res = await db.execute(query, (name, user_id))
+            await res.fetchone()
+
+
+async def pooled_status(database, name, user_id):
+    await ChallengeState(database, name, user_id).fetch()
+
+
+async def measure(label, requests, fn):
+    start = time.perf_counter()
+    await asyncio.gather(*[fn(i) for i in range(requests)])
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {requests / elapsed:10.1f} req/s")
+
+
+async def bench(requests):
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench.sqlite3")
+        database = await asyncio.to_thread(Database, db_file)
+        for user in range(USERS):
+            state = ChallengeState(database, "bench", str(user))
+            await state.create_challenge()
+            await state.set("running")
+            await state.set_port(20000 + user)
+
+        await measure("legacy queries", requests,
+                      lambda i: legacy_status(db_file, "bench", str(i % USERS)))
+        await measure("pooled fetch", requests,
+                      lambda i: pooled_status(database, "bench", str(i % USERS)))
+
+        challenge = Challenge("bench", "bench", "flag{bench}")
+        challenge.url = "http://{{IP}}:{{PORT}}"
+        config = fake_config(database, {"bench": challenge}, [])
+        app.extra = {"config": config, "service": Service(config, Executor(config))}
+
+        auth = httpx.BasicAuth("bench", "bench")
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            await measure("/status end to end", requests,
+                          lambda i: client.get(f"/status/{i % USERS}/bench", auth=auth))
+
+        await database.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+    asyncio.run(bench(args.requests))
+
+
+if __name__ == "__main__":
+    main()
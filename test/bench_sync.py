@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+# Timing benchmark for the challenge sync on a large synthetic challenge repo.
+#
+# Measures hashing the tree (cold and cached), and building the full archive
+# with every codec while piping it straight into a local `tar -x`, which is
+# what the servers run when [sync] stream is enabled.
+#
+#   python test/bench_sync.py [--challenges 200] [--files 20] [--size 65536]
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from webapp.sync import CODECS, TreeHasher, write_delta
+
+
+class Counter:
+    def __init__(self, fileobj) -> None:
+        self.fileobj = fileobj
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+
+def make_repo(base_dir, challenges, files, size):
+    rng = random.Random(1337)
+    words = [b"flag", b"docker", b"compose", b"service", b"port", b"challenge", b"\n"]
+    for c in range(challenges):
+        source = os.path.join(base_dir, f"challenge-{c}", "Source")
+        os.makedirs(source)
+        for f in range(files):
+            with open(os.path.join(source, f"file-{f}"), "wb") as out:
+                # Half of the files are compressible text, half are binaries
+                if f % 2 == 0:
+                    out.write(b" ".join(rng.choice(words) for _ in range(size // 6))[:size])
+                else:
+                    out.write(rng.randbytes(size))
+
+
+def timed(label, fn):
+    start = time.perf_counter()
+    result = fn()
+    print(f"{label:<32} {time.perf_counter() - start:8.2f}s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--challenges", type=int, default=200)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--size", type=int, default=64 * 1024)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base_dir = os.path.join(tmp, "challenges")
+        total = args.challenges * args.files * args.size
+        timed(f"generate {total / 1e6:.0f}MB repo",
+              lambda: make_repo(base_dir, args.challenges, args.files, args.size))
+
+        hasher = TreeHasher()
+        manifest = timed("manifest (cold)", lambda: hasher.manifest(base_dir))
+        timed("manifest (cached)", lambda: hasher.manifest(base_dir))
+
+        for codec, level in [("none", 0), ("gz", 1), ("gz", 6), ("bz2", 9), ("xz", 6)]:
+            target = os.path.join(tmp, f"extract-{codec}-{level}")
+            os.makedirs(target)
+            _, flag = CODECS[codec]
+            tar = subprocess.Popen(["tar", f"-x{flag}f", "-", "--directory", target],
+                                   stdin=subprocess.PIPE)
+            counter = Counter(tar.stdin)
+
+            def stream():
+                write_delta(base_dir, manifest, list(manifest), counter, codec, level)
+                tar.stdin.close()
+                tar.wait()
+
+            timed(f"stream {codec}:{level} into tar -x", stream)
+            print(f"{'':<32} {counter.size / 1e6:8.1f}MB sent")
+
+
+if __name__ == "__main__":
+    main()
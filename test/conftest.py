@@ -0,0 +1,31 @@
+# Setup shared by the tests that run an Executor against FakeBackend
+import pytest
+import pytest_asyncio
+
+from fake import FakeBackend, fake_config, fake_servers
+from webapp.challenge import Challenge
+from webapp.database import Database
+from webapp.executor import Executor
+
+
+@pytest_asyncio.fixture
+async def database(tmp_path):
+    database = Database(str(tmp_path / "test.sqlite3"))
+    yield database
+    await database.close()
+
+
+@pytest.fixture
+def challenge():
+    return Challenge("web", "web", "flag{test}")
+
+
+@pytest.fixture
+def make_executor(database, challenge):
+    # An Executor on fake servers, the sections are passed on to fake_config
+    def make(servers=None, backend=None, **sections) -> Executor:
+        servers = fake_servers(1) if servers is None else servers
+        executor = Executor(fake_config(database, {challenge.name: challenge}, servers, **sections))
+        executor.backend = FakeBackend(latency=0) if backend is None else backend
+        return executor
+    return make
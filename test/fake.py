@@ -0,0 +1,165 @@
+# In-process stand-in for the servers, used by the benchmarks.
+#
+# FakeBackend takes the place of the SSH backend of an Executor. It answers
+# the commands the instancer sends (run.sh, destroy.sh, docker compose ls,
+# resource snapshots, ss, probes) from a model of every server's compose
+# projects, after a simulated latency and with an optional failure rate. No
+# network, SSH or Docker is involved.
+import asyncio
+import json
+import random
+import re
+from collections import Counter
+from types import SimpleNamespace
+
+from webapp.placement import SNAPSHOT_CMD
+from webapp.server import Server
+
+# Sections of config.toml the components read, all left at their defaults
+SECTIONS = ["ssh", "sync", "placement", "pools", "warmup", "lifetime", "reconcile", "admission",
+            "cluster", "reload"]
+
+PROJECT = re.compile(r"COMPOSE_PROJECT_NAME=(\S+)")
+TEAM = re.compile(r"--team (\S+)")
+PORT = re.compile(r"--port (\d+)")
+SOURCE = re.compile(r"cd (?:\"\$\(readlink -f )?(\S+/Source)")
+CONNECTION = re.compile(r"--connection-string \"\S+ (\d+)\"")
+
+
+class FakeNode:
+    def __init__(self, cpus: int = 8, memory: int = 16 * 1024 * 1024) -> None:
+        self.cpus = cpus
+        self.memory = memory
+        # compose project -> (Source directory, running, port)
+        self.projects = {}
+
+    def snapshot(self) -> str:
+        running = sum(1 for _, up, _ in self.projects.values() if up)
+        # Every running instance takes a bit of cpu and 128MB
+        available = max(0, self.memory - running * 128 * 1024)
+        return (f"{0.05 * running:.2f} 0.00 0.00 1/100 1000\n{self.cpus}\n" +
+                f"MemTotal: {self.memory} kB\nMemAvailable: {available} kB\n{running}\n")
+
+    def compose_ls(self) -> str:
+        return json.dumps([
+            {"Name": name, "Status": "running(1)" if up else "exited(1)",
+             "ConfigFiles": f"{source}/docker-compose.yml"}
+            for name, (source, up, _) in self.projects.items()
+        ])
+
+    def listening(self) -> str:
+        return "\n".join(f"LISTEN 0 4096 0.0.0.0:{port} 0.0.0.0:*"
+                         for _, up, port in self.projects.values() if up and port is not None)
+
+
+class FakeBackend:
+    def __init__(self, latency: float = 0.005, start_latency: float = 0.2,
+                 stop_latency: float = 0.1, failure_rate: float = 0, seed: int = 0) -> None:
+        # Seconds a command takes, run.sh and destroy.sh take longer. Each
+        # latency is drawn around the mean so commands don't finish in lockstep.
+        self.latency = latency
+        self.start_latency = start_latency
+        self.stop_latency = stop_latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.nodes = {}
+        self.commands = 0
+        self.failures = 0
+        # hostname -> commands sent to it
+        self.contacted = Counter()
+
+    def node(self, server) -> FakeNode:
+        node = self.nodes.get(server.hostname)
+        if node is None:
+            node = self.nodes[server.hostname] = FakeNode()
+        return node
+
+    async def delay(self, mean: float):
+        if mean > 0:
+            await asyncio.sleep(self.random.uniform(0.5 * mean, 1.5 * mean))
+
+    def fails(self) -> bool:
+        if self.failure_rate > 0 and self.random.random() < self.failure_rate:
+            self.failures += 1
+            return True
+        return False
+
+    def destroy(self, node: FakeNode, step: str) -> bool:
+        team = TEAM.search(step)
+        if team is None or self.fails():
+            return False
+        node.projects.pop(team.group(1), None)
+        return True
+
+    async def run(self, server, cmd, timeout=None) -> str | None:
+        self.commands += 1
+        self.contacted[server.hostname] += 1
+        node = self.node(server)
+        if cmd == SNAPSHOT_CMD:
+            await self.delay(self.latency)
+            return node.snapshot()
+        if cmd.startswith("docker compose ls"):
+            await self.delay(self.latency)
+            return node.compose_ls()
+        if cmd.startswith("ss "):
+            await self.delay(self.latency)
+            return node.listening()
+        if cmd.startswith("which "):
+            return "/usr/bin/python3"
+        if "run.sh" in cmd:
+            await self.delay(self.start_latency)
+            if self.fails():
+                return None
+            project, port, source = PROJECT.search(cmd), PORT.search(cmd), SOURCE.search(cmd)
+            node.projects[project.group(1)] = (source.group(1), True, int(port.group(1)))
+            return "started"
+        if "destroy.sh" in cmd:
+            steps = cmd.split(" ; ")
+            await self.delay(self.stop_latency * len(steps))
+            if "echo stopped:" not in cmd:
+                return "stopped" if self.destroy(node, cmd) else None
+            # stop_many and the reconciler chain one destroy.sh per instance
+            return "\n".join(f"stopped:{i}" if self.destroy(node, step) else f"failed:{i}"
+                             for i, step in enumerate(steps))
+        if "Tests/main.py" in cmd:
+            await self.delay(self.latency)
+            # Only finds an instance on the server it runs on
+            port = CONNECTION.search(cmd)
+            if port is not None and not any(up and int(port.group(1)) == listening
+                                            for _, up, listening in node.projects.values()):
+                return None
+            return '{"test": ""}'
+        # Syncing, warming up and anything else just succeeds
+        await self.delay(self.latency)
+        return "" if not self.fails() else None
+
+    async def stream(self, server, cmd, produce, timeout=None) -> str | None:
+        await asyncio.to_thread(produce, Discard())
+        return await self.run(server, cmd, timeout)
+
+    async def close(self):
+        pass
+
+
+class Discard:
+    def write(self, data: bytes) -> int:
+        return len(data)
+
+
+def fake_servers(count: int, **kwargs) -> list[Server]:
+    return [Server(f"node{i}", f"10.0.0.{i + 1}", 22, "root", "/deployment", **kwargs)
+            for i in range(count)]
+
+
+def fake_config(database, challenges: dict, servers: list[Server], **sections) -> SimpleNamespace:
+    # What Config provides, without reading config.toml or parsing challenges
+    config = SimpleNamespace(
+        api={"username": "bench", "password": "bench"},
+        keyfile="",
+        challenges=challenges,
+        servers=servers,
+        database=database,
+    )
+    for section in SECTIONS:
+        setattr(config, section, sections.get(section, {}))
+    return config
@@ -10,6 +10,7 @@ import logging
 from webapp.executor import Executor
 from webapp.config import Config
 from webapp.challenge import Challenge
+from webapp.service import Service
 
 CONFIG_PATH = "config.toml"
 
@@ -31,7 +32,8 @@ asyncio.run(executor.create_enviroment())
 
 app.extra = {
     "config": config,
-    "executor": executor
+    "executor": executor,
+    "service": Service(config, executor)
 }
 
 def test_start_stop_status_endpoints(): 
@@ -0,0 +1,78 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from webapp.admission import Rejected, StartQueue
+from webapp.database import ChallengeState
+
+
+class SlowChallenge:
+    def __init__(self, name, release):
+        self.name = name
+        self.release = release
+        self.started = []
+
+    async def start(self, executor, user_id):
+        self.started.append(user_id)
+        await self.release.wait()
+
+
+@pytest.mark.asyncio
+async def test_queue_positions_and_quotas():
+    release = asyncio.Event()
+    web = SlowChallenge("web", release)
+    executor = SimpleNamespace(placement=SimpleNamespace(snapshots={}))
+    queue = StartQueue(executor, {"workers": 1, "max_queued": 2, "per_user": 1})
+    assert (await queue.submit(web, "alice")).position == 1
+    await asyncio.sleep(0)
+    # alice is being started, bob and carol wait behind her
+    assert queue.ticket(web, "alice").position == 0
+    assert (await queue.submit(web, "bob")).position == 1
+    assert (await queue.submit(web, "carol")).position == 2
+    assert queue.ticket(web, "carol").eta > queue.ticket(web, "bob").eta
+
+    with pytest.raises(Rejected) as full:
+        await queue.submit(web, "dave")
+    assert full.value.reason == "start queue is full" and full.value.retry_after > 0
+    with pytest.raises(Rejected) as quota:
+        await queue.submit(SlowChallenge("pwn", release), "alice")
+    assert quota.value.reason == "too many starts for this user"
+
+    release.set()
+    while len(queue.jobs) > 0:
+        await asyncio.sleep(0)
+    assert web.started == ["alice", "bob", "carol"]
+    assert len(queue.users) == 0 and len(queue.challenges) == 0
+
+
+@pytest.mark.asyncio
+async def test_starts_of_other_replicas_count(database, challenge, make_executor):
+    executor = make_executor(admission={"max_starting": 2})
+    await executor.placement.refresh()
+    release = asyncio.Event()
+
+    async def start(executor, user_id):
+        await ChallengeState(database, "web", user_id).transition("starting", create=True)
+        await release.wait()
+
+    challenge.start = start
+    # Another replica is starting alice's instance, this one bob's
+    await ChallengeState(database, "web", "alice").transition("starting", create=True)
+    assert (await executor.starts.submit(challenge, "bob")).position == 1
+    while await database.count(["starting"]) < 2:
+        await asyncio.sleep(0.01)
+    with pytest.raises(Rejected) as busy:
+        await executor.starts.submit(challenge, "carol")
+    assert busy.value.reason == "too many starts in the cluster"
+
+    release.set()
+    while len(executor.starts.jobs) > 0:
+        await asyncio.sleep(0.01)
+
+    # Without a server to place it on, a start is not queued at all
+    executor.config.servers[0].draining = True
+    with pytest.raises(Rejected) as full:
+        await executor.starts.submit(challenge, "carol")
+    assert full.value.reason == "no server has room for another instance"
+    assert full.value.retry_after == executor.placement.interval
@@ -0,0 +1,145 @@
+import asyncio
+
+import httpx
+import pytest
+import pytest_asyncio
+
+from fake import FakeBackend, fake_servers
+from webapp.api import MAX_BATCH, app
+from webapp.challenge import Challenge, stop_many
+from webapp.database import ChallengeState
+from webapp.service import Service, background_tasks
+
+
+@pytest.fixture
+def executor(challenge, make_executor):
+    challenge.url = "http://{{IP}}:{{PORT}}"
+    executor = make_executor(fake_servers(2), FakeBackend(latency=0, start_latency=0, stop_latency=0))
+    pwn = executor.config.challenges["pwn"] = Challenge("pwn", "pwn", "flag{pwn}")
+    pwn.url = "nc {{IP}} {{PORT}}"
+    return executor
+
+
+@pytest_asyncio.fixture
+async def client(executor):
+    extra = app.extra
+    app.extra = {"config": executor.config, "executor": executor,
+                 "service": Service(executor.config, executor)}
+    await executor.placement.refresh()
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://instancer",
+                                 auth=httpx.BasicAuth("bench", "bench")) as client:
+        yield client
+    app.extra = extra
+
+
+async def run(executor, user_id: str, name: str, server: int, port: int):
+    # An instance that is up on its server
+    executor.config.servers[server].ports.reserve(port)
+    await ChallengeState(executor.config.database, name, user_id).transition(
+        "running", create=True, server=server, port=port, project=user_id)
+    node = executor.backend.node(executor.config.servers[server])
+    node.projects[user_id] = (f"/deployment/{name}/Source", True, port)
+
+
+def by_pair(entries: list) -> dict:
+    return {(entry["user_id"], entry["challenge"]): entry for entry in entries}
+
+
+@pytest.mark.asyncio
+async def test_batch_status_selects_by_filter(database, executor, client):
+    await run(executor, "alice", "web", 0, 3000)
+    await run(executor, "alice", "pwn", 1, 3001)
+    await ChallengeState(database, "web", "bob").transition("failed", "run.sh failed", create=True)
+
+    response = await client.post("/batch/status", json={"user_id": "alice"})
+    assert response.status_code == 200
+    assert by_pair(response.json()) == {
+        ("alice", "web"): {"user_id": "alice", "challenge": "web", "state": "running",
+                           "url": "http://10.0.0.1:3000"},
+        ("alice", "pwn"): {"user_id": "alice", "challenge": "pwn", "state": "running",
+                           "url": "nc 10.0.0.2 3001"},
+    }
+
+    response = await client.post("/batch/status", json={"challenge": "web"})
+    assert {pair: entry["state"] for pair, entry in by_pair(response.json()).items()} == {
+        ("alice", "web"): "running", ("bob", "web"): "failed"}
+
+    # Pairs without a row are not started, unknown challenges are left out
+    response = await client.post("/batch/status", json={"instances": [["carol", "web"], ["carol", "nope"]],
+                                                        "user_id": "bob"})
+    assert {pair: entry["state"] for pair, entry in by_pair(response.json()).items()} == {
+        ("carol", "web"): "not started", ("bob", "web"): "failed"}
+    assert (await client.post("/batch/status", json={})).json() == []
+
+
+@pytest.mark.asyncio
+async def test_batch_limits(client):
+    pairs = [[f"user{i}", "web"] for i in range(MAX_BATCH + 1)]
+    for endpoint in ("/batch/status", "/batch/start", "/batch/stop"):
+        assert (await client.post(endpoint, json={"instances": pairs})).status_code == 422
+        assert (await client.post(endpoint, json={"instances": [["Alice!", "web"]]})).status_code == 422
+    assert (await client.post("/batch/status", json={"instances": pairs[:MAX_BATCH]})).status_code == 200
+
+    # Filters would start nothing, so they are refused instead
+    response = await client.post("/batch/start", json={"user_id": "alice"})
+    assert response.status_code == 422
+    assert (await client.post("/batch/start", json={"challenge": "web"})).status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_batch_start(database, executor, client):
+    await run(executor, "alice", "web", 0, 3000)
+    executor.config.challenges["pwn"].removed = True
+
+    response = await client.post("/batch/start", json={"instances": [
+        ["alice", "web"], ["bob", "web"], ["bob", "pwn"], ["bob", "nope"]]})
+    assert response.status_code == 200
+    results = by_pair(response.json())
+    assert results[("alice", "web")]["result"] == "running"
+    assert results[("bob", "web")]["result"] == "starting" and "eta" in results[("bob", "web")]
+    assert results[("bob", "pwn")]["result"] == results[("bob", "nope")]["result"] == "not found"
+
+    while len(executor.starts.jobs) > 0:
+        await asyncio.sleep(0.01)
+    assert (await ChallengeState(database, "web", "bob").fetch()).state == "running"
+
+
+@pytest.mark.asyncio
+async def test_batch_stop_by_user(database, executor, client):
+    await run(executor, "alice", "web", 0, 3000)
+    await run(executor, "alice", "pwn", 1, 3001)
+    await run(executor, "bob", "web", 0, 3002)
+
+    response = await client.post("/batch/stop", json={"user_id": "alice", "instances": [["carol", "web"]]})
+    assert {pair: entry["result"] for pair, entry in by_pair(response.json()).items()} == {
+        ("alice", "web"): "stopping", ("alice", "pwn"): "stopping", ("carol", "web"): "not running"}
+    await asyncio.gather(*background_tasks)
+
+    assert await database.select(user_id="alice") == []
+    servers = executor.config.servers
+    assert 3000 not in servers[0].ports and 3001 not in servers[1].ports and 3002 in servers[0].ports
+    assert "alice" not in executor.backend.node(servers[0]).projects
+
+
+class PartialBackend(FakeBackend):
+    # destroy.sh of the second instance fails, and the output is cut off
+    # before the third one reported back
+    async def run(self, server, cmd, timeout=None) -> str | None:
+        if "destroy.sh" in cmd:
+            return "stopped:0\nfailed:1"
+        return await super().run(server, cmd, timeout)
+
+
+@pytest.mark.asyncio
+async def test_stop_many_frees_only_stopped_ports(database, challenge, make_executor):
+    executor = make_executor(backend=PartialBackend(latency=0))
+    server = executor.config.servers[0]
+    targets = []
+    for i, user_id in enumerate(["alice", "bob", "carol"]):
+        await run(executor, user_id, "web", 0, 3000 + i)
+        targets.append((challenge, user_id, await ChallengeState(database, "web", user_id).fetch()))
+
+    await stop_many(executor, targets)
+    assert 3000 not in server.ports and 3001 in server.ports and 3002 in server.ports
+    assert await database.select(name="web") == []
@@ -0,0 +1,69 @@
+import pytest
+
+from fake import fake_servers
+from webapp.database import ChallengeState
+from webapp.executor import PROBE
+from webapp.metrics import RETRIEVES
+from webapp.reconcile import Project
+
+
+async def probe(executor, server, port):
+    # What Challenge.probe runs on the server, the probe itself doesn't ask it yet
+    return await executor.run(server, f'python3 Tests/main.py --connection-string "127.0.0.1 {port}"',
+                              lane=PROBE)
+
+
+@pytest.fixture
+def executor(challenge, make_executor):
+    challenge.probe = probe
+    executor = make_executor(fake_servers(3))
+    RETRIEVES.reset()
+    return executor
+
+
+async def place(executor, user_id: str, recorded: int | None, actual: int, port: int):
+    # The instance runs on `actual`, the row says it is on `recorded`
+    await ChallengeState(executor.config.database, "web", user_id).transition(
+        "starting", create=True, server=recorded, port=port)
+    node = executor.backend.node(executor.config.servers[actual])
+    node.projects[user_id] = ("/deployment/web/Source", True, port)
+
+
+@pytest.mark.asyncio
+async def test_retrieve_state_probes_the_recorded_server(database, challenge, executor):
+    await place(executor, "alice", 1, 1, 3000)
+    await challenge.retrieve_state(executor, "alice")
+
+    assert set(executor.backend.contacted) == {"node1"}
+    assert RETRIEVES.get("direct") == 1 and RETRIEVES.get("fallback") == 0
+    assert (await ChallengeState(database, "web", "alice").fetch()).state == "running"
+
+
+@pytest.mark.asyncio
+async def test_retrieve_state_asks_the_inventory(database, challenge, executor):
+    await place(executor, "alice", 0, 2, 3000)
+    executor.reconciler.inventory.servers = {
+        "node1": {}, "node2": {("web", "alice"): Project("web", "alice", True)}}
+    await challenge.retrieve_state(executor, "alice")
+
+    assert set(executor.backend.contacted) == {"node0", "node2"}
+    assert (RETRIEVES.get("direct"), RETRIEVES.get("inventory"), RETRIEVES.get("fallback")) == (1, 1, 0)
+    instance = await ChallengeState(database, "web", "alice").fetch()
+    assert (instance.state, instance.server) == ("running", 2)
+
+
+@pytest.mark.asyncio
+async def test_retrieve_state_sweeps_without_a_record(database, challenge, executor):
+    await place(executor, "alice", None, 1, 3000)
+    await challenge.retrieve_state(executor, "alice")
+
+    assert set(executor.backend.contacted) == {"node0", "node1", "node2"}
+    assert (RETRIEVES.get("direct"), RETRIEVES.get("inventory"), RETRIEVES.get("fallback")) == (0, 0, 1)
+    instance = await ChallengeState(database, "web", "alice").fetch()
+    assert (instance.state, instance.server) == ("running", 1)
+
+    # Gone from every server
+    executor.backend.node(executor.config.servers[1]).projects.clear()
+    await challenge.retrieve_state(executor, "alice")
+    assert (RETRIEVES.get("direct"), RETRIEVES.get("fallback")) == (1, 2)
+    assert (await ChallengeState(database, "web", "alice").fetch()).state == "stopped"
@@ -0,0 +1,78 @@
+import asyncio
+import multiprocessing
+from types import SimpleNamespace
+
+import pytest
+
+from webapp.cluster import Cluster
+from webapp.database import Database
+from webapp.server import Server
+
+REPLICAS = 4
+KEYS = 20
+PORTS = 10
+
+
+def replica(path: str, holder: str):
+    # One instancer process sharing the sqlite database with the others
+    database = Database(path, cache_size=0)
+    server = Server("node0", "127.0.0.1", 22, "root", "/deployment", ports=(20000, 20000 + REPLICAS * PORTS))
+    config = SimpleNamespace(database=database, challenges={}, servers=[server])
+    cluster = Cluster(SimpleNamespace(config=config), {"enabled": True, "id": holder})
+
+    async def scenario():
+        won = [key for key in range(KEYS) if await cluster.acquire(f"working/web/user{key}", 60)]
+        ports = [await cluster.alloc_port(server) for _ in range(PORTS)]
+        await cluster.elect()
+        await database.close()
+        return won, ports, cluster.leader
+
+    return asyncio.run(scenario())
+
+
+def test_replicas_share_leases_and_ports(tmp_path):
+    path = str(tmp_path / "cluster.sqlite3")
+    Database(path)
+    with multiprocessing.get_context("spawn").Pool(REPLICAS) as pool:
+        results = pool.starmap(replica, [(path, f"replica{i}") for i in range(REPLICAS)])
+
+    won = [key for keys, _, _ in results for key in keys]
+    assert sorted(won) == list(range(KEYS))
+    ports = [port for _, allocated, _ in results for port in allocated]
+    assert None not in ports and len(set(ports)) == len(ports)
+    assert sum(leader for _, _, leader in results) == 1
+
+
+@pytest.mark.asyncio
+async def test_leased_working_set(database):
+    challenge = SimpleNamespace(name="web", working_set=None)
+    config = SimpleNamespace(database=database, challenges={"web": challenge}, servers=[])
+    first = Cluster(SimpleNamespace(config=config), {"enabled": True, "id": "first"})
+    working_set = challenge.working_set
+    other = Cluster(SimpleNamespace(config=config), {"enabled": True, "id": "other"}).acquire
+
+    assert await working_set.contains_or_insert("alice")
+    assert not await working_set.contains_or_insert("alice")
+    assert not await other("working/web/alice", 60)
+    assert await working_set.members() == {"alice"}
+    await working_set.remove("alice")
+    assert await other("working/web/alice", 60)
+    assert not await first.acquire("working/web/alice", 60)
+
+
+@pytest.mark.asyncio
+async def test_reloading_ports_keeps_listening_ports(database):
+    server = Server("node0", "127.0.0.1", 22, "root", "/deployment", ports=(20000, 20003))
+    config = SimpleNamespace(database=database, challenges={}, servers=[server])
+    cluster = Cluster(SimpleNamespace(config=config), {"enabled": True, "id": "first"})
+    await database.reserve_ports([("node0", 20001)])
+    await cluster.reserve_ports()
+    # sshd listens on 20000, see Executor.reserve_listening
+    assert server.ports.reserve(20000)
+
+    assert await cluster.alloc_port(server) == 20002
+    assert await cluster.alloc_port(server) == 20003
+    # Another replica stops its instance, the bitmap ran dry and reloads
+    await database.release_ports([("node0", 20001)])
+    assert await cluster.alloc_port(server) == 20001
+    assert await cluster.alloc_port(server) is None
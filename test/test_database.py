@@ -0,0 +1,213 @@
+import asyncio
+import random
+import sqlite3
+
+import pytest
+
+from webapp.database import ChallengeState, Database, Instance
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    return str(tmp_path / "database.sqlite3")
+
+
+def read_db(db_file, name, user_id):
+    with sqlite3.connect(db_file) as db:
+        row = db.execute("SELECT state, reason, port, server FROM challenges \
+            WHERE name=? AND user_id=?", (name, user_id)).fetchone()
+    return None if row is None else Instance(*row)
+
+
+def run(database, coro):
+    async def wrapper():
+        try:
+            return await coro
+        finally:
+            await database.close()
+    return asyncio.run(wrapper())
+
+
+def test_cache_populated_at_startup(db_file):
+    with sqlite3.connect(db_file) as db:
+        db.execute("CREATE TABLE challenges (name TEXT NOT NULL, user_id TEXT NOT NULL, \
+            server INTEGER, state TEXT NOT NULL, reason TEXT NOT NULL, port INTEGER, \
+            PRIMARY KEY (name, user_id))")
+        db.execute("INSERT INTO challenges VALUES ('pwn', 'alice', 1, 'running', '', 1337)")
+
+    database = Database(db_file)
+    assert database.cache.get(("pwn", "alice")) == Instance("running", "", 1337, 1)
+
+
+def test_write_through(db_file):
+    database = Database(db_file)
+
+    async def scenario():
+        state = ChallengeState(database, "pwn", "alice")
+        await state.transition("starting", create=True)
+        assert await state.fetch() == read_db(db_file, "pwn", "alice")
+        assert ("pwn", "alice") in database.cache.entries
+
+        await state.transition(server=0, port=2000)
+        await state.set("failed", "run.sh failed")
+        assert database.cache.get(("pwn", "alice")) == Instance("failed", "run.sh failed", 2000, 0)
+        assert read_db(db_file, "pwn", "alice") == Instance("failed", "run.sh failed", 2000, 0)
+
+        await state.delete()
+        assert await state.fetch() is None
+        assert read_db(db_file, "pwn", "alice") is None
+
+    run(database, scenario())
+
+
+def test_random_operations_match_database(db_file):
+    database = Database(db_file, cache_size=8)
+    rng = random.Random(1337)
+    keys = [("pwn", str(user)) for user in range(20)]
+
+    async def operation(key):
+        state = ChallengeState(database, *key)
+        match rng.randrange(5):
+            case 0:
+                await state.create_challenge()
+            case 1:
+                await state.set(rng.choice(["starting", "running", "failed"]), "r")
+            case 2:
+                await state.transition("running", server=rng.randrange(3),
+                                       port=rng.randrange(1024, 65535))
+            case 3:
+                await state.delete()
+            case 4:
+                await state.fetch()
+
+    async def scenario():
+        for _ in range(50):
+            # Concurrent operations on distinct keys, so the final state of
+            # each key does not depend on how the writer orders them.
+            batch = rng.sample(keys, 10)
+            await asyncio.gather(*[operation(key) for key in batch])
+            for key in keys:
+                assert await ChallengeState(database, *key).fetch() == read_db(db_file, *key)
+            assert len(database.cache) <= 8
+
+    run(database, scenario())
+
+
+def test_concurrent_reads_do_not_cache_stale_rows(db_file):
+    database = Database(db_file)
+
+    async def scenario():
+        state = ChallengeState(database, "pwn", "alice")
+        await state.transition("starting", create=True)
+        database.cache.discard(state.key)
+
+        for i in range(20):
+            # The read is started before the write and may complete after it
+            reads = [asyncio.create_task(state.fetch()) for _ in range(5)]
+            await state.transition("running", port=3000 + i)
+            await asyncio.gather(*reads)
+            assert await state.fetch() == read_db(db_file, "pwn", "alice")
+            database.cache.discard(state.key)
+
+    run(database, scenario())
+
+
+def test_cache_remembers_missing_rows(db_file):
+    database = Database(db_file)
+
+    async def scenario():
+        alice = ChallengeState(database, "pwn", "alice")
+        assert await alice.fetch() is None
+        assert database.cache.lookup(alice.key) == (True, None)
+        await alice.create_challenge()
+        assert (await alice.fetch()).state == "created"
+
+        bob = ChallengeState(database, "pwn", "bob")
+        assert await bob.fetch() is None
+        await ChallengeState(database, "pwn", "pool-1").transition("running", create=True, port=2000)
+        await bob.claim("pool-1")
+        assert await bob.fetch() == Instance("running", "", 2000, None, None, "pool-1")
+
+    run(database, scenario())
+
+
+def test_idle_eviction(db_file, monkeypatch):
+    database = Database(db_file, cache_idle=10)
+    now = [1000.0]
+    monkeypatch.setattr("webapp.database.monotonic", lambda: now[0])
+
+    async def scenario():
+        for user in ["alice", "bob"]:
+            await ChallengeState(database, "pwn", user).transition("running", create=True)
+            await ChallengeState(database, "pwn", user).fetch()
+
+        now[0] += 5
+        await ChallengeState(database, "pwn", "bob").fetch()
+        now[0] += 6
+        await ChallengeState(database, "pwn", "carol").transition("running", create=True)
+        await ChallengeState(database, "pwn", "carol").fetch()
+
+        assert ("pwn", "alice") not in database.cache.entries
+        assert ("pwn", "bob") in database.cache.entries
+        # Evicted entries are still served from the database
+        assert await ChallengeState(database, "pwn", "alice").fetch() == Instance("running", "", None, None)
+
+    run(database, scenario())
+
+
+def test_cache_disabled(db_file):
+    database = Database(db_file, cache_size=0)
+
+    async def scenario():
+        state = ChallengeState(database, "pwn", "alice")
+        await state.transition("running", create=True, port=1337)
+        assert database.cache is None
+        assert await state.fetch() == Instance("running", "", 1337, None)
+
+    run(database, scenario())
+
+
+def test_claim_rekeys_pool_instance(db_file):
+    database = Database(db_file)
+
+    async def scenario():
+        pooled = ChallengeState(database, "pwn", "pool-1")
+        await pooled.transition("running", create=True, server=0, port=2000, project="pool-1")
+        user = ChallengeState(database, "pwn", "alice")
+        await user.transition("stopped", create=True)
+
+        await user.claim("pool-1")
+        assert await pooled.fetch() is None
+        assert await user.fetch() == Instance("running", "", 2000, 0, None, "pool-1")
+        assert read_db(db_file, "pwn", "pool-1") is None
+        assert read_db(db_file, "pwn", "alice") == Instance("running", "", 2000, 0)
+
+    run(database, scenario())
+
+
+def test_expired(db_file):
+    database = Database(db_file)
+
+    async def scenario():
+        for user, expires_at, idle_at in [("alice", 100, None), ("bob", None, 50),
+                                          ("carol", 300, 300), ("dave", None, None)]:
+            await ChallengeState(database, "pwn", user).transition(
+                "running", create=True, expires_at=expires_at, idle_at=idle_at)
+        expired = await database.expired(200, 10)
+        assert sorted(user_id for _, user_id, _ in expired) == ["alice", "bob"]
+        assert len(await database.expired(200, 1)) == 1
+        assert [user_id for _, user_id, _ in await database.expired(200, 10, after=("pwn", "alice"))] == ["bob"]
+        assert await database.expired(200, 10, names=["web"]) == []
+
+    run(database, scenario())
+
+
+def test_instances_of_matches_the_prefix_literally(db_file):
+    database = Database(db_file)
+
+    async def scenario():
+        for user in ["pool_1", "poolx2", "pool"]:
+            await ChallengeState(database, "pwn", user).transition("running", create=True)
+        assert [user_id for _, user_id, _ in await database.instances_of("pool_")] == ["pool_1"]
+
+    run(database, scenario())
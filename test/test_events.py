@@ -0,0 +1,31 @@
+import pytest
+
+from webapp.events import RESYNC, EventBus
+
+
+@pytest.mark.asyncio
+async def test_filters():
+    bus = EventBus()
+    with bus.subscribe(user_id="alice") as alice, bus.subscribe(challenge="web") as web, \
+            bus.subscribe(user_id="alice", challenge="pwn") as alice_pwn:
+        bus.publish("web", "alice", None)
+        bus.publish("pwn", "bob", None)
+        assert alice.queue.qsize() == 1
+        assert web.queue.qsize() == 1
+        assert alice_pwn.queue.qsize() == 0
+        assert not bus.wants("rev", "carol")
+    assert bus.count == 0 and len(bus.by_user) == 0
+
+
+@pytest.mark.asyncio
+async def test_overflow_resyncs():
+    bus = EventBus(queue_size=2)
+    with bus.subscribe(user_id="alice") as subscriber:
+        for _ in range(5):
+            bus.publish("web", "alice", None)
+        assert subscriber.dropped == 3
+        assert (await subscriber.next())["type"] == "state"
+        assert (await subscriber.next())["type"] == "state"
+        assert await subscriber.next() == RESYNC
+        bus.publish("web", "alice", None)
+        assert (await subscriber.next())["type"] == "state"
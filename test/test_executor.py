@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+from fake import fake_servers
+from webapp.executor import BULK, PROBE, Lane
+
+
+class GatedBackend:
+    # Every command runs until its gate is opened
+    def __init__(self) -> None:
+        self.gates = {}
+        self.started = []
+
+    def gate(self, cmd: str) -> asyncio.Event:
+        return self.gates.setdefault(cmd, asyncio.Event())
+
+    async def run(self, server, cmd, timeout=None) -> str:
+        self.started.append(cmd)
+        await self.gate(cmd).wait()
+        return cmd
+
+
+@pytest.mark.asyncio
+async def test_probes_run_while_bulk_is_saturated(make_executor):
+    backend = GatedBackend()
+    executor = make_executor(fake_servers(1, max_sessions=3, probe_sessions=1), backend)
+    server = executor.config.servers[0]
+
+    bulk = [asyncio.create_task(executor.run(server, f"run.sh {i}")) for i in range(4)]
+    await asyncio.sleep(0)
+    assert backend.started == ["run.sh 0", "run.sh 1"]
+    assert executor.queue_depths()["node0"][BULK] == (2, 2)
+
+    # The bulk lane is full, a probe still gets through at once
+    backend.gate("probe").set()
+    assert await asyncio.wait_for(executor.run(server, "probe", lane=PROBE), 1) == "probe"
+
+    for i in range(4):
+        backend.gate(f"run.sh {i}").set()
+    await asyncio.gather(*bulk)
+    assert backend.started == ["run.sh 0", "run.sh 1", "probe", "run.sh 2", "run.sh 3"]
+
+
+@pytest.mark.asyncio
+async def test_lane_is_fifo():
+    lane = Lane(1)
+    order = []
+    release = asyncio.Event()
+
+    async def command(i):
+        async with lane.slot():
+            order.append(i)
+            await release.wait()
+
+    first = asyncio.create_task(command(0))
+    await asyncio.sleep(0)
+    waiting = []
+    for i in range(1, 5):
+        waiting.append(asyncio.create_task(command(i)))
+        await asyncio.sleep(0)
+    assert (lane.waiting, lane.running) == (4, 1)
+
+    release.set()
+    await asyncio.gather(first, *waiting)
+    assert order == [0, 1, 2, 3, 4]
+    assert (lane.waiting, lane.running) == (0, 0)
@@ -0,0 +1,66 @@
+import os
+import sys
+
+from webapp.index import load_challenges
+
+# Stands in for the checker of the challenge repo, every challenge is a
+# <category>/<name> directory with a challenge.yml
+CHECKER = """
+import os
+from types import SimpleNamespace
+from yaml import safe_load
+
+PARSES = []
+
+
+class ChallengeSet:
+    def __init__(self, path):
+        PARSES.append(path)
+        self.challenges = {}
+        for category in sorted(os.listdir(path)):
+            if not os.path.isdir(os.path.join(path, category)):
+                continue
+            for name in sorted(os.listdir(os.path.join(path, category))):
+                with open(os.path.join(path, category, name, "challenge.yml")) as f:
+                    data = safe_load(f)
+                self.challenges[data["uuid"]] = SimpleNamespace(
+                    uuid=data["uuid"], path=f"{category}/{name}", flag={data["flag"]: 1}, url=[data["url"]])
+"""
+
+
+def write_challenge(path, category, name, flag):
+    os.makedirs(os.path.join(path, category, name, "Source"), exist_ok=True)
+    with open(os.path.join(path, category, name, "challenge.yml"), "w") as f:
+        f.write(f"uuid: {name}\nflag: {flag}\nurl: http://{{{{IP}}}}:{{{{PORT}}}}\n")
+
+
+def test_index_skips_the_checker_until_a_challenge_changes(tmp_path):
+    repo = str(tmp_path / "challenges")
+    os.makedirs(repo)
+    with open(os.path.join(repo, "checker.py"), "w") as f:
+        f.write(CHECKER)
+    write_challenge(repo, "web", "easy", "flag{easy}")
+    write_challenge(repo, "pwn", "hard", "flag{hard}")
+    index = str(tmp_path / "challenges.json")
+
+    try:
+        first = load_challenges(repo, index)
+        import checker
+        assert len(checker.PARSES) == 1
+        assert first["easy"].path == "web/easy" and first["hard"].flag == "flag{hard}"
+
+        again = load_challenges(repo, index)
+        assert len(checker.PARSES) == 1
+        assert {name: (c.path, c.flag, c.url) for name, c in again.items()} == \
+            {name: (c.path, c.flag, c.url) for name, c in first.items()}
+
+        write_challenge(repo, "web", "easy", "flag{changed}")
+        assert load_challenges(repo, index)["easy"].flag == "flag{changed}"
+        assert len(checker.PARSES) == 2
+
+        write_challenge(repo, "web", "new", "flag{new}")
+        assert "new" in load_challenges(repo, index)
+        assert len(checker.PARSES) == 3
+    finally:
+        sys.modules.pop("checker", None)
+        sys.path.remove(repo)
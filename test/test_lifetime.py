@@ -0,0 +1,24 @@
+import pytest
+
+from fake import FakeBackend
+from webapp.database import ChallengeState
+
+
+@pytest.mark.asyncio
+async def test_reap_pages_past_skipped_instances(database, challenge, make_executor):
+    executor = make_executor(backend=FakeBackend(latency=0, stop_latency=0),
+                             lifetime={"batch": 5, "rate": 1000})
+
+    # A full batch of rows of a challenge that is gone and of users
+    # being started, in front of the one instance to reap
+    for i in range(5):
+        await ChallengeState(database, "gone", f"user{i}").transition(
+            "running", create=True, expires_at=1)
+        await ChallengeState(database, "web", f"busy{i}").transition(
+            "running", create=True, expires_at=1)
+        await challenge.working_set.add(f"busy{i}")
+    await ChallengeState(database, "web", "zoe").transition(
+        "running", create=True, server=0, port=3000, expires_at=1)
+
+    assert await executor.lifetime.reap() == 1
+    assert await ChallengeState(database, "web", "zoe").fetch() is None
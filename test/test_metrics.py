@@ -0,0 +1,26 @@
+from webapp.metrics import Counter, Histogram, REGISTRY, render
+
+
+def test_histogram_is_cumulative():
+    histogram = Histogram("test_seconds", "Test histogram", ("path",), buckets=(0.1, 1))
+    REGISTRY.remove(histogram)
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.observe(value, "a")
+    samples = {(name, labels): value for name, labels, value in histogram.samples()}
+    assert samples[("test_seconds_bucket", '{path="a",le="0.1"}')] == 1
+    assert samples[("test_seconds_bucket", '{path="a",le="1"}')] == 3
+    assert samples[("test_seconds_bucket", '{path="a",le="+Inf"}')] == 4
+    assert samples[("test_seconds_count", '{path="a"}')] == 4
+    assert samples[("test_seconds_sum", '{path="a"}')] == 6.05
+    assert histogram.count("a") == 4
+
+
+def test_render_escapes_labels():
+    counter = Counter("test_total", "Test counter", ("server",))
+    try:
+        counter.inc('a"b\\c')
+        counter.inc('a"b\\c', amount=2)
+        assert 'test_total{server="a\\"b\\\\c"} 3\n' in render()
+        assert "# TYPE test_total counter\n" in render()
+    finally:
+        REGISTRY.remove(counter)
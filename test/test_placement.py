@@ -0,0 +1,25 @@
+from types import SimpleNamespace
+
+from webapp.placement import POLICIES, Candidate, Placement, Snapshot
+
+
+def candidate(hostname: str, load: float, warm: bool) -> Candidate:
+    snapshot = Snapshot(load, 1, 1000, 1000, 0, 0)
+    return Candidate(SimpleNamespace(hostname=hostname), snapshot, 0, 100, warm)
+
+
+def test_policies_weigh_warm_servers():
+    idle, busy = candidate("idle", 0.1, False), candidate("busy", 0.5, True)
+    # Warm servers win unless the policy says otherwise
+    assert POLICIES["least-loaded"]([idle, busy], None, {}).server.hostname == "busy"
+    assert POLICIES["bin-packing"]([idle, busy], None, {}).server.hostname == "busy"
+    affinity = {"web": ["idle"]}
+    assert POLICIES["affinity"]([idle, busy], SimpleNamespace(name="web"), affinity).server.hostname == "idle"
+    # A warm server that is too busy is not preferred
+    hot = candidate("hot", 0.9, True)
+    assert POLICIES["least-loaded"]([idle, hot], None, {}).server.hostname == "idle"
+
+
+def test_placement_options():
+    placement = Placement(None, {"policy": "spread", "intervall": 5})
+    assert (placement.policy, placement.interval) == ("spread", 15)
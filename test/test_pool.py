@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+from fake import fake_servers
+from webapp.database import ChallengeState
+
+
+@pytest.mark.asyncio
+async def test_claim_gives_back_the_replaced_instance(database, challenge, make_executor):
+    executor = make_executor(fake_servers(1, ports=(3000, 3004)))
+    server = executor.config.servers[0]
+    node = executor.backend.node(server)
+
+    # alice's earlier start failed after run.sh got going on port 3002
+    assert server.ports.reserve(3002)
+    await ChallengeState(database, "web", "alice").transition(
+        "failed", "starting run.sh failed", create=True, server=0, port=3002, project="alice")
+    node.projects["alice"] = ("/deployment/web/Source", False, 3002)
+
+    # A pool instance on port 3000
+    pool_id = "pool-test"
+    assert server.alloc_port() == 3000
+    await ChallengeState(database, "web", pool_id).transition(
+        "running", create=True, server=0, port=3000, project=pool_id)
+    node.projects[pool_id] = ("/deployment/web/Source", True, 3000)
+    executor.pools.pool(challenge).ready.append(pool_id)
+
+    assert await executor.pools.claim(challenge, "alice")
+    await asyncio.gather(*executor.pools.tasks)
+
+    instance = await ChallengeState(database, "web", "alice").fetch()
+    assert (instance.state, instance.port, instance.project) == ("running", 3000, pool_id)
+    assert "alice" not in node.projects and pool_id in node.projects
+    assert 3002 not in server.ports and 3000 in server.ports
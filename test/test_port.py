@@ -0,0 +1,37 @@
+from webapp.port import PortAllocator
+
+
+def test_exhaustion():
+    ports = PortAllocator(2000, 2003)
+    assert [ports.alloc() for _ in range(4)] == [2000, 2001, 2002, 2003]
+    assert ports.available() == 0
+    assert ports.alloc() is None
+
+    ports.free(2002)
+    assert ports.alloc() == 2002
+    assert ports.alloc() is None
+
+
+def test_wraparound():
+    ports = PortAllocator(2000, 2003)
+    for _ in range(3):
+        ports.alloc()
+    ports.free(2000)
+    # Continues after the last handed out port before wrapping around
+    assert ports.alloc() == 2003
+    assert ports.alloc() == 2000
+    ports.free(2001)
+    assert ports.alloc() == 2001
+
+
+def test_reserve_and_double_free():
+    ports = PortAllocator(2000, 2003)
+    assert ports.reserve(2000)
+    assert not ports.reserve(2000)
+    assert not ports.reserve(1999)
+    assert ports.alloc() == 2001
+
+    ports.free(2001)
+    ports.free(2001)
+    assert ports.available() == 3
+    assert 2000 in ports and 2001 not in ports
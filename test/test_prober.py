@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+from fake import FakeBackend
+from webapp.database import ChallengeState
+from webapp.prober import Prober
+
+
+@pytest.mark.asyncio
+async def test_probe_leaves_starts_alone(database, challenge, make_executor):
+    executor = make_executor()
+    prober = Prober(executor.config, executor, rate=1000)
+    probed = []
+
+    async def probe(executor, server, port):
+        probed.append(port)
+        return '{"test": "connection refused"}'
+
+    challenge.probe = probe
+    for user_id, port in (("alice", 3000), ("bob", 3001), ("carol", 3002)):
+        await ChallengeState(database, "web", user_id).transition(
+            "starting", create=True, server=0, port=port)
+    await ChallengeState(database, "web", "carol").transition("running")
+
+    # alice is still being started, bob's start is not known to be over
+    await challenge.working_set.add("alice")
+    await prober.probe_all()
+    await asyncio.gather(*prober.tasks)
+
+    assert sorted(probed) == [3001, 3002]
+    assert (await ChallengeState(database, "web", "alice").fetch()).state == "starting"
+    assert (await ChallengeState(database, "web", "bob").fetch()).state == "starting"
+    assert (await ChallengeState(database, "web", "carol").fetch()).state == "stopped"
+
+
+@pytest.mark.asyncio
+async def test_start_probes_once_run_sh_is_done(database, challenge, make_executor):
+    executor = make_executor(backend=FakeBackend(latency=0, start_latency=0))
+    await executor.placement.refresh()
+    results = iter(['{"test": "connection refused"}', '{"test": ""}'])
+
+    async def probe(executor, server, port):
+        return next(results)
+
+    challenge.probe = probe
+    # Not up yet, the start doesn't take that as stopped
+    await challenge.start(executor, "alice")
+    assert (await ChallengeState(database, "web", "alice").fetch()).state == "starting"
+    await challenge.start(executor, "bob")
+    assert (await ChallengeState(database, "web", "bob").fetch()).state == "running"
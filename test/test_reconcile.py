@@ -0,0 +1,51 @@
+from types import SimpleNamespace
+
+import pytest
+
+from fake import FakeBackend
+from webapp.challenge import Challenge
+from webapp.database import ChallengeState
+from webapp.reconcile import Inventory, Project, Reconciler
+
+
+def test_identify():
+    challenges = {"web": Challenge("web", "web/easy", "flag"), "easy": Challenge("easy", "easy", "flag")}
+    reconciler = Reconciler(SimpleNamespace(config=SimpleNamespace(challenges=challenges)), {})
+    dirs = reconciler.challenge_dirs()
+    assert reconciler.identify("/srv/challenges/web/easy/Source/docker-compose.yml", dirs) == "web"
+    assert reconciler.identify("/srv/challenges.releases/3/easy/Source/docker-compose.yml", dirs) == "easy"
+    assert reconciler.identify("/srv/other/Source/docker-compose.yml", dirs) is None
+
+
+def test_locate():
+    inventory = Inventory()
+    inventory.servers = {"n0": {("web", "alice"): Project("web", "alice", True)}, "n1": {}}
+    assert inventory.locate("web", "alice") == ["n0"]
+    assert inventory.locate("web", "bob") == []
+
+
+class ListingBackend(FakeBackend):
+    # A start of bob is done right after the servers were listed
+    def __init__(self, database) -> None:
+        super().__init__(latency=0)
+        self.database = database
+
+    async def run(self, server, cmd, timeout=None) -> str | None:
+        result = await super().run(server, cmd, timeout)
+        if cmd.startswith("docker compose ls") and "bob" not in self.node(server).projects:
+            self.node(server).projects["bob"] = ("/deployment/web/Source", True, 3001)
+            await ChallengeState(self.database, "web", "bob").transition(
+                "running", create=True, server=0, port=3001)
+        return result
+
+
+@pytest.mark.asyncio
+async def test_diff_compares_rows_with_a_newer_listing(database, make_executor):
+    executor = make_executor(backend=ListingBackend(database))
+    await ChallengeState(database, "web", "alice").transition("running", create=True, server=0, port=3000)
+
+    await executor.reconciler.reconcile()
+    assert (await ChallengeState(database, "web", "alice").fetch()).state == "stopped"
+    assert (await ChallengeState(database, "web", "bob").fetch()).state == "running"
+    await executor.reconciler.reconcile()
+    assert (await ChallengeState(database, "web", "bob").fetch()).state == "running"
@@ -0,0 +1,112 @@
+import os
+import sys
+
+import pytest
+
+from fake import FakeBackend
+from test_index import CHECKER, write_challenge
+from webapp.config import Config
+from webapp.executor import Executor
+from webapp.service import Service
+
+SERVER = '\n[servers.{0}]\nip = "{1}"\n'
+
+
+def write_config(tmp, repo, servers: list[tuple[str, str]]):
+    keyfile = os.path.join(tmp, "key")
+    open(keyfile, "w").close()
+    path = os.path.join(tmp, "config.toml")
+    with open(path, "w") as f:
+        f.write(f"""
+[api]
+ip = "127.0.0.1"
+port = 8000
+username = "test"
+password = "test"
+
+[database]
+path = "{os.path.join(tmp, 'test.sqlite3')}"
+
+[docker]
+challenge_path = "{repo}"
+index = "{os.path.join(tmp, 'challenges.json')}"
+
+[ssh]
+keyfile = "{keyfile}"
+
+[warmup]
+enabled = false
+
+[servers.default]
+port = "22"
+user = "root"
+path = "/deployment"
+""")
+        for server in servers:
+            f.write(SERVER.format(*server))
+    # Edits within the same tick of the clock still count
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + len(servers)))
+    return path
+
+
+@pytest.fixture
+def repo(tmp_path):
+    repo = tmp_path / "challenges"
+    repo.mkdir()
+    (repo / "checker.py").write_text(CHECKER)
+    write_challenge(repo, "web", "easy", "flag{easy}")
+    write_challenge(repo, "pwn", "hard", "flag{hard}")
+    yield str(repo)
+    sys.modules.pop("checker", None)
+    sys.path.remove(str(repo))
+
+
+@pytest.mark.asyncio
+async def test_reload_applies_edits_in_place(tmp_path, repo):
+    config = Config(write_config(str(tmp_path), repo, [("node0", "10.0.0.1"), ("node1", "10.0.0.2")]))
+    executor = Executor(config)
+    executor.backend = FakeBackend(latency=0)
+    synced = []
+    sync = executor.sync.sync
+
+    async def record(base_dir, servers):
+        synced.append(sorted(server.hostname for server in servers))
+        return await sync(base_dir, servers)
+
+    executor.sync.sync = record
+    await executor.create_enviroment()
+    await executor.reloader.watcher.check()
+    servers, challenges = config.servers, config.challenges
+
+    # Nothing changed, and every server synced fine
+    changes = await executor.reloader.reload()
+    assert changes["synced"] == [] and synced == [["node0", "node1"]]
+
+    # A new challenge is synced to the servers in use
+    write_challenge(repo, "web", "new", "flag{new}")
+    changes = await executor.reloader.reload()
+    assert changes["challenges"]["added"] == ["new"] and changes["files"] == ["web/new"]
+    assert synced[-1] == ["node0", "node1"] and config.challenges["new"].flag == "flag{new}"
+
+    # node1 drains, node2 joins and is the only one synced
+    write_config(str(tmp_path), repo, [("node0", "10.0.0.1"), ("node2", "10.0.0.3")])
+    changes = await executor.reloader.reload()
+    assert changes["servers"] == {"added": ["node2"], "changed": [], "removed": ["node1"]}
+    assert synced[-1] == ["node2"]
+    assert [server.hostname for server in config.servers] == ["node0", "node1", "node2"]
+    assert config.servers[1].draining
+    await executor.placement.refresh()
+    assert {c.server.hostname for c in executor.placement.candidates()} == {"node0", "node2"}
+
+    # A removed challenge can't be started anymore
+    os.remove(os.path.join(repo, "pwn", "hard", "challenge.yml"))
+    os.rmdir(os.path.join(repo, "pwn", "hard", "Source"))
+    os.rmdir(os.path.join(repo, "pwn", "hard"))
+    changes = await executor.reloader.reload()
+    assert changes["challenges"]["removed"] == ["hard"] and config.challenges["hard"].removed
+    assert await Service(config, executor).start("hard", "alice") == {
+        "state": "failed", "reason": "Challenge 'hard' not found"}
+
+    # Edited in place, everyone holding on to them sees the change
+    assert config.servers is servers and config.challenges is challenges
+    await config.database.close()
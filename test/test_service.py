@@ -0,0 +1,68 @@
+import asyncio
+import os
+import stat
+from types import SimpleNamespace
+
+import pytest
+
+from fake import FakeBackend, fake_servers
+from webapp import metrics
+from webapp.admission import Rejected
+from webapp.database import ChallengeState, Instance
+from webapp.events import EventBus
+from webapp.service import Service, ServiceClient, ServiceError, ServiceServer, describe
+
+
+@pytest.mark.asyncio
+async def test_api_worker_reaches_the_executor_service(tmp_path, database, challenge, make_executor):
+    challenge.url = "http://{{IP}}:{{PORT}}"
+    executor = make_executor(backend=FakeBackend(latency=0, start_latency=0.2, stop_latency=0),
+                             admission={"workers": 1, "max_queued": 1})
+    await executor.placement.refresh()
+
+    server = ServiceServer(Service(executor.config, executor), str(tmp_path / "service.sock"))
+    serving = asyncio.create_task(server.run())
+    await server.listening.wait()
+    assert stat.S_IMODE(os.stat(server.path).st_mode) == 0o600
+    client = ServiceClient(server.path)
+
+    # alice is being started, bob waits and carol finds the queue full
+    assert (await client.start("web", "alice"))["state"] == "starting"
+    assert (await client.start("web", "bob"))["position"] == 1
+    with pytest.raises(Rejected) as rejected:
+        await client.start("web", "carol")
+    assert rejected.value.reason == "start queue is full"
+    assert (await client.start("web", "alice"))["position"] == 0
+    assert await client.batch_stop([["carol", "web"]]) == [
+        {"user_id": "carol", "challenge": "web", "result": "not running"}]
+    with pytest.raises(ServiceError):
+        await client.call("collect_gauges")
+
+    # State changes made by the executor reach the worker's subscribers
+    bus = EventBus()
+    with bus.subscribe("dave", "web") as subscriber:
+        client.follow(bus)
+        await asyncio.sleep(0.1)
+        await ChallengeState(database, "web", "dave").transition("running", create=True, port=1234)
+        event = await asyncio.wait_for(subscriber.next(), 5)
+    assert event["instance"].state == "running" and event["instance"].port == 1234
+
+    # /metrics of the service adds up what the workers observed
+    metrics.HTTP_REQUESTS.reset()
+    metrics.HTTP_REQUESTS.observe(0.01, "challenge_status", "GET", "200")
+    text = await client.metrics()
+    assert 'instancer_http_request_seconds_count{endpoint="challenge_status",method="GET",status="200"} 1' in text
+
+    serving.cancel()
+    while len(executor.starts.jobs) > 0:
+        await asyncio.sleep(0.01)
+    # Every answer of a start has the same shape
+    assert await Service(executor.config, executor).start("web", "alice") == {"state": "running"}
+
+
+def test_describe_a_server_the_worker_does_not_know(challenge):
+    # Placed on a server a reload added after this API worker loaded config.toml
+    challenge.url = "http://{{IP}}:{{PORT}}"
+    config = SimpleNamespace(servers=fake_servers(1))
+    assert describe(config, challenge, Instance("running", "", 3000, 1)) == {
+        "state": "running", "url": "http://:3000"}
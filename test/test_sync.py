@@ -0,0 +1,96 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from fake import FakeBackend, fake_servers
+from webapp.server import Server
+from webapp.sync import ChallengeSync, Release
+
+
+@pytest.mark.asyncio
+async def test_prune_keeps_releases_in_use():
+    releases = "/srv.releases"
+    projects = [
+        {"Name": "alice", "ConfigFiles": f"{releases}/old-2/web/Source/docker-compose.yml"},
+        {"Name": "other", "ConfigFiles": "/opt/other/docker-compose.yml"},
+    ]
+    commands = []
+
+    async def run(server, cmd, timeout=None, lane=None):
+        commands.append(cmd)
+        if cmd.startswith("ls -1t"):
+            return "new\nold-1\nold-2\nold-3\nold-4\n"
+        if cmd.startswith("docker compose ls"):
+            return json.dumps(projects)
+        return ""
+
+    sync = ChallengeSync(SimpleNamespace(run=run), {"keep_releases": 2})
+    server = Server("node0", "10.0.0.1", 22, "root", "/srv")
+    await sync.prune(server, Release(server, "new"))
+    assert commands[-1] == f"cd {releases} && rm -rf -- old-3 old-4"
+
+    # An instance started through the symlink may use any release
+    commands.clear()
+    projects.append({"Name": "bob", "ConfigFiles": "/srv/web/Source/docker-compose.yml"})
+    await sync.prune(server, Release(server, "new"))
+    assert not any("rm -rf" in cmd for cmd in commands)
+
+
+class RelayBackend(FakeBackend):
+    # Forwarding between servers takes a while, and fails from `failing`
+    def __init__(self, servers, failing=()) -> None:
+        super().__init__(latency=0)
+        self.hostnames = {f"{server.user}@{server.ip}": server.hostname for server in servers}
+        self.failing = failing
+        self.forwards = []
+
+    async def run(self, server, cmd, timeout=None) -> str | None:
+        if not cmd.startswith("ssh "):
+            return await super().run(server, cmd, timeout)
+        target = next(hostname for login, hostname in self.hostnames.items() if f" {login} " in cmd)
+        await asyncio.sleep(0.01)
+        if server.hostname in self.failing:
+            return None
+        self.forwards.append((server.hostname, target))
+        return ""
+
+
+async def sync_tree(tmp_path, make_executor, failing=()):
+    (tmp_path / "web").mkdir()
+    (tmp_path / "web" / "challenge.yml").write_text("flag: flag{test}\n")
+    servers = fake_servers(7)
+    backend = RelayBackend(servers, failing)
+    executor = make_executor(servers, backend, sync={"distribution": "tree", "seeds": 1})
+    await executor.sync.sync(str(tmp_path), servers)
+    return backend.forwards, executor.sync.results
+
+
+@pytest.mark.asyncio
+async def test_tree_fans_out_from_the_seed(tmp_path, make_executor):
+    forwards, results = await sync_tree(tmp_path, make_executor)
+
+    assert all(result.ok for result in results.values()) and len(results) == 7
+    assert [hostname for hostname, result in results.items() if result.source == "instancer"] == ["node0"]
+    # Every server forwards as soon as it has the delta, the seed doesn't
+    # send to everyone itself
+    assert forwards[0] == ("node0", "node1")
+    received = {"node0"}
+    for source, target in forwards:
+        assert source in received
+        received.add(target)
+    assert len(received) == 7
+    assert sum(1 for source, _ in forwards if source == "node0") == 3
+
+
+@pytest.mark.asyncio
+async def test_tree_falls_back_to_the_instancer(tmp_path, make_executor):
+    forwards, results = await sync_tree(tmp_path, make_executor, failing={"node1"})
+
+    assert all(result.ok for result in results.values()) and len(results) == 7
+    assert all(source != "node1" for source, _ in forwards)
+    assert all(result.source != "node1" for result in results.values())
+    # What node1 failed to forward came from the instancer instead
+    direct = sorted(hostname for hostname, result in results.items() if result.source == "instancer")
+    assert direct[0] == "node0" and len(direct) > 1
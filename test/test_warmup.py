@@ -0,0 +1,52 @@
+import pytest
+
+from fake import FakeBackend, fake_servers
+
+
+class BuildBackend(FakeBackend):
+    # Nothing reaches node2, and building the images fails on node1 once
+    def __init__(self) -> None:
+        super().__init__(latency=0)
+        self.builds = []
+        self.broken = {"node1"}
+
+    async def run(self, server, cmd, timeout=None) -> str | None:
+        if server.hostname == "node2":
+            return None
+        if "docker compose build" in cmd:
+            self.builds.append(server.hostname)
+            if server.hostname in self.broken:
+                self.broken.discard(server.hostname)
+                return None
+        return await super().run(server, cmd, timeout)
+
+
+@pytest.mark.asyncio
+async def test_warm_up_synced_servers(tmp_path, challenge, make_executor):
+    (tmp_path / "web" / "Source").mkdir(parents=True)
+    (tmp_path / "web" / "Source" / "docker-compose.yml").write_text("services: {}\n")
+    backend = BuildBackend()
+    executor = make_executor(fake_servers(3), backend)
+    executor.config.challenge_path = str(tmp_path)
+    node0, node1, node2 = executor.config.servers
+
+    # node2 failed to sync and isn't warmed up, node1 failed to build
+    await executor.create_enviroment()
+    await executor.warmup.task
+    assert not executor.sync.results["node2"].ok
+    assert sorted(backend.builds) == ["node0", "node1"]
+    assert executor.warmup.is_warm(node0, challenge)
+    assert not executor.warmup.is_warm(node1, challenge)
+    assert not executor.warmup.is_warm(node2, challenge)
+
+    # Only what isn't warm yet is built again
+    await executor.create_enviroment()
+    await executor.warmup.task
+    assert sorted(backend.builds) == ["node0", "node1", "node1"]
+    assert executor.warmup.is_warm(node1, challenge)
+
+    # Changed content is built again everywhere
+    (tmp_path / "web" / "Source" / "docker-compose.yml").write_text("services: {web: {}}\n")
+    await executor.create_enviroment()
+    await executor.warmup.task
+    assert sorted(backend.builds) == ["node0", "node0", "node1", "node1", "node1"]
@@ -0,0 +1,150 @@
+import asyncio
+import time
+
+from collections import Counter, deque
+from logging import getLogger
+from typing import NamedTuple
+
+from webapp.metrics import ADMISSIONS
+from webapp.pool import DEFAULT_COLD_START, LATENCY_SAMPLES, percentile
+
+log = getLogger(__name__)
+
+
+class Rejected(Exception):
+    def __init__(self, reason: str, retry_after: float) -> None:
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket(NamedTuple):
+    # Place in the queue, 0 once it is being started, and the expected
+    # seconds until it is done
+    position: int
+    eta: float
+
+
+class Job(NamedTuple):
+    challenge: object
+    user_id: str
+    sequence: int
+
+
+class StartQueue:
+    def __init__(self, executor, options: dict) -> None:
+        self.executor = executor
+        # starts running at once over the whole cluster, and starts waiting
+        # for one of them at most
+        self.workers = options.get("workers", 16)
+        self.max_queued = options.get("max_queued", 1000)
+        # seconds a new start may expect to wait before it is rejected, 0 is
+        # no limit
+        self.max_wait = options.get("max_wait", 0)
+        # starts queued or running per user and per challenge, 0 is no limit
+        self.per_user = options.get("per_user", 0)
+        self.per_challenge = options.get("per_challenge", 0)
+        # starts in progress over every replica sharing the database, 0 is
+        # no limit. The limits above only cover this process.
+        self.max_starting = options.get("max_starting", 0)
+        self.durations = deque(maxlen=LATENCY_SAMPLES)
+        self.users = Counter()
+        self.challenges = Counter()
+        # (challenge name, user_id) -> sequence number of the queued start
+        self.jobs = {}
+        self.submitted = 0
+        self.taken = 0
+        self.loop = None
+        self.queue = None
+        self.tasks = []
+
+    def bind(self):
+        # The workers are started lazily, on the loop that serves requests
+        loop = asyncio.get_running_loop()
+        if self.loop is loop:
+            return
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    def queued(self) -> int:
+        return self.submitted - self.taken
+
+    def running(self) -> int:
+        return len(self.jobs) - self.queued()
+
+    def duration(self) -> float:
+        return percentile(self.durations, 0.5) or DEFAULT_COLD_START
+
+    def eta(self, ahead: int) -> float:
+        # The starts ahead, running or queued, are done `workers` at a time
+        return (ahead // self.workers + 1) * self.duration()
+
+    def ticket(self, challenge, user_id: str) -> Ticket | None:
+        sequence = self.jobs.get((challenge.name, user_id))
+        if sequence is None:
+            return None
+        position = max(0, sequence - self.taken)
+        ahead = 0 if position == 0 else self.running() + position - 1
+        return Ticket(position, round(self.eta(ahead), 1))
+
+    def admit(self, challenge, user_id: str):
+        if self.per_user > 0 and self.users[user_id] >= self.per_user:
+            raise Rejected("too many starts for this user", self.duration())
+        if self.per_challenge > 0 and self.challenges[challenge.name] >= self.per_challenge:
+            raise Rejected("too many starts for this challenge", self.duration())
+        if self.queued() >= self.max_queued:
+            raise Rejected("start queue is full", self.eta(len(self.jobs) - self.max_queued))
+        if self.max_wait > 0 and self.eta(len(self.jobs)) > self.max_wait:
+            raise Rejected("start queue is full", self.eta(len(self.jobs)) - self.max_wait)
+
+    async def admit_cluster(self, challenge):
+        # Checked before the limits of this process, which are checked and
+        # taken without waiting in between
+        placement = self.executor.placement
+        if len(placement.snapshots) > 0 and len(placement.candidates(challenge)) == 0:
+            raise Rejected("no server has room for another instance", placement.interval)
+        if self.max_starting > 0:
+            # Starts of other replicas only show up in the shared database
+            starting = await self.executor.config.database.count(["starting"])
+            if starting + self.queued() >= self.max_starting:
+                raise Rejected("too many starts in the cluster", self.duration())
+
+    async def submit(self, challenge, user_id: str) -> Ticket:
+        # The caller holds the user in the challenge's working set, which is
+        # released once the start is done or rejected
+        self.bind()
+        try:
+            await self.admit_cluster(challenge)
+            self.admit(challenge, user_id)
+        except Rejected as e:
+            ADMISSIONS.inc(e.reason)
+            log.info(f"rejected start of {challenge.name} for {user_id}: {e.reason}")
+            raise
+        ADMISSIONS.inc("admitted")
+        self.submitted += 1
+        self.jobs[(challenge.name, user_id)] = self.submitted
+        self.users[user_id] += 1
+        self.challenges[challenge.name] += 1
+        self.queue.put_nowait(Job(challenge, user_id, self.submitted))
+        return self.ticket(challenge, user_id)
+
+    async def worker(self):
+        while True:
+            job = await self.queue.get()
+            self.taken += 1
+            begin = time.monotonic()
+            try:
+                await job.challenge.start(self.executor, job.user_id)
+                self.durations.append(time.monotonic() - begin)
+            except Exception as e:
+                log.warning(f"Starting {job.challenge.name} for {job.user_id} failed: {e}")
+                await job.challenge.working_set.remove(job.user_id)
+            finally:
+                del self.jobs[(job.challenge.name, job.user_id)]
+                self.users[job.user_id] -= 1
+                if self.users[job.user_id] <= 0:
+                    del self.users[job.user_id]
+                self.challenges[job.challenge.name] -= 1
+                if self.challenges[job.challenge.name] <= 0:
+                    del self.challenges[job.challenge.name]
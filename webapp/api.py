@@ -1,21 +1,41 @@
+import asyncio
+import json
+import math
+
 from typing import Annotated
-from asyncio import create_task
-from fastapi import FastAPI, HTTPException, status, Path, Depends
+from fastapi import FastAPI, HTTPException, status, Path, Query, Depends
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from pydantic import BaseModel, Field
+from webapp.admission import Rejected
 from webapp.database import ChallengeState
+from webapp.service import describe, select
+from webapp import metrics
 from logging import getLogger
 import traceback as tb
 
 log = getLogger(__name__)
 
 app = FastAPI()
+app.add_middleware(metrics.MetricsMiddleware)
 
 security = HTTPBasic()
 
-background_tasks = set()
-
 ALPHANUM = r"^[a-z0-9\-_]*$"
 
+# (user, challenge) pairs a single batch request may name
+MAX_BATCH = 1000
+
+Name = Annotated[str, Field(pattern=ALPHANUM)]
+
+
+class Selection(BaseModel):
+    # (user_id, challenge) pairs, and/or every instance of a user or of a
+    # challenge
+    instances: list[tuple[Name, Name]] = Field(default=[], max_length=MAX_BATCH)
+    user_id: Name | None = None
+    challenge: Name | None = None
+
 
 def does_challenge_exist(app: FastAPI, service_name: str):
     challenges = app.extra["config"].challenges
@@ -39,65 +59,40 @@ def authenticate(credentials: HTTPBasicCredentials = Depends(security)):
     return credentials.username
 
 
+def too_busy(e: Rejected) -> JSONResponse:
+    return JSONResponse(status_code=status.HTTP_429_TOO_MANY_REQUESTS, content={"detail": e.reason},
+                        headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))})
+
+
 @app.get("/start/{user_id}/{service_name}")
 async def start_challenge(
         user_id: Annotated[str, Path(pattern=ALPHANUM)],
         service_name: Annotated[str, Path(pattern=ALPHANUM)],
+        fresh: bool = False,
         username: str = Depends(authenticate),
         ):
     try:
         does_challenge_exist(app, service_name)
-
-        executor = app.extra["executor"]
-        challenge = app.extra["config"].challenges[service_name]
-
-        await challenge.retrieve_state(executor, user_id)
-
-        state = await ChallengeState(app.extra["config"].database, service_name, user_id).get()
-        if state is not None:
-            if state == "running":
-                await challenge.working_set.remove(user_id)
-                return {"running"}
-
-        if await challenge.working_set.contains_or_insert(user_id):
-            task = create_task(challenge.start(executor, user_id))
-            background_tasks.add(task)
-            task.add_done_callback(background_tasks.discard)
-            return {"starting"}
-        else:
-            return {"still working on it"}
+        return await app.extra["service"].start(service_name, user_id, fresh)
+    except Rejected as e:
+        return too_busy(e)
     except HTTPException as e:
-        return {e.detail}
+        return {"state": "failed", "reason": e.detail}
     except Exception as e:
         log.warning(f"Error occured in start API: {tb.format_exc()}")
-        return {"something went wrong"}
+        return {"state": "failed", "reason": "something went wrong"}
 
 
 @app.get("/stop/{user_id}/{service_name}")
 async def stop_challenge(
         user_id: Annotated[str, Path(pattern=ALPHANUM)],
         service_name: Annotated[str, Path(pattern=ALPHANUM)],
+        fresh: bool = False,
         username: str = Depends(authenticate),
         ):
     try:
         does_challenge_exist(app, service_name)
-        executor = app.extra["executor"]
-        challenge = app.extra["config"].challenges[service_name]
-        await challenge.retrieve_state(executor, user_id)
-
-        state = await ChallengeState(app.extra["config"].database, service_name, user_id).get()
-        if state is not None:
-            if state != "running":
-                await challenge.working_set.remove(user_id)
-                return {"not running"}
-
-        if await challenge.working_set.contains_or_insert(user_id):
-            task = create_task(challenge.stop(executor, user_id))
-            background_tasks.add(task)
-            task.add_done_callback(background_tasks.discard)
-            return {"stopping"}
-        else:
-            return {"still working on it"}
+        return await app.extra["service"].stop(service_name, user_id, fresh)
     except HTTPException as e:
         return {e.detail}
     except Exception as e:
@@ -105,39 +100,151 @@ async def stop_challenge(
         return {"something went wrong"}
 
 
+@app.get("/extend/{user_id}/{service_name}")
+async def extend_challenge(
+        user_id: Annotated[str, Path(pattern=ALPHANUM)],
+        service_name: Annotated[str, Path(pattern=ALPHANUM)],
+        username: str = Depends(authenticate),
+        ):
+    try:
+        does_challenge_exist(app, service_name)
+        return await app.extra["service"].extend(service_name, user_id)
+    except HTTPException as e:
+        return {e.detail}
+    except Exception as e:
+        log.warning(f"Error occured in extend API: {tb.format_exc()}")
+        return {"something went wrong"}
+
+
 @app.get("/status/{user_id}/{service_name}")
 async def challenge_status(
         user_id: Annotated[str, Path(pattern=ALPHANUM)],
         service_name: Annotated[str, Path(pattern=ALPHANUM)],
+        fresh: bool = False,
         username: str = Depends(authenticate),
         ):
     try:
         does_challenge_exist(app, service_name)
 
-        executor = app.extra["executor"]
-        challenge = app.extra["config"].challenges[service_name]
-
-        await challenge.retrieve_state(executor, user_id)
-        state = await ChallengeState(app.extra["config"].database, service_name, user_id).get_with_reason()
-        r = {
-            "state": 'not started',
-        }
-        if state is not None:
-            port = await ChallengeState(app.extra["config"].database, service_name, user_id).get_port()
-            server_id = await ChallengeState(app.extra["config"].database, service_name, user_id).get_server()
-            if server_id is not None:
-                server_ip = executor.config.servers[ server_id ].ip
-            else:
-                server_ip = ""
-            state, reason = state
-            r['state'] = state
-            if state == "running":
-                r['url'] = challenge.url.replace("{{PORT}}", str(port)).replace("{{IP}}", server_ip)
-            if state == "failed":
-                r['reason'] = reason
-        return r
+        config = app.extra["config"]
+        service = app.extra["service"]
+        challenge = config.challenges[service_name]
+
+        # The prober keeps the state up to date, only probe on request
+        if fresh:
+            await service.refresh(service_name, user_id)
+        # Answered from the database, the executor only hears about it when
+        # the instance may go idle
+        instance = await ChallengeState(config.database, service_name, user_id).fetch()
+        if instance is not None and instance.idle_at is not None:
+            await service.touch(service_name, user_id)
+        return describe(config, challenge, instance)
     except HTTPException as e:
         return {e.detail}
     except Exception as e:
         log.warning(f"Error occured in status API: {tb.format_exc()}")
         return {"state": "failed", "reason": "something went wrong"}
+
+
+@app.get("/pools")
+async def pool_stats(username: str = Depends(authenticate)):
+    return await app.extra["service"].pools()
+
+
+@app.get("/metrics")
+async def metrics_endpoint(username: str = Depends(authenticate)):
+    return PlainTextResponse(await app.extra["service"].metrics(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.post("/batch/status")
+async def batch_status(selection: Selection, username: str = Depends(authenticate)):
+    try:
+        config = app.extra["config"]
+        return [{"user_id": user_id, "challenge": challenge.name, **describe(config, challenge, instance)}
+                for user_id, challenge, instance in await select(config, selection.instances,
+                                                                 selection.user_id, selection.challenge)]
+    except Exception as e:
+        log.warning(f"Error occured in batch status API: {tb.format_exc()}")
+        return {"something went wrong"}
+
+
+@app.post("/batch/start")
+async def batch_start(selection: Selection, username: str = Depends(authenticate)):
+    # Only explicitly named pairs are started, filters select existing rows
+    if selection.user_id is not None or selection.challenge is not None:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Starts take (user_id, challenge) pairs, not filters"
+        )
+    try:
+        return await app.extra["service"].batch_start(selection.instances)
+    except Exception as e:
+        log.warning(f"Error occured in batch start API: {tb.format_exc()}")
+        return {"something went wrong"}
+
+
+@app.post("/batch/stop")
+async def batch_stop(selection: Selection, username: str = Depends(authenticate)):
+    try:
+        return await app.extra["service"].batch_stop(selection.instances, selection.user_id,
+                                                     selection.challenge)
+    except Exception as e:
+        log.warning(f"Error occured in batch stop API: {tb.format_exc()}")
+        return {"something went wrong"}
+
+
+@app.post("/admin/reload")
+async def reload(username: str = Depends(authenticate)):
+    # Applies edits of config.toml and the challenge repo now instead of at
+    # the next poll. An API worker reloads its own copy of the config too,
+    # the other workers follow at their next poll.
+    watcher = app.extra.get("watcher")
+    if watcher is not None:
+        await watcher.check(force=True)
+    return await app.extra["service"].reload()
+
+
+def format_event(event: dict) -> str | None:
+    if event["type"] == "resync":
+        return "event: resync\ndata: {}\n\n"
+    config = app.extra["config"]
+    challenge = config.challenges.get(event["challenge"])
+    if challenge is None:
+        return None
+    data = {"user_id": event["user_id"], "challenge": challenge.name,
+            **describe(config, challenge, event["instance"])}
+    return f"event: state\ndata: {json.dumps(data)}\n\n"
+
+
+@app.get("/events")
+async def events(
+        user_id: Annotated[str | None, Query(pattern=ALPHANUM)] = None,
+        challenge: Annotated[str | None, Query(pattern=ALPHANUM)] = None,
+        username: str = Depends(authenticate),
+        ):
+    # Server-Sent Events with the state changes of a user's and/or a
+    # challenge's instances, or of every instance without filters
+    bus = app.extra["config"].database.events
+    if bus.full():
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many subscribers"
+        )
+    app.extra["service"].follow(bus)
+
+    async def stream():
+        with bus.subscribe(user_id, challenge) as subscriber:
+            yield ": subscribed\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscriber.next(), bus.keepalive)
+                except TimeoutError:
+                    # Keeps proxies from closing an idle stream
+                    yield ": keepalive\n\n"
+                    continue
+                message = format_event(event)
+                if message is not None:
+                    yield message
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
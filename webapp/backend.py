@@ -0,0 +1,191 @@
+import asyncio
+
+from logging import getLogger
+
+import asyncssh
+
+from webapp.server import Server
+
+log = getLogger(__name__)
+
+
+def runner(server, cmd, timeout=None) -> tuple[Server, str | None]:
+    try:
+        log.info(f"[{server.hostname}]\tRunning command '{cmd}'")
+        result = server.connection.run(cmd, hide=True, timeout=timeout)
+
+        return (server, result.stdout.strip())
+    except Exception as e:
+        log.warning(f"[{server.hostname}]\tFailed to run '{cmd}': {e}")
+
+        return (server, None)
+
+
+def streamer(server, cmd, produce, timeout=None) -> str | None:
+    # Runs cmd with produce(writer) feeding its stdin, without a temp file
+    try:
+        log.info(f"[{server.hostname}]\tStreaming into '{cmd}'")
+        server.connection.open()
+        channel = server.connection.client.get_transport().open_session()
+        try:
+            channel.settimeout(timeout)
+            # Read as one stream, a command that fills the window with
+            # stderr while stdout is read would never finish
+            channel.set_combine_stderr(True)
+            channel.exec_command(cmd)
+            produce(ChannelWriter(channel))
+            channel.shutdown_write()
+
+            output = channel.makefile("rb").read().decode().strip()
+            status = channel.recv_exit_status()
+            if status != 0:
+                raise RuntimeError(f"exit status {status}: {output}")
+            return output
+        finally:
+            channel.close()
+    except Exception as e:
+        log.warning(f"[{server.hostname}]\tFailed to stream into '{cmd}': {e}")
+
+        return None
+
+
+class ChannelWriter:
+    def __init__(self, channel) -> None:
+        self.channel = channel
+
+    def write(self, data: bytes) -> int:
+        self.channel.sendall(data)
+        return len(data)
+
+
+class ProcessWriter:
+    # Lets a producer thread write to the stdin of an asyncssh process,
+    # waiting for the channel to drain so memory use stays bounded
+    def __init__(self, stdin, loop) -> None:
+        self.stdin = stdin
+        self.loop = loop
+
+    async def send(self, data: bytes):
+        self.stdin.write(data)
+        await self.stdin.drain()
+
+    def write(self, data: bytes) -> int:
+        asyncio.run_coroutine_threadsafe(self.send(data), self.loop).result()
+        return len(data)
+
+
+class FabricBackend:
+    # Blocking Fabric/Paramiko calls, each one occupying a thread of the
+    # default executor while it runs
+    async def run(self, server, cmd, timeout=None) -> str | None:
+        _, result = await asyncio.to_thread(runner, server, cmd, timeout)
+        return result
+
+    async def stream(self, server, cmd, produce, timeout=None) -> str | None:
+        return await asyncio.to_thread(streamer, server, cmd, produce, timeout)
+
+    async def close(self):
+        pass
+
+
+class AsyncSSHBackend:
+    # One persistent connection per server, every command runs on its own
+    # channel of that connection
+    def __init__(self, keyfile: str, keepalive_interval: float = 15,
+                 keepalive_count_max: int = 3, channels: int = 10,
+                 known_hosts: str | None = None) -> None:
+        self.keyfile = keyfile
+        # Host keys are checked against this file, ~/.ssh/known_hosts when
+        # unset, unless a server turns the check off
+        self.known_hosts = () if known_hosts is None else known_hosts
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count_max = keepalive_count_max
+        # sshd refuses more than MaxSessions (10 by default) open channels
+        self.channels = channels
+        self.connections = {}
+        self.locks = {}
+        self.semaphores = {}
+
+    async def connect(self, server) -> asyncssh.SSHClientConnection:
+        lock = self.locks.setdefault(server.hostname, asyncio.Lock())
+        async with lock:
+            connection = self.connections.get(server.hostname)
+            if connection is not None and not connection.is_closed():
+                return connection
+
+            log.info(f"[{server.hostname}]\tConnecting to {server.user}@{server.ip}:{server.port}")
+            connection = await asyncssh.connect(
+                server.ip,
+                port=int(server.port),
+                username=server.user,
+                client_keys=[self.keyfile],
+                known_hosts=self.known_hosts if server.host_key_check else None,
+                keepalive_interval=self.keepalive_interval,
+                keepalive_count_max=self.keepalive_count_max,
+            )
+            self.connections[server.hostname] = connection
+            return connection
+
+    def disconnect(self, server, connection):
+        # Only forget the connection if nobody replaced it in the meantime
+        if self.connections.get(server.hostname) is connection:
+            del self.connections[server.hostname]
+        if connection is not None:
+            connection.close()
+
+    async def run(self, server, cmd, timeout=None) -> str | None:
+        semaphore = self.semaphores.setdefault(server.hostname,
+                                               asyncio.Semaphore(self.channels))
+        log.info(f"[{server.hostname}]\tRunning command '{cmd}'")
+        async with semaphore:
+            # A dropped connection is reconnected once before giving up
+            for attempt in range(2):
+                connection = None
+                try:
+                    connection = await self.connect(server)
+                    result = await connection.run(cmd, check=True, timeout=timeout)
+                    return result.stdout.strip()
+                except (asyncio.TimeoutError, asyncssh.ProcessError) as e:
+                    log.warning(f"[{server.hostname}]\tFailed to run '{cmd}': {e}")
+                    return None
+                except (OSError, asyncssh.ChannelOpenError, asyncssh.ConnectionLost,
+                        asyncssh.DisconnectError) as e:
+                    self.disconnect(server, connection)
+                    if attempt > 0:
+                        log.warning(f"[{server.hostname}]\tFailed to run '{cmd}': {e}")
+                except Exception as e:
+                    log.warning(f"[{server.hostname}]\tFailed to run '{cmd}': {e}")
+                    return None
+        return None
+
+    async def stream(self, server, cmd, produce, timeout=None) -> str | None:
+        semaphore = self.semaphores.setdefault(server.hostname,
+                                               asyncio.Semaphore(self.channels))
+        log.info(f"[{server.hostname}]\tStreaming into '{cmd}'")
+        async with semaphore:
+            try:
+                connection = await self.connect(server)
+                async with connection.create_process(cmd, encoding=None) as process:
+                    writer = ProcessWriter(process.stdin, asyncio.get_running_loop())
+                    await asyncio.to_thread(produce, writer)
+                    process.stdin.write_eof()
+                    result = await process.wait(check=True, timeout=timeout)
+                    return result.stdout.decode().strip()
+            except Exception as e:
+                log.warning(f"[{server.hostname}]\tFailed to stream into '{cmd}': {e}")
+                return None
+
+    async def close(self):
+        for connection in self.connections.values():
+            connection.close()
+        self.connections.clear()
+
+
+def make_backend(config):
+    if config.ssh.get("backend", "fabric") == "asyncssh":
+        return AsyncSSHBackend(config.keyfile,
+                               config.ssh.get("keepalive_interval", 15),
+                               config.ssh.get("keepalive_count_max", 3),
+                               config.ssh.get("channels", 10),
+                               config.ssh.get("known_hosts"))
+    return FabricBackend()
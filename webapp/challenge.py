@@ -2,24 +2,29 @@ import asyncio
 import json
 import os
 import sys
+import time
 import pathlib
 
 from shlex import quote
 from yaml import safe_load
 from logging import getLogger
 
-from webapp.database import ChallengeState
+from webapp.database import ChallengeState, Instance
+from webapp.metrics import RETRIEVES, START_PHASES, STARTS, STOP_PHASES, STOPS
 from webapp.port import Port
+from webapp.pool import POOL_PREFIX
 
 log = getLogger(__name__)
 
-
 class Challenge:
     def __init__(self, name: str, path, flag) -> None:
         self.name = name
         self.path = path
         self.flag = flag
         self.url = None
+        # Gone from the challenge repo, it is kept around for the instances
+        # still running but can't be started anymore
+        self.removed = False
 
         class WorkingSet:
             def __init__(self) -> None:
@@ -42,65 +47,115 @@ class Challenge:
                 async with self.lock:
                     self.challenges.discard(user_id)
 
+            async def members(self) -> set[str]:
+                return set(self.challenges)
+
         self.working_set = WorkingSet()
+
+    def update(self, other) -> bool:
+        # Takes over what was parsed again from the challenge repo, the
+        # working set stays
+        changed = (self.path, self.flag, self.url, self.removed) != (other.path, other.flag, other.url, False)
+        self.path = other.path
+        self.flag = other.flag
+        self.url = other.url
+        self.removed = False
+        return changed
     
-    async def parse_test_output(self, result, db_entry):
+    async def parse_test_output(self, result, db_entry, downgrade: bool = True):
+        # Without downgrade a failed test leaves the state alone, e.g. for an
+        # instance that may still be coming up
         try:
             data = json.loads(result)
         except ValueError as e:
             log.warning(f"  + pre-execution test yielded invalid JSON! results: {result}")
-            await db_entry.set("failed", f"pre-flight test failed to run!")
+            if downgrade:
+                await db_entry.transition("failed", f"pre-flight test failed to run!",
+                                          checked_at=time.time())
+            return
 
         
         if(len(list(filter(lambda x: x != "", data.values()))) > 0):
             log.info(f"  + challenge down!")
-            await db_entry.set("stopped")
+            if downgrade:
+                await db_entry.transition("stopped", checked_at=time.time())
         else:
             log.info("  + check OK! challenge up!")
-            await db_entry.set("running")
+            await db_entry.transition("running", checked_at=time.time())
+
+    async def probe(self, executor, server, port: int) -> str | None:
+        hostname = "0.0.0.0"
+
+        python_path = await executor.python_path(server)
+
+        challenge_path = pathlib.Path(server.path) / self.path
+        probe_script_path = challenge_path / "Tests/main.py"
+        cmd = f"{python_path} {probe_script_path} "
+        cmd += f"--connection-string \"127.0.0.1 {port}\" --flag={self.flag} "
+        cmd += f"--handout-path {challenge_path / "Handout"} "
+        cmd += f"--deployment-path {challenge_path / "Source"} "
 
+        # result = await executor.run(server, cmd, timeout=1, lane="probe")
+        result = '{"test": ""}'
+
+        # perhaps a better way to do this than checking the string?
+        return result
 
     async def retrieve_state(self, executor, user_id: str):
         log.info(f"checking state of challenge! {self.name} {user_id}")
         state = ChallengeState(executor.config.database, self.name, user_id)
-        if await state.get() is None:
+        instance = await state.fetch()
+        if instance is None:
             await state.create_challenge()
+        port = None if instance is None else instance.port
 
         async def retrieve(server):
 
-            port = await state.get_port()
             if (port is None):
                 return None
-            
-            hostname = "0.0.0.0"
-
-            log.info("looking for python")
-            python_path = await executor.run(server, "which python3", timeout=1)
-            if(len(python_path) <= 0):
-                log.critical(f"python3 is not available on {server}!")
-
-            challenge_path = pathlib.Path(server.path) / self.path
-            probe_script_path = challenge_path / "Tests/main.py"
-            cmd = f"{python_path} {probe_script_path} "
-            cmd += f"--connection-string \"127.0.0.1 {port}\" --flag={self.flag} "
-            cmd += f"--handout-path {challenge_path / "Handout"} "
-            cmd += f"--deployment-path {challenge_path / "Source"} "
-
-            # result = await executor.run(server, cmd, timeout=1)
-            result = '{"test": ""}'
-
-            # perhaps a better way to do this than checking the string?
-            return result
-           
+
+            return await self.probe(executor, server, port)
+
+        if port is None:
+            log.info(f"  + no port allocated, challenge not started!")
+            await state.set("stopped", "challenge not found on a server")
+            return
+
+        servers = executor.config.servers
+        if instance.server is not None and instance.server < len(servers):
+            # Only ask the server the instance was placed on
+            RETRIEVES.inc("direct")
+            result = await retrieve(servers[instance.server])
+            if result is not None and len(result) > 0:
+                await self.parse_test_output(result, state)
+                return
+            log.info(f"  + not found on {servers[instance.server].hostname}, looking on all servers")
+
+        # The last inventory knows where the compose project is, only sweep
+        # every server when it doesn't
+        project = user_id if instance.project is None else instance.project
+        located = executor.reconciler.inventory.locate(self.name, project)
+        if len(located) > 0:
+            RETRIEVES.inc("inventory")
+        else:
+            RETRIEVES.inc("fallback")
+            log.info(f"  + discovery sweep, {RETRIEVES.get("fallback"):.0f} sweeps " +
+                     f"for {RETRIEVES.get("direct"):.0f} direct probes so far")
+
+        async def retrieve_located(server):
+            if len(located) > 0 and server.hostname not in located:
+                return None
+            return await retrieve(server)
+
         results = await asyncio.gather(
-            *[retrieve(server) for server in executor.config.servers]
+            *[retrieve_located(server) for server in servers]
         )
 
         log.info(f"  + results are {results}")
 
         idx = None
         
-        for i in range(len(executor.config.servers)):
+        for i in range(len(servers)):
             if (results[i] is not None and len(results[i]) > 0):
                 idx = i
                 break
@@ -110,93 +165,188 @@ class Challenge:
             await state.set("stopped", "challenge not found on a server")
             return
         else:
+            if instance.server != idx:
+                await state.set_server(idx)
             await self.parse_test_output(results[idx], state)
 
     async def start(self, executor, user_id: str):
         log.info(f"starting challenge! {self.name} {user_id}")
+        begin = time.monotonic()
 
         db = executor.config.database
         state = ChallengeState(db, self.name, user_id)
 
-        s = await state.get()
+        previous = await state.fetch()
+        s = None if previous is None else previous.state
         if s is not None:
-            if s == "failed":
-                # Reschedule starting the challenge if it failed before
-                await state.set("scheduled")
-            elif s == "running":
+            if s == "running":
                 # The challenge is already running, so stop trying to start it
+                STARTS.inc(self.name, "running")
                 await self.working_set.remove(user_id)
                 return
-            else:
-                # The challenge is in another state, so it is marked as starting
-                # but it is not in the starting_challenges set. Let's retry
-                # starting
-                pass
-        else:
-            await state.create_challenge()
+            # A failed challenge is rescheduled, any other state is marked as
+            # starting but it is not in the starting_challenges set. Either
+            # way, let's retry starting
 
         log.info("  + setting state")
-        await state.set("starting")
-        target_server = await executor.get_available_server()
+        # Pool instances only start to age once they are claimed
+        deadlines = {} if user_id.startswith(POOL_PREFIX) else executor.lifetime.deadlines(self)
+        with START_PHASES.time("state"):
+            await state.transition("starting", create=s is None, **deadlines)
+        with START_PHASES.time("placement"):
+            target_server = await executor.get_available_server(self)
 
         log.info(f"  + chose server: {target_server}")
         if target_server is None:
             # this is never reached on fail, Why?
+            STARTS.inc(self.name, "no server")
             await state.set("failed", "no server available")
             await self.working_set.remove(user_id)
             return
-        
-        await state.set_server(executor.config.servers.index(target_server))
 
         # I love pathlib
         run_script_path : pathlib.Path = pathlib.Path(target_server.path) / self.path / "Source/run.sh"
         execution_path = run_script_path.parent
         
+        servers = executor.config.servers
+        if previous is not None and previous.port is not None and \
+                previous.server is not None and previous.server < len(servers):
+            # Retrying replaces the earlier attempt (same compose project)
+            await executor.cluster.free_port(servers[previous.server], previous.port)
+
         log.info("  + allocating port")
-        port = target_server.alloc_port()
-        await state.set_port(port)
+        with START_PHASES.time("port"):
+            port = await executor.cluster.alloc_port(target_server)
+            if port is not None:
+                await state.transition(server=executor.config.servers.index(target_server),
+                                       port=port, project=user_id)
+        if port is None:
+            executor.placement.release(target_server)
+            STARTS.inc(self.name, "no port")
+            await state.set("failed", "no ports available")
+            await self.working_set.remove(user_id)
+            return
 
         hostname = "0.0.0.0"
 
-        cmd = f"cd {execution_path} && COMPOSE_PROJECT_NAME={user_id} bash {run_script_path} --flag '{self.flag}' --hostname {hostname} --port {port}"
-        result = await executor.run(target_server, cmd, timeout=100000)
+        # Started from the release the symlink points at, the compose project
+        # then tells which release it uses and that one is not pruned
+        cmd = f"cd \"$(readlink -f {execution_path})\" && COMPOSE_PROJECT_NAME={user_id} bash ./{run_script_path.name} --flag '{self.flag}' --hostname {hostname} --port {port}"
+        try:
+            with START_PHASES.time("run"):
+                result = await executor.run(target_server, cmd, timeout=100000)
+        finally:
+            executor.placement.release(target_server)
         log.info(f"  + command resulted: {result}")
 
         if result is None:
+            STARTS.inc(self.name, "failed")
             await state.set("failed", "starting run.sh failed")
             await self.working_set.remove(user_id)
+            return
+        # Probed once right away instead of waiting for the prober's next
+        # round. An instance that isn't up yet stays starting for the prober.
+        try:
+            with START_PHASES.time("probe"):
+                result = await self.probe(executor, target_server, port)
+            if result is not None and len(result) > 0:
+                await self.parse_test_output(result, state, downgrade=False)
+        except Exception as e:
+            log.warning(f"  + probing after the start failed: {e}")
+        STARTS.inc(self.name, "started")
+        START_PHASES.observe(time.monotonic() - begin, "total")
+        executor.pools.record_cold_start(self, time.monotonic() - begin)
+        # Done starting, the prober takes it from here and stopping is allowed
+        await self.working_set.remove(user_id)
         
 
+    def destroy_command(self, server, project: str) -> str:
+        destroy_script_path : pathlib.Path = pathlib.Path(server.path) / self.path / f"Source/destroy.sh --team {project}"
+        execution_path = destroy_script_path.parent
+        return f"cd {execution_path} && bash {destroy_script_path}"
+
     async def stop(self, executor, user_id: str):
         log.info(f"Stopping challenge!  {self.name} {user_id}")
+        begin = time.monotonic()
         state = ChallengeState(executor.config.database, self.name, user_id)
         
-        target_server = executor.config.servers[ await state.get_server() ]
+        server_idx = await state.get_server()
         
-        if target_server is None:
+        if server_idx is None or server_idx >= len(executor.config.servers):
+            # Never got placed on a server, there is nothing to tear down
+            await state.delete()
             await self.working_set.remove(user_id)
             log.warning("server not found, cannot stop")
             return
+        target_server = executor.config.servers[server_idx]
 
-        port = await state.get_port()
+        instance = await state.fetch()
+        # Instances claimed from a pool keep running as the pool's project
+        project = user_id if instance is None or instance.project is None else instance.project
 
-        destroy_script_path : pathlib.Path = pathlib.Path(target_server.path) / self.path / f"Source/destroy.sh --team {user_id}"
-        execution_path = destroy_script_path.parent
-        cmd = f"cd {execution_path} && bash {destroy_script_path}"
-        log.info(f"  + destroy script: {destroy_script_path}")
-        log.info(f"  + execution location: {execution_path}")
+        cmd = self.destroy_command(target_server, project)
+        log.info(f"  + destroy command: {cmd}")
 
-        res = await executor.run(target_server, cmd)
+        with STOP_PHASES.time("destroy"):
+            res = await executor.run(target_server, cmd)
         log.info(f"  + result: {res}")
         
-        await state.delete()
+        with STOP_PHASES.time("state"):
+            await state.delete()
+        if instance is not None and instance.port is not None:
+            await executor.cluster.free_port(target_server, instance.port)
         await self.working_set.remove(user_id)
+        STOPS.inc(self.name)
+        STOP_PHASES.observe(time.monotonic() - begin, "total")
         log.info(f"  + updated local state")
 
 
+async def stop_many(executor, targets: list[tuple[Challenge, str, Instance]]):
+    # Stops every instance with a single command per server, e.g. all of a
+    # user's instances at logout
+    begin = time.monotonic()
+    servers = executor.config.servers
+    per_server = {}
+    for challenge, user_id, instance in targets:
+        if instance.server is not None and instance.server < len(servers):
+            per_server.setdefault(instance.server, []).append((challenge, user_id, instance))
+
+    async def stop_on(server, group):
+        steps = []
+        for i, (challenge, user_id, instance) in enumerate(group):
+            project = user_id if instance.project is None else instance.project
+            steps.append(f"( {challenge.destroy_command(server, project)} ) >/dev/null 2>&1 " +
+                         f"&& echo stopped:{i} || echo failed:{i}")
+        log.info(f"[{server.hostname}]\tstopping {len(group)} instances")
+        out = await executor.run(server, " ; ".join(steps))
+        if out is None:
+            log.warning(f"[{server.hostname}]\tstopping {len(group)} instances failed")
+            return
+        stopped = {int(line[len("stopped:"):]) for line in out.splitlines()
+                   if line.startswith("stopped:")}
+        for i, (challenge, user_id, instance) in enumerate(group):
+            if i not in stopped:
+                # The port stays taken, the instance may still be using it
+                log.warning(f"[{server.hostname}]\tdestroy.sh of {challenge.name} {user_id} failed")
+            elif instance.port is not None:
+                await executor.cluster.free_port(server, instance.port)
+
+    await asyncio.gather(*[stop_on(servers[idx], group) for idx, group in per_server.items()])
+
+    # Like stop(), the rows go even when destroy.sh failed
+    await executor.config.database.delete_many([(challenge.name, user_id)
+                                                for challenge, user_id, _ in targets])
+    for challenge, user_id, _ in targets:
+        await challenge.working_set.remove(user_id)
+        STOPS.inc(challenge.name)
+    STOP_PHASES.observe(time.monotonic() - begin, "batch")
+
+
 def parse_challenges(path: str) -> dict[str, Challenge]:
-    
-    sys.path.append(path)
+    # The checker of the challenge repo is only imported when there is no
+    # up to date index, see webapp/index.py
+    if path not in sys.path:
+        sys.path.append(path)
     import checker
 
     set = checker.ChallengeSet(path)
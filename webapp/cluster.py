@@ -0,0 +1,199 @@
+import asyncio
+import os
+import secrets
+import socket
+import time
+
+from logging import getLogger
+
+from webapp.metrics import LOOP_FAILURES
+
+log = getLogger(__name__)
+
+LEADER_LEASE = "leader"
+WORKING_PREFIX = "working/"
+
+
+class LeasedWorkingSet:
+    # Challenge.WorkingSet shared by every replica: a user is being started
+    # or stopped while some replica holds the lease on it
+    def __init__(self, cluster, challenge_name: str) -> None:
+        self.cluster = cluster
+        self.prefix = f"{WORKING_PREFIX}{challenge_name}/"
+        # the users this replica holds the lease of
+        self.challenges = set()
+
+    async def add(self, user_id):
+        self.challenges.add(user_id)
+        await self.cluster.acquire(self.prefix + user_id, self.cluster.working_ttl)
+
+    async def contains_or_insert(self, user_id):
+        if user_id in self.challenges:
+            return False
+        # Taken locally first, so two requests on this replica don't both
+        # get the lease they already hold
+        self.challenges.add(user_id)
+        if await self.cluster.acquire(self.prefix + user_id, self.cluster.working_ttl):
+            return True
+        self.challenges.discard(user_id)
+        return False
+
+    async def remove(self, user_id):
+        if user_id in self.challenges:
+            self.challenges.discard(user_id)
+            await self.cluster.release(self.prefix + user_id)
+
+    async def members(self) -> set[str]:
+        return {name[len(self.prefix):] for name in await self.cluster.database.leases(self.prefix)}
+
+
+class Cluster:
+    def __init__(self, executor, options: dict) -> None:
+        self.executor = executor
+        self.database = executor.config.database
+        # Several replicas share the database, the leases and port
+        # reservations in it keep them from stepping on each other
+        self.enabled = options.get("enabled", False)
+        self.id = options.get("id") or f"{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(3)}"
+        # seconds the leader lease lasts, it is renewed every third of that
+        self.lease = options.get("lease", 30)
+        # seconds a start or stop may take before another replica may retry it
+        self.working_ttl = options.get("working_ttl", 900)
+        self.leader = not self.enabled
+        self.elected = asyncio.Event()
+        self.deposed = asyncio.Event()
+        # hostname -> ports reserved in the database when last loaded
+        self.reserved = {}
+
+        for challenge in executor.config.challenges.values():
+            self.track(challenge)
+
+    def track(self, challenge):
+        # Starts and stops of the challenge are leased in the database
+        if self.enabled:
+            challenge.working_set = LeasedWorkingSet(self, challenge.name)
+
+    async def acquire(self, name: str, ttl: float) -> bool:
+        return await self.database.acquire(name, self.id, ttl)
+
+    async def release(self, name: str):
+        await self.database.release(name, self.id)
+
+    async def elect(self):
+        if not self.enabled:
+            self.elected.set()
+            return
+        try:
+            leader = await self.acquire(LEADER_LEASE, self.lease)
+        except Exception as e:
+            # Without the database nobody can tell who leads, so step down
+            log.warning(f"Renewing the leader lease failed: {e}")
+            leader = False
+        if leader != self.leader:
+            log.info(f"{self.id} {'is now' if leader else 'is no longer'} the leader")
+        self.leader = leader
+        if leader:
+            self.deposed.clear()
+            self.elected.set()
+        else:
+            self.elected.clear()
+            self.deposed.set()
+
+    async def run(self):
+        if not self.enabled:
+            return
+        while True:
+            await self.elect()
+            if self.leader:
+                try:
+                    await self.collect_ports()
+                except Exception as e:
+                    LOOP_FAILURES.inc("cluster")
+                    log.warning(f"Something went wrong while collecting port reservations: {e}")
+            await asyncio.sleep(self.lease / 3)
+
+    async def leading(self, run):
+        # Runs the background loop `run` only while this replica leads
+        if not self.enabled:
+            await run()
+            return
+        while True:
+            await self.elected.wait()
+            task = asyncio.create_task(run())
+            await self.deposed.wait()
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+    async def alloc_port(self, server) -> int | None:
+        if not self.enabled:
+            return server.alloc_port()
+        for _ in range(2):
+            port = server.alloc_port()
+            while port is not None:
+                if await self.database.reserve_port(server.hostname, port):
+                    return port
+                # Another replica has it, the bitmap now marks it as taken
+                # until that replica releases it
+                self.reserved.setdefault(server.hostname, set()).add(port)
+                port = server.alloc_port()
+            # The bitmap doesn't see ports other replicas freed, reload it
+            await self.load_ports(server)
+        return None
+
+    async def free_port(self, server, port: int):
+        server.free_port(port)
+        if self.enabled:
+            await self.database.release_ports([(server.hostname, port)])
+
+    async def move_port(self, source, target, port: int):
+        # An instance turned up on another server than recorded
+        if port in source.ports:
+            await self.free_port(source, port)
+        target.ports.reserve(port)
+        if self.enabled:
+            await self.database.reserve_ports([(target.hostname, port)])
+
+    async def load_ports(self, server):
+        # Merged into the bitmap, which also holds the ports other services
+        # listen on. Only ports released since the last load are freed.
+        reserved = {port for hostname, port, _ in await self.database.reserved_ports()
+                    if hostname == server.hostname}
+        for port in self.reserved.get(server.hostname, set()) - reserved:
+            if port in server.ports:
+                server.ports.free(port)
+        for port in reserved:
+            server.ports.reserve(port)
+        self.reserved[server.hostname] = reserved
+
+    async def reserve_ports(self):
+        # Ports of existing instances are reserved for every replica, and
+        # the bitmaps start out with everything reserved by any replica
+        if not self.enabled:
+            return
+        servers = self.executor.config.servers
+        await self.database.reserve_ports([(servers[idx].hostname, port)
+                                           for idx, port in await self.database.ports()
+                                           if idx < len(servers)])
+        reserved = await self.database.reserved_ports()
+        for server in servers:
+            self.reserved[server.hostname] = set()
+            for hostname, port, _ in reserved:
+                if hostname == server.hostname:
+                    server.ports.reserve(port)
+                    self.reserved[server.hostname].add(port)
+
+    async def collect_ports(self):
+        # Reservations of starts that never recorded their instance, e.g.
+        # because the replica died in between
+        servers = self.executor.config.servers
+        used = {(servers[idx].hostname, port) for idx, port in await self.database.ports()
+                if idx < len(servers)}
+        cutoff = time.time() - self.working_ttl
+        stale = [(hostname, port) for hostname, port, reserved_at in await self.database.reserved_ports()
+                 if reserved_at < cutoff and (hostname, port) not in used]
+        if len(stale) > 0:
+            log.info(f"releasing {len(stale)} stale port reservations")
+            await self.database.release_ports(stale)
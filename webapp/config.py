@@ -1,10 +1,9 @@
 import tomllib
 
-from webapp.challenge import parse_challenges
-from webapp.server import parse_servers
+from webapp.index import load_challenges
+from webapp.server import Server, parse_servers
 from webapp.database import Database
-
-from multiprocessing import Pool
+from webapp.events import EventBus
 
 from logging import getLogger
 
@@ -34,8 +33,8 @@ class Config:
             return False
         return True
 
-    def __init__(self, config_path: str) -> None:
-        self.pool = Pool()
+    def __init__(self, config_path: str, api_worker: bool = False) -> None:
+        self.path = config_path
 
         with open(config_path, "rb") as config:
             data = tomllib.load(config)
@@ -43,17 +42,84 @@ class Config:
             self.api = data["api"]
 
             self.challenge_path = data["docker"]["challenge_path"]
-            self.challenges = parse_challenges(self.challenge_path)
-
-            self.keyfile = data["ssh"]["keyfile"]
+            self.challenge_index = data["docker"].get("index", "challenges.json")
+            self.challenges = load_challenges(self.challenge_path, self.challenge_index or None)
+
+            self.ssh = data["ssh"]
+            self.keyfile = self.ssh["keyfile"]
+
+            self.prober = data.get("prober", {})
+            self.sync = data.get("sync", {})
+            self.placement = data.get("placement", {})
+            self.pools = data.get("pools", {})
+            self.warmup = data.get("warmup", {})
+            self.lifetime = data.get("lifetime", {})
+            self.reconcile = data.get("reconcile", {})
+            self.admission = data.get("admission", {})
+            self.cluster = data.get("cluster", {})
+            self.reload = data.get("reload", {})
 
             self.servers = parse_servers(data["servers"])
 
-            self.database = Database(data["database"]["path"])
-
+            database = data["database"]
+            # Other replicas, or the executor service of an API worker, write
+            # to the database behind the cache's back
+            shared = api_worker or self.cluster.get("enabled", False)
+            cache_size = 0 if shared else database.get("cache_size", 10000)
+            self.database = Database(database["path"],
+                                     database.get("pool_size", 4),
+                                     database.get("commit_interval", 0.005),
+                                     cache_size,
+                                     database.get("cache_idle", 3600))
+            self.database.events = EventBus(**data.get("events", {}))
+
+            # Nothing is connected yet, every server connects on first use
             for server in self.servers:
                 server.connect(self.keyfile)
         log.debug(f"Config has been read from {config_path}!")
 
         assert(self.validate_config())
+
+    def load(self) -> tuple[list[Server], dict]:
+        # Reads the servers and challenges again without touching the ones in
+        # use, blocking, see apply()
+        with open(self.path, "rb") as config:
+            data = tomllib.load(config)
+        return (parse_servers(data["servers"]),
+                load_challenges(self.challenge_path, self.challenge_index or None))
+
+    def apply(self, servers: list[Server], challenges: dict) -> dict:
+        # Updates self.servers and self.challenges in place, so everyone
+        # holding on to them sees the change. Nothing is ever taken out:
+        # instances refer to their server by index, and both removed servers
+        # and removed challenges may still have instances running.
+        changes = {kind: {"added": [], "changed": [], "removed": []}
+                   for kind in ("servers", "challenges")}
+
+        known = {server.hostname: server for server in self.servers}
+        for server in servers:
+            current = known.pop(server.hostname, None)
+            if current is None:
+                server.connect(self.keyfile)
+                self.servers.append(server)
+                changes["servers"]["added"].append(server.hostname)
+            elif len(current.update(server)) > 0:
+                changes["servers"]["changed"].append(server.hostname)
+        for server in known.values():
+            if not server.draining:
+                server.draining = True
+                changes["servers"]["removed"].append(server.hostname)
+
+        for name, challenge in challenges.items():
+            current = self.challenges.get(name)
+            if current is None:
+                self.challenges[name] = challenge
+                changes["challenges"]["added"].append(name)
+            elif current.update(challenge):
+                changes["challenges"]["changed"].append(name)
+        for name, challenge in self.challenges.items():
+            if name not in challenges and not challenge.removed:
+                challenge.removed = True
+                changes["challenges"]["removed"].append(name)
+        return changes
             
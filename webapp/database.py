@@ -1,12 +1,200 @@
-from asyncio import run
+import asyncio
+import sqlite3
+
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from time import monotonic, perf_counter, time
+from typing import NamedTuple
 from aiosqlite import connect
 
+from webapp.events import EventBus
+from webapp.metrics import CACHE_LOOKUPS, DB_COMMIT_BATCH, DB_QUERIES
+
+# Statements are kept as constants so every pooled connection hits its own
+# sqlite3 statement cache instead of re-preparing them for every query.
+INSTANCE_COLUMNS = "state, reason, port, server, checked_at, project, expires_at, idle_at"
+SELECT_INSTANCE = f"SELECT {INSTANCE_COLUMNS} \
+    FROM challenges WHERE name=? AND user_id=? LIMIT 1"
+SELECT_INSTANCES = f"SELECT name, user_id, {INSTANCE_COLUMNS} \
+    FROM challenges LIMIT ?"
+INSERT_INSTANCE = "INSERT INTO challenges \
+    (name, user_id, state, reason) \
+    VALUES (?, ?, ?, ?) ON CONFLICT (name, user_id) DO NOTHING"
+DELETE_INSTANCE = "DELETE FROM challenges WHERE name=? AND user_id=?"
+CLAIM_INSTANCE = "UPDATE challenges SET user_id=?, project=COALESCE(project, ?) \
+    WHERE name=? AND user_id=?"
+
+# Leases shared by replicas in cluster mode, see webapp/cluster.py. A lease
+# is taken over when it expired, or renewed when the holder asks again.
+ACQUIRE_LEASE = "INSERT INTO locks (name, holder, expires_at) VALUES (?, ?, ?) \
+    ON CONFLICT (name) DO UPDATE SET holder=excluded.holder, expires_at=excluded.expires_at \
+    WHERE locks.holder=excluded.holder OR locks.expires_at < ?"
+SELECT_LEASE = "SELECT holder FROM locks WHERE name=? AND expires_at >= ?"
+RELEASE_LEASE = "DELETE FROM locks WHERE name=? AND holder=?"
+RESERVE_PORT = "INSERT INTO ports (server, port, reserved_at) VALUES (?, ?, ?)"
+RESERVE_PORT_IF_FREE = "INSERT OR IGNORE INTO ports (server, port, reserved_at) VALUES (?, ?, ?)"
+RELEASE_PORT = "DELETE FROM ports WHERE server=? AND port=?"
+
+# Columns besides state/reason that ChallengeState.transition may update.
+TRANSITION_COLUMNS = ("server", "port", "checked_at", "project", "expires_at", "idle_at")
+
+# Columns added after the challenges table was first released, created on
+# existing databases by Database.setup()
+MIGRATIONS = [
+    ("checked_at", "REAL"),
+    ("project", "TEXT"),
+    ("expires_at", "REAL"),
+    ("idle_at", "REAL"),
+]
+
+
+def update_statement(name: str, user_id: str, updates: dict) -> tuple[str, tuple]:
+    for column in updates:
+        if column not in ("state", "reason") + TRANSITION_COLUMNS:
+            raise ValueError(f"cannot transition unknown column '{column}'")
+    assignments = ", ".join(f"{column}=?" for column in updates)
+    return (f"UPDATE challenges SET {assignments} WHERE name=? AND user_id=?",
+            (*updates.values(), name, user_id))
+
+
+class Instance(NamedTuple):
+    state: str
+    reason: str
+    port: int | None
+    server: int | None
+    # when the prober last checked the instance (unix time)
+    checked_at: float | None = None
+    # compose project the instance runs as, the user_id when unset
+    project: str | None = None
+    # unix times after which the reaper stops the instance, None for never
+    expires_at: float | None = None
+    idle_at: float | None = None
+
+
+class StateCache:
+    def __init__(self, max_entries: int, idle_timeout: float) -> None:
+        self.max_entries = max_entries
+        self.idle_timeout = idle_timeout
+        # (name, user_id) -> (Instance, last access), least recently used
+        # first. None for a user without a row, the most common /status.
+        self.entries = OrderedDict()
+        # Keys written while a database read was in flight, see fill()
+        self.sequence = 0
+        self.written = {}
+        self.readers = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key) -> Instance | None:
+        return self.lookup(key)[1]
+
+    def lookup(self, key) -> tuple[bool, Instance | None]:
+        # Whether the key is cached, and its instance
+        entry = self.entries.get(key)
+        if entry is None:
+            return False, None
+        self.entries[key] = (entry[0], monotonic())
+        self.entries.move_to_end(key)
+        return True, entry[0]
+
+    def put(self, key, instance: Instance | None):
+        now = monotonic()
+        self.entries[key] = (instance, now)
+        self.entries.move_to_end(key)
+        self.evict(now)
+
+    def evict(self, now: float):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        while len(self.entries) > 0:
+            _, (_, last_access) = next(iter(self.entries.items()))
+            if now - last_access < self.idle_timeout:
+                break
+            self.entries.popitem(last=False)
+
+    def begin_read(self) -> int:
+        self.readers += 1
+        return self.sequence
+
+    def fill(self, key, instance: Instance | None, sequence: int):
+        # A row read from the database, or its absence, is only cached when
+        # nothing wrote to that key since the read started, otherwise it may
+        # already be stale.
+        if self.written.get(key, 0) <= sequence:
+            self.put(key, instance)
+        self.end_read()
+
+    def end_read(self):
+        self.readers -= 1
+        if self.readers == 0:
+            self.written.clear()
+
+    def mark_written(self, key):
+        self.sequence += 1
+        if self.readers > 0:
+            self.written[key] = self.sequence
+
+    def peek(self, key) -> Instance | None:
+        entry = self.entries.get(key)
+        return None if entry is None else entry[0]
+
+    def update(self, key, updates: dict):
+        self.mark_written(key)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] is None:
+            # The row was created, it is read again
+            del self.entries[key]
+        elif entry is not None:
+            self.entries[key] = (entry[0]._replace(**updates), entry[1])
+
+    def create(self, key, updates: dict):
+        # Where the row was known to be missing, the inserted row is exactly
+        # the defaults and the updates, no need to read it again
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] is None:
+            self.mark_written(key)
+            self.entries[key] = (Instance("created", "", None, None)._replace(**updates), entry[1])
+        else:
+            self.update(key, updates)
+
+    def discard(self, key):
+        self.mark_written(key)
+        self.entries.pop(key, None)
+
 
 class ChallengeState:
     def __init__(self, db, challenge_name: str, user_id: str):
         self.db = db
         self.challenge_name = challenge_name
         self.user_id = user_id
+        self.key = (challenge_name, user_id)
+
+    async def fetch(self) -> Instance | None:
+        cache = self.db.cache
+        if cache is not None:
+            cached, instance = cache.lookup(self.key)
+            if cached:
+                CACHE_LOOKUPS.inc("hit")
+                return instance
+            CACHE_LOOKUPS.inc("miss")
+            sequence = cache.begin_read()
+
+        try:
+            async with self.db.connection("fetch") as db:
+                res = await db.execute(SELECT_INSTANCE,
+                                       (self.challenge_name, self.user_id))
+                row = await res.fetchone()
+                await res.close()
+            instance = None if row is None else Instance(*row)
+        except BaseException:
+            if cache is not None:
+                cache.end_read()
+            raise
+
+        if cache is not None:
+            cache.fill(self.key, instance, sequence)
+        return instance
 
     async def get(self):
         state = await self.get_with_reason()
@@ -16,88 +204,396 @@ class ChallengeState:
         return st
 
     async def create_challenge(self):
-        async with connect(self.db.file) as db:
-            await db.execute("INSERT INTO challenges \
-                (name, user_id, state, reason) \
-                VALUES (?, ?, ?, ?) ON CONFLICT (name, user_id) DO NOTHING",
-                             (self.challenge_name, self.user_id, "created", ""))
-            await db.commit()
+        await self.transition(create=True)
 
     async def get_with_reason(self):
-        async with connect(self.db.file) as db:
-            res = await db.execute("SELECT state, reason FROM challenges \
-                WHERE name=? AND user_id=? LIMIT 1",
-                                   (self.challenge_name, self.user_id))
-            return await res.fetchone()
+        instance = await self.fetch()
+        if instance is None:
+            return None
+        return (instance.state, instance.reason)
+
+    async def transition(self, state: str | None = None, reason: str = "",
+                         create: bool = False, **columns):
+        # Applies every given field in a single transaction, optionally
+        # creating the row first, instead of one commit per setter.
+        statements = []
+        if create:
+            statements.append((INSERT_INSTANCE,
+                               (self.challenge_name, self.user_id, "created", "")))
+
+        updates = {}
+        if state is not None:
+            updates["state"] = state
+            updates["reason"] = reason
+        updates.update(columns)
+
+        if len(updates) > 0:
+            statements.append(update_statement(self.challenge_name, self.user_id, updates))
+
+        previous = None
+        if self.db.cache is not None:
+            previous = self.db.cache.peek(self.key)
+        await self.db.write_many(statements)
+        if self.db.cache is not None and create:
+            self.db.cache.create(self.key, updates)
+        elif self.db.cache is not None:
+            self.db.cache.update(self.key, updates)
+
+        if state is not None and (previous is None or (previous.state, previous.reason) != (state, reason)):
+            await self.publish()
+
+    async def publish(self):
+        # Pushes the new state to /events subscribers, if there are any
+        if self.db.events.wants(self.challenge_name, self.user_id):
+            self.db.events.publish(self.challenge_name, self.user_id, await self.fetch())
 
     async def set(self, state: str, reason: str = ""):
-        async with connect(self.db.file) as db:
-            await db.execute("UPDATE challenges SET state=?, reason=?\
-                WHERE name=? AND user_id=?",
-                             (state, reason, self.challenge_name, self.user_id))
-            await db.commit()
+        await self.transition(state, reason)
 
     async def set_server(self, server_idx: int):
-        async with connect(self.db.file) as db:
-            await db.execute("UPDATE challenges SET server=?\
-                WHERE name=? AND user_id=?",
-                             (server_idx, self.challenge_name, self.user_id))
-            await db.commit()
+        await self.transition(server=server_idx)
 
     async def get_server(self) -> int | None:
-        async with connect(self.db.file) as db:
-            res = await db.execute("SELECT server FROM challenges \
-                WHERE name=? AND user_id=? LIMIT 1",
-                                   (self.challenge_name, self.user_id))
-            res = await res.fetchone()
-            if res is None:
-                return None
-            else:
-                return res[0]
-            
+        instance = await self.fetch()
+        if instance is None:
+            return None
+        return instance.server
+
     async def set_port(self, port: int):
-        async with connect(self.db.file) as db:
-            await db.execute("UPDATE challenges SET port=?\
-                WHERE name=? AND user_id=?",
-                             (port, self.challenge_name, self.user_id))
-            await db.commit()
+        await self.transition(port=port)
 
     async def get_port(self) -> int | None:
-        async with connect(self.db.file) as db:
-            res = await db.execute("SELECT port FROM challenges \
-                WHERE name=? AND user_id=? LIMIT 1",
-                                   (self.challenge_name, self.user_id))
-            res = await res.fetchone()
-            if res is None:
-                return None
-            else:
-                return res[0]
+        instance = await self.fetch()
+        if instance is None:
+            return None
+        return instance.port
 
     async def delete(self):
-        async with connect(self.db.file) as db:
-            await db.execute("DELETE FROM challenges WHERE name=? AND user_id=?",
-                             (self.challenge_name, self.user_id))
-            await db.commit()
-
-    async def delete_and_insert(self, state):
-        async with connect(self.db.file) as db:
-            await db.execute("DELETE FROM challenges WHERE name=? AND user_id=?",
-                             (self.challenge_name, self.user_id))
-            await db.execute("INSERT INTO challenges \
-                (name, user_id, state, reason) \
-                VALUES (?, ?, ?, ?)",
-                             (self.challenge_name, self.user_id, state, ""))
-            await db.commit()
+        await self.db.write(DELETE_INSTANCE,
+                            (self.challenge_name, self.user_id))
+        if self.db.cache is not None:
+            self.db.cache.discard(self.key)
+        await self.publish()
+
+    async def claim(self, pool_id: str, **columns):
+        # Hands a pre-started instance over to this user by re-keying its
+        # row, replacing whatever stale row the user had, in one transaction
+        statements = [
+            (DELETE_INSTANCE, (self.challenge_name, self.user_id)),
+            (CLAIM_INSTANCE, (self.user_id, pool_id, self.challenge_name, pool_id)),
+        ]
+        if len(columns) > 0:
+            statements.append(update_statement(self.challenge_name, self.user_id, columns))
+        await self.db.write_many(statements)
+        if self.db.cache is not None:
+            self.db.cache.discard((self.challenge_name, pool_id))
+            self.db.cache.discard(self.key)
+        await self.publish()
 
 
 class Database():
-    def __init__(self, file: str) -> None:
+    def __init__(self, file: str, pool_size: int = 4,
+                 commit_interval: float = 0.005, cache_size: int = 10000,
+                 cache_idle: float = 3600) -> None:
         self.file = file
-        run(self.setup())
+        self.cache = None
+        if cache_size > 0:
+            self.cache = StateCache(cache_size, cache_idle)
+        self.pool_size = pool_size
+        self.commit_interval = commit_interval
+        # Replaced by Config with the [events] settings
+        self.events = EventBus()
+        self.loop = None
+        self.pool = None
+        self.writes = None
+        self.writer_task = None
+        self.setup()
+
+    def bind(self):
+        # The pool and the writer are created lazily, so they are bound to
+        # the loop that serves requests.
+        loop = asyncio.get_running_loop()
+        if self.loop is loop:
+            return
+        self.loop = loop
+        self.pool = asyncio.Queue()
+        for _ in range(self.pool_size):
+            self.pool.put_nowait(None)
+        self.writes = asyncio.Queue()
+        self.writer_task = None
+
+    async def open(self, **kwargs):
+        db = await connect(self.file, cached_statements=64, **kwargs)
+        # WAL lets the pooled readers run next to a writer, and NORMAL sync
+        # is durable enough in WAL mode while skipping an fsync per commit.
+        await db.execute("PRAGMA synchronous=NORMAL")
+        await db.execute("PRAGMA busy_timeout=5000")
+        return db
+
+    @asynccontextmanager
+    async def connection(self, query: str = "other"):
+        # Timed from asking for a connection, so waiting for the pool counts
+        self.bind()
+
+        begin = perf_counter()
+        db = await self.pool.get()
+        try:
+            if db is None:
+                db = await self.open()
+            yield db
+        except BaseException:
+            if db is not None:
+                await db.rollback()
+            raise
+        finally:
+            self.pool.put_nowait(db)
+            DB_QUERIES.observe(perf_counter() - begin, query)
+
+    async def instances(self, states: list[str] | None = None) -> list[tuple[str, str, Instance]]:
+        # Every instance in one of the states, or every instance at all
+        where = ""
+        if states is not None:
+            where = f"WHERE state IN ({', '.join('?' for _ in states)})"
+        async with self.connection("instances") as db:
+            res = await db.execute(f"SELECT name, user_id, {INSTANCE_COLUMNS} \
+                FROM challenges {where}", states or [])
+            rows = await res.fetchall()
+            await res.close()
+        return [(name, user_id, Instance(*instance)) for name, user_id, *instance in rows]
+
+    async def count(self, states: list[str]) -> int:
+        # Instances in one of the states, answered from the state index
+        async with self.connection("count") as db:
+            res = await db.execute(f"SELECT COUNT(*) FROM challenges \
+                WHERE state IN ({', '.join('?' for _ in states)})", states)
+            (count,) = await res.fetchone()
+            await res.close()
+        return count
+
+    async def instances_of(self, user_prefix: str) -> list[tuple[str, str, Instance]]:
+        # Not LIKE, user ids may contain _ which LIKE takes as a wildcard
+        async with self.connection("instances_of") as db:
+            res = await db.execute(f"SELECT name, user_id, {INSTANCE_COLUMNS} \
+                FROM challenges WHERE substr(user_id, 1, ?) = ?", (len(user_prefix), user_prefix))
+            rows = await res.fetchall()
+            await res.close()
+        return [(name, user_id, Instance(*instance)) for name, user_id, *instance in rows]
+
+    async def select(self, pairs: list[tuple[str, str]] | None = None, user_id: str | None = None,
+                     name: str | None = None) -> list[tuple[str, str, Instance]]:
+        # Every instance matching any of the (name, user_id) pairs, the user
+        # or the challenge, in a single query
+        conditions = []
+        params = []
+        if pairs is not None and len(pairs) > 0:
+            conditions.append(f"(name, user_id) IN (VALUES {', '.join('(?, ?)' for _ in pairs)})")
+            for pair in pairs:
+                params += pair
+        if user_id is not None:
+            conditions.append("user_id=?")
+            params.append(user_id)
+        if name is not None:
+            conditions.append("name=?")
+            params.append(name)
+        if len(conditions) == 0:
+            return []
+
+        async with self.connection("select") as db:
+            res = await db.execute(f"SELECT name, user_id, {INSTANCE_COLUMNS} \
+                FROM challenges WHERE {' OR '.join(conditions)}", params)
+            rows = await res.fetchall()
+            await res.close()
+        return [(name, user_id, Instance(*instance)) for name, user_id, *instance in rows]
+
+    async def expired(self, now: float, limit: int, names: list[str] | None = None,
+                      after: tuple[str, str] | None = None) -> list[tuple[str, str, Instance]]:
+        # Both columns are indexed, sqlite answers the OR from the two indexes.
+        # Only instances of the challenges in names, in (name, user_id) order
+        # after `after`, so rows a caller skips don't come back on every page.
+        conditions = ["(expires_at < ? OR idle_at < ?)"]
+        params = [now, now]
+        if names is not None:
+            conditions.append(f"name IN ({', '.join('?' for _ in names)})")
+            params += names
+        if after is not None:
+            conditions.append("(name, user_id) > (?, ?)")
+            params += after
+        params.append(limit)
+        async with self.connection("expired") as db:
+            res = await db.execute(f"SELECT name, user_id, {INSTANCE_COLUMNS} \
+                FROM challenges WHERE {' AND '.join(conditions)} ORDER BY name, user_id LIMIT ?", params)
+            rows = await res.fetchall()
+            await res.close()
+        return [(name, user_id, Instance(*instance)) for name, user_id, *instance in rows]
+
+    async def update_many(self, changes: list[tuple[str, str, dict]]):
+        # (name, user_id, updates) applied in a single transaction
+        if len(changes) == 0:
+            return
+        await self.write_many([update_statement(name, user_id, updates)
+                               for name, user_id, updates in changes])
+        for name, user_id, updates in changes:
+            if self.cache is not None:
+                self.cache.update((name, user_id), updates)
+            if "state" in updates:
+                await ChallengeState(self, name, user_id).publish()
+
+    async def delete_many(self, keys: list[tuple[str, str]]):
+        await self.write_many([(DELETE_INSTANCE, key) for key in keys])
+        if self.cache is not None:
+            for key in keys:
+                self.cache.discard(key)
+        for name, user_id in keys:
+            if self.events.wants(name, user_id):
+                self.events.publish(name, user_id, None)
+
+    async def ports(self) -> list[tuple[int, int]]:
+        # (server, port) of every instance holding a port
+        async with self.connection("ports") as db:
+            res = await db.execute("SELECT server, port FROM challenges \
+                WHERE server IS NOT NULL AND port IS NOT NULL")
+            rows = await res.fetchall()
+            await res.close()
+        return rows
 
-    async def setup(self):
-        async with connect(self.file) as db:
-            await db.execute("CREATE TABLE IF NOT EXISTS challenges ( \
+    async def acquire(self, name: str, holder: str, ttl: float) -> bool:
+        now = time()
+        await self.write(ACQUIRE_LEASE, (name, holder, now + ttl, now))
+        async with self.connection("lease") as db:
+            res = await db.execute(SELECT_LEASE, (name, now))
+            row = await res.fetchone()
+            await res.close()
+        return row is not None and row[0] == holder
+
+    async def release(self, name: str, holder: str):
+        await self.write(RELEASE_LEASE, (name, holder))
+
+    async def leases(self, prefix: str) -> list[str]:
+        # Names of the leases that didn't expire yet
+        async with self.connection("leases") as db:
+            res = await db.execute("SELECT name FROM locks WHERE substr(name, 1, ?)=? AND expires_at >= ?",
+                                   (len(prefix), prefix, time()))
+            rows = await res.fetchall()
+            await res.close()
+        return [name for name, in rows]
+
+    async def reserve_port(self, hostname: str, port: int) -> bool:
+        # False when another replica reserved the port first
+        try:
+            await self.write(RESERVE_PORT, (hostname, port, time()))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    async def reserve_ports(self, ports: list[tuple[str, int]]):
+        now = time()
+        await self.write_many([(RESERVE_PORT_IF_FREE, (hostname, port, now)) for hostname, port in ports])
+
+    async def release_ports(self, ports: list[tuple[str, int]]):
+        await self.write_many([(RELEASE_PORT, (hostname, port)) for hostname, port in ports])
+
+    async def reserved_ports(self) -> list[tuple[str, int, float]]:
+        async with self.connection("reserved_ports") as db:
+            res = await db.execute("SELECT server, port, reserved_at FROM ports")
+            rows = await res.fetchall()
+            await res.close()
+        return rows
+
+    async def write(self, query: str, params: tuple):
+        await self.write_many([(query, params)])
+
+    async def write_many(self, statements: list[tuple[str, tuple]]):
+        # Queues the statements for the group-commit writer and waits until
+        # they are committed, so reads after a write still see it.
+        if len(statements) == 0:
+            return
+        self.bind()
+        if self.writer_task is None or self.writer_task.done():
+            self.writer_task = asyncio.create_task(self.writer())
+
+        future = self.loop.create_future()
+        self.writes.put_nowait((statements, future))
+        with DB_QUERIES.time("write"):
+            await future
+
+    async def writer(self):
+        db = None
+        try:
+            # The writer manages its own transactions, see commit()
+            db = await self.open(isolation_level=None)
+            while True:
+                batch = [await self.writes.get()]
+                # Give concurrent writers a few milliseconds to join the batch
+                await asyncio.sleep(self.commit_interval)
+                while not self.writes.empty():
+                    batch.append(self.writes.get_nowait())
+                await self.commit(db, batch)
+        except Exception as e:
+            while not self.writes.empty():
+                _, future = self.writes.get_nowait()
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            if db is not None:
+                await db.close()
+
+    async def commit(self, db, batch):
+        # Every queued group is atomic on its own (a savepoint), while the
+        # whole batch shares a single transaction and a single commit.
+        results = []
+        DB_COMMIT_BATCH.observe(len(batch))
+        begin = perf_counter()
+        try:
+            await db.execute("BEGIN IMMEDIATE")
+            for statements, _ in batch:
+                await db.execute("SAVEPOINT grp")
+                try:
+                    for query, params in statements:
+                        await db.execute(query, params)
+                    await db.execute("RELEASE grp")
+                    results.append(None)
+                except Exception as e:
+                    await db.execute("ROLLBACK TO grp")
+                    await db.execute("RELEASE grp")
+                    results.append(e)
+            await db.execute("COMMIT")
+        except Exception as e:
+            if db.in_transaction:
+                await db.execute("ROLLBACK")
+            results = [e] * len(batch)
+        DB_QUERIES.observe(perf_counter() - begin, "commit")
+
+        for (_, future), error in zip(batch, results):
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    async def close(self):
+        if self.writer_task is not None:
+            self.writer_task.cancel()
+            try:
+                await self.writer_task
+            except asyncio.CancelledError:
+                pass
+            self.writer_task = None
+        if self.pool is not None:
+            while not self.pool.empty():
+                db = self.pool.get_nowait()
+                if db is not None:
+                    await db.close()
+        self.loop = None
+        self.pool = None
+
+    def setup(self):
+        # Plain sqlite3, so constructing needs no event loop of its own and
+        # works inside a running one
+        db = sqlite3.connect(self.file)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS challenges ( \
                 name TEXT NOT NULL, \
                 user_id TEXT NOT NULL, \
                 server INTEGER, \
@@ -106,4 +602,30 @@ class Database():
                 port INTEGER,\
                 PRIMARY KEY (name, user_id) \
             )")
-            await db.commit()
+            res = db.execute("PRAGMA table_info(challenges)")
+            columns = [column[1] for column in res.fetchall()]
+            for column, kind in MIGRATIONS:
+                if column not in columns:
+                    db.execute(f"ALTER TABLE challenges ADD COLUMN {column} {kind}")
+            db.execute("CREATE INDEX IF NOT EXISTS challenges_state ON challenges (state)")
+            db.execute("CREATE INDEX IF NOT EXISTS challenges_expires_at ON challenges (expires_at)")
+            db.execute("CREATE INDEX IF NOT EXISTS challenges_idle_at ON challenges (idle_at)")
+            db.execute("CREATE TABLE IF NOT EXISTS locks ( \
+                name TEXT NOT NULL PRIMARY KEY, \
+                holder TEXT NOT NULL, \
+                expires_at REAL NOT NULL \
+            )")
+            db.execute("CREATE TABLE IF NOT EXISTS ports ( \
+                server TEXT NOT NULL, \
+                port INTEGER NOT NULL, \
+                reserved_at REAL NOT NULL, \
+                PRIMARY KEY (server, port) \
+            )")
+            db.commit()
+
+            if self.cache is not None:
+                res = db.execute(SELECT_INSTANCES, (self.cache.max_entries,))
+                for name, user_id, *instance in res.fetchall():
+                    self.cache.put((name, user_id), Instance(*instance))
+        finally:
+            db.close()
@@ -0,0 +1,100 @@
+import asyncio
+
+from contextlib import contextmanager
+from logging import getLogger
+
+log = getLogger(__name__)
+
+# Sent to a subscriber that fell behind and missed events, it should fetch
+# the state again (e.g. /batch/status) instead of relying on the stream
+RESYNC = {"type": "resync"}
+
+
+class Subscriber:
+    def __init__(self, user_id: str | None, challenge: str | None, queue_size: int) -> None:
+        self.user_id = user_id
+        self.challenge = challenge
+        self.queue = asyncio.Queue(queue_size)
+        self.overflowed = False
+        self.dropped = 0
+
+    def matches(self, event: dict) -> bool:
+        return (self.user_id is None or self.user_id == event["user_id"]) and \
+            (self.challenge is None or self.challenge == event["challenge"])
+
+    def offer(self, event: dict):
+        # Never blocks the writer, a full queue drops events until the
+        # subscriber caught up and got a resync
+        if self.overflowed or self.queue.full():
+            self.overflowed = True
+            self.dropped += 1
+            return
+        self.queue.put_nowait(event)
+
+    async def next(self) -> dict:
+        if self.overflowed and self.queue.empty():
+            self.overflowed = False
+            return RESYNC
+        return await self.queue.get()
+
+
+class EventBus:
+    def __init__(self, queue_size: int = 100, max_subscribers: int = 10000,
+                 keepalive: float = 15) -> None:
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.keepalive = keepalive
+        # Subscribers indexed by their filter, so publishing only looks at
+        # the ones that may be interested
+        self.by_user = {}
+        self.by_challenge = {}
+        self.everything = set()
+        self.count = 0
+
+    def full(self) -> bool:
+        return self.count >= self.max_subscribers
+
+    def index(self, subscriber: Subscriber) -> set:
+        if subscriber.user_id is not None:
+            return self.by_user.setdefault(subscriber.user_id, set())
+        if subscriber.challenge is not None:
+            return self.by_challenge.setdefault(subscriber.challenge, set())
+        return self.everything
+
+    @contextmanager
+    def subscribe(self, user_id: str | None = None, challenge: str | None = None):
+        subscriber = Subscriber(user_id, challenge, self.queue_size)
+        subscribers = self.index(subscriber)
+        subscribers.add(subscriber)
+        self.count += 1
+        try:
+            yield subscriber
+        finally:
+            subscribers.discard(subscriber)
+            self.count -= 1
+            if len(subscribers) == 0:
+                if subscriber.user_id is not None:
+                    self.by_user.pop(subscriber.user_id, None)
+                elif subscriber.challenge is not None:
+                    self.by_challenge.pop(subscriber.challenge, None)
+            if subscriber.dropped > 0:
+                log.info(f"subscriber for {user_id} {challenge} dropped {subscriber.dropped} events")
+
+    def resync(self):
+        # Every subscriber may have missed events, e.g. while the events of
+        # another process could not be forwarded
+        for subscribers in (*self.by_user.values(), *self.by_challenge.values(), self.everything):
+            for subscriber in subscribers:
+                subscriber.overflowed = True
+
+    def wants(self, challenge: str, user_id: str) -> bool:
+        return len(self.everything) > 0 or user_id in self.by_user or challenge in self.by_challenge
+
+    def publish(self, challenge: str, user_id: str, instance):
+        # instance is None once the instance is gone
+        event = {"type": "state", "challenge": challenge, "user_id": user_id, "instance": instance}
+        for subscribers in (self.by_user.get(user_id, ()), self.by_challenge.get(challenge, ()),
+                            self.everything):
+            for subscriber in subscribers:
+                if subscriber.matches(event):
+                    subscriber.offer(event)
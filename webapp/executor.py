@@ -1,86 +1,190 @@
 import asyncio
+import json
+import time
 from webapp.config import Config
 from shlex import quote
 from os.path import join, dirname, basename
+from contextlib import asynccontextmanager
 from logging import getLogger
-from tempfile import NamedTemporaryFile
-from shutil import make_archive
 from webapp.server import Server
+from webapp.backend import make_backend
+from webapp.sync import ChallengeSync
+from webapp.placement import Placement
+from webapp.pool import Pools
+from webapp.warmup import WarmUp
+from webapp.lifetime import Lifetime
+from webapp.reconcile import Reconciler
+from webapp.admission import StartQueue
+from webapp.cluster import Cluster
+from webapp.reload import Reloader
+from webapp.metrics import SSH_COMMANDS, SSH_FAILURES, SSH_WAIT
 
 log = getLogger(__name__)
 
-
-def runner(server, cmd, timeout=None) -> tuple[Server, str | None]:
-    try:
-        log.info(f"[{server.hostname}]\tRunning command '{cmd}'")
-        result = server.connection.run(cmd, hide=True, timeout=timeout)
-
-        return (server, result.stdout.strip())
-    except Exception as e:
-        log.warning(f"[{server.hostname}]\tFailed to run '{cmd}': {e}")
-        
-        return (server, None)
+# Lanes a command can be scheduled on. Probes get their own slots on every
+# server so they never queue behind slow starts, stops and syncs.
+PROBE = "probe"
+BULK = "bulk"
+
+
+class Lane:
+    def __init__(self, slots: int) -> None:
+        self.slots = slots
+        self.semaphore = asyncio.Semaphore(slots)
+        self.waiting = 0
+        self.running = 0
+
+    @asynccontextmanager
+    async def slot(self):
+        # asyncio.Semaphore wakes up waiters in FIFO order, so commands on a
+        # lane run in the order they were submitted
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self.semaphore.release()
+
+
+class Scheduler:
+    def __init__(self, server: Server) -> None:
+        self.lanes = {
+            PROBE: Lane(server.probe_sessions),
+            BULK: Lane(server.max_sessions - server.probe_sessions),
+        }
+
+    def slot(self, lane: str):
+        return self.lanes[lane].slot()
 
 
 class Executor:
     def __init__(self, config: Config):
         self.config = config
-
-    async def create_enviroment(self):
-        # List all the files that have to be uploaded
-        base_dir = self.config.challenge_path
-
-        with NamedTemporaryFile(delete_on_close=False) as f:
-            log.info(f"Making archive of {base_dir}")
-            archive_name = await asyncio.to_thread(make_archive,
-                                                   f.name,
-                                                   "tar",
-                                                   base_dir)
-
-            log.info(f"Sending archive to {len(self.config.servers)} servers")
-
-            async def send_archive(server, tar):
-                try:
-                    await self.run(server, f"rm -rf {quote(server.path)}")
-                    await self.run(server, f"mkdir -p {quote(server.path)}")
-
-                    to_path = join(server.path, basename(tar))
-                    log.info(f"[{server.hostname}]\tputting {tar} to {to_path}")
-                    await asyncio.to_thread(server.connection.put, tar, to_path)
-
-                    extract_cmd = f"tar -xf {quote(to_path)} --directory {quote(server.path)}"
-                    log.info(f"[{server.hostname}]\tRunning {extract_cmd}")
-                    await self.run(server, extract_cmd)
-
-                    await self.run(server, f"rm -f {quote(to_path)}")
-                except Exception as e:
-                    log.warning(f"[{server.hostname}] Failed to setup server: {e}")
-
-            await asyncio.gather(
-                *[send_archive(server, archive_name) for server in self.config.servers]
-            )
-
-    async def run_all(self, cmd, timeout=None) -> list[tuple[Server, str]]:
-        result = await asyncio.gather(
-            *[asyncio.to_thread(runner, server, cmd, timeout) for server in self.config.servers]
-        )
-        return [(server, response) for (server, response) in result if response != None]
-
-    async def run(self, server, cmd, timeout=None) -> str | None:
-        _, result = await asyncio.to_thread(runner, server, cmd, timeout)
+        self.backend = make_backend(config)
+        self.schedulers = {}
+        self.python_paths = {}
+        self.cluster = Cluster(self, config.cluster)
+        self.sync = ChallengeSync(self, config.sync)
+        self.placement = Placement(self, config.placement)
+        self.pools = Pools(self, config.pools)
+        self.warmup = WarmUp(self, config.warmup)
+        self.lifetime = Lifetime(self, config.lifetime)
+        self.reconciler = Reconciler(self, config.reconcile)
+        self.starts = StartQueue(self, config.admission)
+        self.reloader = Reloader(self, config.reload)
+
+    async def create_enviroment(self, servers: list | None = None):
+        if servers is None:
+            servers = [server for server in self.config.servers if not server.draining]
+        manifest = await self.sync.sync(self.config.challenge_path, servers)
+        synced = [server for server in servers
+                  if server.hostname in self.sync.results and self.sync.results[server.hostname].ok]
+        self.warmup.schedule(manifest, synced)
+
+    def scheduler(self, server) -> Scheduler:
+        scheduler = self.schedulers.get(server.hostname)
+        if scheduler is None:
+            scheduler = self.schedulers[server.hostname] = Scheduler(server)
+        return scheduler
+
+    async def run(self, server, cmd, timeout=None, lane=BULK) -> str | None:
+        queued = time.perf_counter()
+        async with self.scheduler(server).slot(lane):
+            began = time.perf_counter()
+            SSH_WAIT.observe(began - queued, server.hostname, lane)
+            result = await self.backend.run(server, cmd, timeout)
+        SSH_COMMANDS.observe(time.perf_counter() - began, server.hostname, lane)
+        if result is None:
+            SSH_FAILURES.inc(server.hostname, lane)
         return result
 
-    #async def current_compose_projects(self):
-    #    await self.run_all("docker compose ls --format json")
-
-    async def get_available_server(self) -> Server | None:
-        loads = await self.run_all("cat /proc/loadavg | awk '{ print $1}'")
-
-        if len(loads) == 0:
-            return None
+    async def stream(self, server, cmd, produce, timeout=None, lane=BULK) -> str | None:
+        queued = time.perf_counter()
+        async with self.scheduler(server).slot(lane):
+            began = time.perf_counter()
+            SSH_WAIT.observe(began - queued, server.hostname, lane)
+            result = await self.backend.stream(server, cmd, produce, timeout)
+        SSH_COMMANDS.observe(time.perf_counter() - began, server.hostname, lane)
+        if result is None:
+            SSH_FAILURES.inc(server.hostname, lane)
+        return result
 
-        (idlest_server, _) = min(loads, key=lambda l: l[1])
-        return idlest_server
+    def queue_depths(self) -> dict[str, dict[str, tuple[int, int]]]:
+        # hostname -> lane -> (commands waiting, commands running)
+        return {
+            hostname: {name: (lane.waiting, lane.running) for name, lane in scheduler.lanes.items()}
+            for hostname, scheduler in self.schedulers.items()
+        }
+
+    async def reserve_ports(self):
+        # The ports of instances from before a restart are in the database,
+        # anything else listening on a server is skipped as well
+        servers = self.config.servers
+        recorded = {}
+        for idx, port in await self.config.database.ports():
+            if idx < len(servers):
+                servers[idx].ports.reserve(port)
+                recorded.setdefault(servers[idx].hostname, set()).add(port)
+        await self.cluster.reserve_ports()
+        await asyncio.gather(
+            *[self.reserve_listening(server, recorded.get(server.hostname, set())) for server in servers]
+        )
 
-    async def current_challenges(self):
-        pass
+    async def reserve_listening(self, server, recorded: set[int]):
+        out = await self.run(server, "ss -Htln", timeout=10, lane=PROBE)
+        if out is None:
+            log.warning(f"[{server.hostname}]\tcould not list listening ports")
+            return
+        listening = set()
+        for line in out.splitlines():
+            fields = line.split()
+            if len(fields) < 4:
+                continue
+            _, _, port = fields[3].rpartition(":")
+            if port.isdigit():
+                listening.add(int(port))
+        blocked = sorted(port for port in listening - recorded if server.ports.reserve(port))
+        if len(blocked) > 0:
+            log.info(f"[{server.hostname}]\tskipping {len(blocked)} ports in use by other services: {blocked[:10]}")
+        missing = recorded - listening
+        if len(missing) > 0:
+            log.info(f"[{server.hostname}]\t{len(missing)} ports in the database are not listening")
+
+    async def python_path(self, server) -> str | None:
+        # Looked up once per server instead of before every probe
+        if server.hostname not in self.python_paths:
+            log.info(f"[{server.hostname}]\tlooking for python")
+            python_path = await self.run(server, "which python3", timeout=1, lane=PROBE)
+            if python_path is None or len(python_path) <= 0:
+                log.critical(f"python3 is not available on {server}!")
+                return None
+            self.python_paths[server.hostname] = python_path
+        return self.python_paths[server.hostname]
+
+    async def get_available_server(self, challenge=None) -> Server | None:
+        # Counts as an in-flight placement until placement.release(server)
+        return await self.placement.choose(challenge)
+
+    async def current_challenges(self) -> dict[str, list[dict] | None]:
+        # hostname -> compose projects on that server (Name, Status,
+        # ConfigFiles), None for servers that didn't answer
+        results = await asyncio.gather(
+            *[self.run(server, "docker compose ls --all --format json", timeout=30, lane=PROBE)
+              for server in self.config.servers]
+        )
+        projects = {}
+        for server, result in zip(self.config.servers, results):
+            if result is None:
+                projects[server.hostname] = None
+                continue
+            try:
+                projects[server.hostname] = json.loads(result or "[]")
+            except ValueError:
+                log.warning(f"[{server.hostname}]\tdocker compose ls returned invalid JSON")
+                projects[server.hostname] = None
+        return projects
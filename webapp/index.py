@@ -0,0 +1,142 @@
+# Persisted index of the parsed challenges, so a restart doesn't need the
+# checker of the challenge repo.
+#
+# The index keeps a fingerprint (file names, sizes and modification times)
+# of every directory a challenge may live in and of the files at the top of
+# the repo. While none of them changed the challenges are read from the index.
+# Telling what changed is per directory, rebuilding is not: the checker can
+# only parse the whole repo, so a single changed directory parses every
+# challenge again.
+import hashlib
+import json
+import os
+
+from logging import getLogger
+
+from webapp.challenge import Challenge, parse_challenges
+
+log = getLogger(__name__)
+
+INDEX_VERSION = 1
+
+# Key of the files at the top of the challenge repo, e.g. the checker
+TOP = "."
+
+
+def fingerprint(directory: str, recursive: bool = True) -> str:
+    # Changes when anything below the directory is added, removed or
+    # modified. Only stats are read, so it stays cheap for large challenges.
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        rel = os.path.relpath(root, directory)
+        for name in sorted(files):
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            digest.update(f"{rel}/{name}\0{st.st_mtime_ns}\0{st.st_size}\0{st.st_mode}\n".encode())
+        if not recursive:
+            break
+        for name in dirs:
+            digest.update(f"{rel}/{name}/\n".encode())
+    return digest.hexdigest()[:16]
+
+
+def candidates(path: str, depths: set[int]) -> list[str]:
+    # Directories at the depths challenges were found at, so a new challenge
+    # next to the known ones is noticed too
+    found = []
+    level = [""]
+    for depth in range(1, max(depths, default=0) + 1):
+        below = []
+        for parent in level:
+            try:
+                entries = sorted(os.scandir(os.path.join(path, parent)), key=lambda e: e.name)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in entries:
+                if entry.name.startswith(".") or not entry.is_dir(follow_symlinks=False):
+                    continue
+                below.append(os.path.join(parent, entry.name))
+        if depth in depths:
+            found.extend(below)
+        level = below
+    return found
+
+
+def scan(path: str, depths: set[int]) -> dict[str, str]:
+    # relative directory -> fingerprint, for every directory a challenge may
+    # live in and the files at the top
+    dirs = {rel: fingerprint(os.path.join(path, rel)) for rel in candidates(path, depths)}
+    dirs[TOP] = fingerprint(path, recursive=False)
+    return dirs
+
+
+def challenge_dir(path: str, challenge: Challenge) -> str:
+    return os.path.relpath(os.path.join(path, challenge.path), path)
+
+
+def load_index(index_path: str, path: str) -> dict | None:
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        log.warning(f"Ignoring the challenge index {index_path}: {e}")
+        return None
+    if index.get("version") != INDEX_VERSION or index.get("path") != os.path.abspath(path):
+        return None
+    return index
+
+
+def save_index(index_path: str, index: dict):
+    # Written next to the old one and swapped, a crash never leaves half an
+    # index and API workers starting at once don't write over each other
+    staging = f"{index_path}.{os.getpid()}.tmp"
+    try:
+        with open(staging, "w") as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(staging, index_path)
+    except OSError as e:
+        log.warning(f"Could not write the challenge index {index_path}: {e}")
+
+
+def from_index(index: dict) -> dict[str, Challenge]:
+    challenges = {}
+    for name, entry in index["challenges"].items():
+        challenge = challenges[name] = Challenge(name, entry["path"], entry["flag"])
+        challenge.url = entry["url"]
+    return challenges
+
+
+def load_challenges(path: str, index_path: str | None = None) -> dict[str, Challenge]:
+    # Challenges from the index when no challenge directory changed since it
+    # was written, otherwise parsed by the checker of the challenge repo
+    if index_path is None:
+        return parse_challenges(path)
+
+    index = load_index(index_path, path)
+    if index is not None:
+        depths = {len(entry["dir"].split("/")) for entry in index["challenges"].values()}
+        dirs = scan(path, depths)
+        changed = sorted(rel for rel in dirs.keys() | index["dirs"].keys()
+                         if dirs.get(rel) != index["dirs"].get(rel))
+        if len(changed) == 0:
+            log.info(f"{len(index['challenges'])} challenges read from the index {index_path}")
+            return from_index(index)
+        log.info(f"{len(changed)} challenge directories changed, e.g. {changed[:5]}, parsing {path}")
+
+    challenges = parse_challenges(path)
+    entries = {name: {"path": challenge.path, "flag": challenge.flag, "url": challenge.url,
+                      "dir": challenge_dir(path, challenge)}
+               for name, challenge in challenges.items()}
+    depths = {len(entry["dir"].split("/")) for entry in entries.values()}
+    save_index(index_path, {
+        "version": INDEX_VERSION,
+        "path": os.path.abspath(path),
+        "dirs": scan(path, depths),
+        "challenges": entries,
+    })
+    return challenges
@@ -0,0 +1,115 @@
+import asyncio
+import time
+
+from logging import getLogger
+
+from webapp.database import ChallengeState
+from webapp.metrics import LOOP_FAILURES, LOOP_SECONDS
+
+log = getLogger(__name__)
+
+
+class Lifetime:
+    def __init__(self, executor, options: dict) -> None:
+        self.executor = executor
+        self.options = options
+        # seconds between reaper rounds, instances stopped per round and
+        # stops started per second at most
+        self.interval = options.get("interval", 60)
+        self.batch = options.get("batch", 20)
+        self.rate = options.get("rate", 2)
+        self.semaphore = asyncio.Semaphore(options.get("concurrency", 4))
+
+    def setting(self, challenge, name: str, default: float = 0) -> float:
+        override = self.options.get("challenges", {}).get(challenge.name, {})
+        return override.get(name, self.options.get(name, default))
+
+    def deadlines(self, challenge, now: float | None = None) -> dict[str, float | None]:
+        # expires_at/idle_at of an instance that starts now, None when the
+        # challenge has no ttl or idle timeout
+        now = time.time() if now is None else now
+        ttl = self.setting(challenge, "ttl")
+        idle = self.setting(challenge, "idle")
+        return {
+            "expires_at": now + ttl if ttl > 0 else None,
+            "idle_at": now + idle if idle > 0 else None,
+        }
+
+    async def touch(self, state: ChallengeState, challenge, instance):
+        # Someone asked about the instance, so it is not idle. Only written
+        # once half the idle timeout passed, to keep /status free of writes.
+        idle = self.setting(challenge, "idle")
+        if idle <= 0 or instance is None or instance.idle_at is None:
+            return
+        now = time.time()
+        if instance.idle_at - now < idle / 2:
+            await state.transition(idle_at=now + idle)
+
+    async def extend(self, state: ChallengeState, challenge, instance) -> float | None:
+        now = time.time()
+        extension = self.setting(challenge, "extend", self.setting(challenge, "ttl"))
+        columns = {}
+        expires_at = instance.expires_at
+        if instance.expires_at is not None and extension > 0:
+            expires_at = max(now, instance.expires_at) + extension
+            # Extending can't push the instance past max_lifetime from now
+            max_lifetime = self.setting(challenge, "max_lifetime")
+            if max_lifetime > 0:
+                expires_at = min(expires_at, now + max_lifetime)
+            columns["expires_at"] = expires_at
+        idle = self.setting(challenge, "idle")
+        if instance.idle_at is not None and idle > 0:
+            columns["idle_at"] = now + idle
+        if len(columns) > 0:
+            await state.transition(**columns)
+        return expires_at
+
+    async def stop(self, challenge, user_id: str, reason: str):
+        async with self.semaphore:
+            try:
+                log.info(f"stopping {reason} instance {challenge.name} {user_id}")
+                await challenge.stop(self.executor, user_id)
+            except Exception as e:
+                log.warning(f"Stopping {reason} instance {challenge.name} {user_id} failed: {e}")
+                await challenge.working_set.remove(user_id)
+
+    async def reap(self):
+        now = time.time()
+        challenges = self.executor.config.challenges
+        stops = []
+        after = None
+        # Pages past the instances left alone, so they can't fill the batch
+        while len(stops) < self.batch:
+            expired = await self.executor.config.database.expired(now, self.batch, list(challenges), after)
+            for name, user_id, instance in expired:
+                after = (name, user_id)
+                challenge = challenges[name]
+                # Instances being started or stopped are left alone this round
+                if not await challenge.working_set.contains_or_insert(user_id):
+                    continue
+                reason = "expired" if instance.expires_at is not None and instance.expires_at < now else "idle"
+                stops.append(asyncio.create_task(self.stop(challenge, user_id, reason)))
+                # Spread the stops out so they never flood the executor
+                await asyncio.sleep(1 / self.rate)
+                if len(stops) >= self.batch:
+                    break
+            if len(expired) < self.batch:
+                break
+        if len(stops) > 0:
+            log.info(f"reaping {len(stops)} expired or idle instances")
+        # The next round only starts once these rows are gone
+        await asyncio.gather(*stops)
+        return len(stops)
+
+    async def run(self):
+        while True:
+            try:
+                with LOOP_SECONDS.time("lifetime"):
+                    reaped = await self.reap()
+            except Exception as e:
+                LOOP_FAILURES.inc("lifetime")
+                log.warning(f"Something went wrong while reaping instances: {e}")
+                reaped = 0
+            # A full batch means there is more to do, go again right away
+            if reaped < self.batch:
+                await asyncio.sleep(self.interval)
@@ -0,0 +1,226 @@
+import time
+
+from bisect import bisect_left
+
+# Every metric registers itself here, /metrics renders them in order
+REGISTRY = []
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from a cached status read to a slow run.sh
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if len(pairs) > 0 else ""
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        # label values -> value
+        self.values = {}
+        REGISTRY.append(self)
+
+    def get(self, *labels) -> float:
+        return self.values.get(labels, 0)
+
+    def reset(self):
+        self.values = {}
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, format_labels(self.labels, labels), value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+
+class Timer:
+    # A plain class rather than @contextmanager, this sits on every request
+    __slots__ = ("histogram", "labels", "begin")
+
+    def __init__(self, histogram, labels: tuple) -> None:
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.begin, *self.labels)
+        return False
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels):
+        # [count per bucket..., count above the last bucket, sum], the
+        # cumulative counts are only worked out when rendering
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def time(self, *labels) -> Timer:
+        return Timer(self, labels)
+
+    def count(self, *labels) -> int:
+        series = self.values.get(labels)
+        return 0 if series is None else sum(series[:-1])
+
+    def dump(self) -> list:
+        return [[list(labels), series] for labels, series in self.values.items()]
+
+    def merge(self, dumps):
+        # Replaces the series with the sum of dump()s taken in other processes
+        self.values = {}
+        for dump in dumps:
+            for labels, series in dump:
+                mine = self.values.get(tuple(labels))
+                if mine is None:
+                    self.values[tuple(labels)] = list(series)
+                else:
+                    for i, value in enumerate(series):
+                        mine[i] += value
+
+    def samples(self):
+        for labels, series in self.values.items():
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                total += count
+                le = f'le="{format_value(bound)}"'
+                yield f"{self.name}_bucket", format_labels(self.labels, labels, le), total
+            yield f"{self.name}_sum", format_labels(self.labels, labels), series[-1]
+            yield f"{self.name}_count", format_labels(self.labels, labels), total
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{labels} {format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    # Plain ASGI rather than BaseHTTPMiddleware, which would buffer the
+    # /events stream. Observes the time until the response started, labelled
+    # with the endpoint function so user ids never end up in a label.
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        begin = time.perf_counter()
+
+        async def send_observed(message):
+            if message["type"] == "http.response.start":
+                endpoint = scope.get("endpoint")
+                HTTP_REQUESTS.observe(time.perf_counter() - begin,
+                                      "other" if endpoint is None else endpoint.__name__,
+                                      scope["method"], str(message["status"]))
+            await send(message)
+
+        await self.app(scope, receive, send_observed)
+
+
+HTTP_REQUESTS = Histogram("instancer_http_request_seconds",
+                          "Time until the response started, by endpoint",
+                          ("endpoint", "method", "status"))
+
+SSH_COMMANDS = Histogram("instancer_ssh_command_seconds",
+                         "Time commands ran on a server, after getting a slot",
+                         ("server", "lane"))
+SSH_WAIT = Histogram("instancer_ssh_wait_seconds",
+                     "Time commands waited for a slot on their lane",
+                     ("server", "lane"))
+SSH_FAILURES = Counter("instancer_ssh_command_failures_total",
+                       "Commands that failed or timed out",
+                       ("server", "lane"))
+SSH_COMMANDS_ACTIVE = Gauge("instancer_ssh_commands",
+                            "Commands waiting for a slot or running",
+                            ("server", "lane", "status"))
+
+DB_QUERIES = Histogram("instancer_db_query_seconds",
+                       "Time database queries took, writes until they were committed",
+                       ("query",))
+DB_COMMIT_BATCH = Histogram("instancer_db_commit_batch_size",
+                            "Write groups committed in one transaction",
+                            buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+CACHE_ENTRIES = Gauge("instancer_state_cache_entries", "Instances in the state cache")
+CACHE_LOOKUPS = Counter("instancer_state_cache_lookups_total",
+                        "Instance reads answered by the state cache or not", ("result",))
+
+START_PHASES = Histogram("instancer_start_phase_seconds",
+                         "Time spent in each phase of starting an instance",
+                         ("phase",))
+STOP_PHASES = Histogram("instancer_stop_phase_seconds",
+                        "Time spent in each phase of stopping an instance",
+                        ("phase",))
+STARTS = Counter("instancer_starts_total", "Starts by outcome", ("challenge", "result"))
+STOPS = Counter("instancer_stops_total", "Instances stopped", ("challenge",))
+RETRIEVES = Counter("instancer_retrieve_state_total",
+                    "How retrieve_state found the server of an instance: the recorded " +
+                    "server, the reconcile inventory or a sweep of every server",
+                    ("path",))
+
+ADMISSIONS = Counter("instancer_start_admissions_total",
+                     "Starts admitted to the start queue or rejected, by reason", ("result",))
+START_QUEUE = Gauge("instancer_start_queue", "Starts waiting in the queue or running", ("status",))
+
+WORKING_SET = Gauge("instancer_working_set",
+                    "Instances being started or stopped", ("challenge",))
+BACKGROUND_TASKS = Gauge("instancer_background_tasks",
+                         "Tasks running in the background", ("kind",))
+LOOP_SECONDS = Histogram("instancer_loop_seconds",
+                         "Time a round of a background loop took", ("loop",))
+LOOP_FAILURES = Counter("instancer_loop_failures_total",
+                        "Rounds of a background loop that raised", ("loop",))
+POOL_READY = Gauge("instancer_pool_ready", "Pool instances ready to be claimed", ("challenge",))
+PORTS_FREE = Gauge("instancer_ports_free", "Ports left to allocate", ("server",))
+EVENT_SUBSCRIBERS = Gauge("instancer_event_subscribers", "Open /events streams")
@@ -0,0 +1,188 @@
+import asyncio
+import time
+
+from collections import Counter
+from logging import getLogger
+from typing import NamedTuple
+
+from webapp.metrics import LOOP_FAILURES, LOOP_SECONDS
+
+log = getLogger(__name__)
+
+# One command gathering everything a snapshot needs
+SNAPSHOT_CMD = "cat /proc/loadavg; nproc; grep -E '^(MemTotal|MemAvailable):' /proc/meminfo; " + \
+    "docker ps -q | wc -l"
+
+# What a starting instance is assumed to cost until the next snapshot shows it
+INSTANCE_LOAD = 0.5
+INSTANCE_MEMORY = 256 * 1024  # kB
+
+# Utilisation above which bin-packing moves on to the next server
+PACKING_THRESHOLD = 0.8
+# Servers with the challenge images already built are preferred by every
+# policy, unless they are busier than this
+WARM_THRESHOLD = 0.8
+
+
+class Snapshot(NamedTuple):
+    load: float
+    cpus: int
+    mem_total: int  # kB
+    mem_available: int  # kB
+    containers: int
+    taken_at: float
+
+
+def parse_snapshot(output: str) -> Snapshot:
+    lines = output.splitlines()
+    load = float(lines[0].split()[0])
+    cpus = max(1, int(lines[1]))
+    memory = {}
+    for line in lines[2:4]:
+        key, value = line.split(":", 1)
+        memory[key] = int(value.split()[0])
+    containers = int(lines[4])
+    return Snapshot(load, cpus, memory["MemTotal"], memory["MemAvailable"],
+                    containers, time.monotonic())
+
+
+class Candidate(NamedTuple):
+    server: object
+    snapshot: Snapshot
+    # placements handed out but not started yet
+    pending: int
+    free_ports: int
+    # the challenge images are built on the server
+    warm: bool = False
+
+    @property
+    def instances(self) -> int:
+        return self.snapshot.containers + self.pending
+
+    @property
+    def utilisation(self) -> float:
+        snapshot = self.snapshot
+        cpu = (snapshot.load + self.pending * INSTANCE_LOAD) / snapshot.cpus
+        memory = 1 - (snapshot.mem_available - self.pending * INSTANCE_MEMORY) / snapshot.mem_total
+        return max(cpu, memory)
+
+    @property
+    def cold(self) -> bool:
+        # Starting here would first pull and build the images
+        return not self.warm or self.utilisation >= WARM_THRESHOLD
+
+
+POLICIES = {}
+
+
+def policy(name: str):
+    def register(fn):
+        POLICIES[name] = fn
+        return fn
+    return register
+
+
+@policy("least-loaded")
+def least_loaded(candidates: list[Candidate], challenge, affinity) -> Candidate:
+    return min(candidates, key=lambda c: (c.cold, c.utilisation))
+
+
+@policy("spread")
+def spread(candidates: list[Candidate], challenge, affinity) -> Candidate:
+    return min(candidates, key=lambda c: (c.instances, c.cold, c.utilisation))
+
+
+@policy("bin-packing")
+def bin_packing(candidates: list[Candidate], challenge, affinity) -> Candidate:
+    # Fill up the busiest server that still has room, so idle servers stay
+    # idle (and can be scaled down)
+    fitting = [c for c in candidates if c.utilisation < PACKING_THRESHOLD]
+    if len(fitting) == 0:
+        return least_loaded(candidates, challenge, affinity)
+    return max(fitting, key=lambda c: (not c.cold, c.utilisation))
+
+
+@policy("affinity")
+def affinity_policy(candidates: list[Candidate], challenge, affinity) -> Candidate:
+    # Prefer the servers configured for the challenge, any server otherwise
+    name = None if challenge is None else challenge.name
+    preferred = [c for c in candidates if c.server.hostname in affinity.get(name, [])]
+    return least_loaded(preferred if len(preferred) > 0 else candidates, challenge, affinity)
+
+
+class Placement:
+    def __init__(self, executor, options: dict) -> None:
+        self.policy = options.get("policy", "least-loaded")
+        if self.policy not in POLICIES:
+            raise ValueError(f"unknown placement policy '{self.policy}', " +
+                             f"expected one of {', '.join(POLICIES)}")
+        self.executor = executor
+        self.interval = options.get("interval", 15)
+        self.affinity = options.get("affinity", {})
+        # hostname -> last Snapshot
+        self.snapshots = {}
+        self.pending = Counter()
+        self.lock = asyncio.Lock()
+
+    async def snapshot(self, server):
+        output = await self.executor.run(server, SNAPSHOT_CMD, timeout=5, lane="probe")
+        if output is None:
+            self.snapshots.pop(server.hostname, None)
+            return
+        try:
+            self.snapshots[server.hostname] = parse_snapshot(output)
+        except (ValueError, IndexError, KeyError) as e:
+            log.warning(f"[{server.hostname}]\tcould not parse resource snapshot: {e}")
+            self.snapshots.pop(server.hostname, None)
+
+    async def refresh(self):
+        await asyncio.gather(
+            *[self.snapshot(server) for server in self.executor.config.servers]
+        )
+
+    async def run(self):
+        while True:
+            try:
+                with LOOP_SECONDS.time("placement"):
+                    await self.refresh()
+            except Exception as e:
+                LOOP_FAILURES.inc("placement")
+                log.warning(f"Something went wrong while taking resource snapshots: {e}")
+            await asyncio.sleep(self.interval)
+
+    def candidates(self, challenge=None) -> list[Candidate]:
+        now = time.monotonic()
+        candidates = []
+        for server in self.executor.config.servers:
+            snapshot = self.snapshots.get(server.hostname)
+            # A server without a recent snapshot did not answer, skip it
+            if snapshot is None or now - snapshot.taken_at > 3 * self.interval:
+                continue
+            if server.free_ports() <= 0 or server.draining:
+                continue
+            warm = challenge is not None and self.executor.warmup.is_warm(server, challenge)
+            candidates.append(Candidate(server, snapshot, self.pending[server.hostname],
+                                        server.free_ports(), warm))
+        return candidates
+
+    async def choose(self, challenge=None):
+        if len(self.candidates(challenge)) == 0:
+            await self.refresh()
+
+        # Choosing and counting the placement as pending happens at once, so
+        # a burst of starts spreads out instead of picking the same server
+        async with self.lock:
+            candidates = self.candidates(challenge)
+            if len(candidates) == 0:
+                return None
+            chosen = POLICIES[self.policy](candidates, challenge, self.affinity)
+            self.pending[chosen.server.hostname] += 1
+            log.info(f"[{chosen.server.hostname}]\tplaced {'' if challenge is None else challenge.name} " +
+                     f"({self.policy}, utilisation {chosen.utilisation:.2f}, {chosen.instances} instances)")
+            return chosen.server
+
+    def release(self, server):
+        # Called once the instance started (or failed to), from then on the
+        # snapshots account for it
+        if self.pending[server.hostname] > 0:
+            self.pending[server.hostname] -= 1
@@ -0,0 +1,224 @@
+import asyncio
+import math
+import secrets
+import time
+
+from collections import deque
+from logging import getLogger
+
+from webapp.database import ChallengeState
+from webapp.metrics import LOOP_FAILURES
+
+log = getLogger(__name__)
+
+# user_id, and so compose project, of the instances started ahead of time
+POOL_PREFIX = "pool-"
+
+# Latencies kept per challenge to report on and to size the pool with
+LATENCY_SAMPLES = 200
+# Assumed time to start an instance until one was measured
+DEFAULT_COLD_START = 30
+
+
+def percentile(samples, fraction) -> float | None:
+    if len(samples) == 0:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+class WarmPool:
+    def __init__(self, challenge, minimum: int, maximum: int, window: float) -> None:
+        self.challenge = challenge
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        # pool ids of running instances, oldest first
+        self.ready = deque()
+        self.filling = 0
+        # when start requests came in over the last window
+        self.starts = deque()
+        self.claims = deque(maxlen=LATENCY_SAMPLES)
+        self.cold_starts = deque(maxlen=LATENCY_SAMPLES)
+
+    def rate(self, now: float) -> float:
+        while len(self.starts) > 0 and now - self.starts[0] > self.window:
+            self.starts.popleft()
+        return len(self.starts) / self.window
+
+    def target(self, now: float) -> int:
+        if self.maximum <= 0:
+            return 0
+        # Enough instances to serve the starts coming in while a replacement
+        # is being started, within the configured bounds
+        cold_start = percentile(self.cold_starts, 0.5) or DEFAULT_COLD_START
+        wanted = math.ceil(self.rate(now) * cold_start)
+        return max(self.minimum, min(self.maximum, wanted))
+
+
+class Pools:
+    def __init__(self, executor, options: dict) -> None:
+        self.executor = executor
+        self.options = options
+        self.interval = options.get("interval", 10)
+        self.window = options.get("window", 600)
+        # pool instances being started at once, so refills don't crowd out
+        # the starts users are waiting for
+        self.parallel = asyncio.Semaphore(options.get("parallel", 2))
+        self.pools = {}
+        self.wakeup = asyncio.Event()
+        self.tasks = set()
+
+    def pool(self, challenge) -> WarmPool:
+        pool = self.pools.get(challenge.name)
+        if pool is None:
+            override = self.options.get("challenges", {}).get(challenge.name, {})
+            pool = self.pools[challenge.name] = WarmPool(
+                challenge,
+                override.get("min", self.options.get("min", 0)),
+                override.get("max", self.options.get("max", 0)),
+                self.window,
+            )
+        return pool
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def record_cold_start(self, challenge, seconds: float):
+        self.pool(challenge).cold_starts.append(seconds)
+
+    async def claim(self, challenge, user_id: str) -> bool:
+        begin = time.monotonic()
+        pool = self.pool(challenge)
+        pool.starts.append(begin)
+        self.wakeup.set()
+
+        db = self.executor.config.database
+        while len(pool.ready) > 0:
+            # Taken off the pool before anything is awaited, so no two users
+            # can end up with the same instance
+            pool_id = pool.ready.popleft()
+            instance = await ChallengeState(db, challenge.name, pool_id).fetch()
+            if instance is None or instance.state != "running":
+                log.info(f"pool instance {pool_id} of {challenge.name} went down, discarding it")
+                self.spawn(self.remove(challenge, pool_id))
+                continue
+
+            # The claimed row replaces the user's earlier one, e.g. a failed
+            # start, whose port and compose project are given back
+            state = ChallengeState(db, challenge.name, user_id)
+            previous = await state.fetch()
+            # The lifetime of the instance starts now
+            await state.claim(pool_id, **self.executor.lifetime.deadlines(challenge))
+            if previous is not None:
+                self.spawn(self.discard(challenge, user_id, previous))
+            pool.claims.append(time.monotonic() - begin)
+            log.info(f"claimed pool instance {pool_id} of {challenge.name} for {user_id}, " +
+                     f"{len(pool.ready)} left")
+            return True
+        return False
+
+    async def fill(self, pool: WarmPool):
+        challenge = pool.challenge
+        pool_id = POOL_PREFIX + secrets.token_hex(6)
+        state = ChallengeState(self.executor.config.database, challenge.name, pool_id)
+        try:
+            async with self.parallel:
+                await challenge.start(self.executor, pool_id)
+                instance = await state.fetch()
+                # Not up yet when the start probed it
+                if instance is not None and instance.state == "starting":
+                    await challenge.retrieve_state(self.executor, pool_id)
+            instance = await state.fetch()
+            if instance is not None and instance.state == "running":
+                pool.ready.append(pool_id)
+                return
+            log.warning(f"pool instance {pool_id} of {challenge.name} did not come up")
+            await self.remove(challenge, pool_id)
+        except Exception as e:
+            log.warning(f"Something went wrong while starting pool instance of {challenge.name}: {e}")
+        finally:
+            pool.filling -= 1
+
+    async def remove(self, challenge, pool_id: str):
+        state = ChallengeState(self.executor.config.database, challenge.name, pool_id)
+        instance = await state.fetch()
+        if instance is None:
+            return
+        if instance.server is None:
+            await state.delete()
+            return
+        await challenge.stop(self.executor, pool_id)
+
+    async def discard(self, challenge, user_id: str, instance):
+        servers = self.executor.config.servers
+        if instance.server is None or instance.server >= len(servers):
+            return
+        server = servers[instance.server]
+        project = user_id if instance.project is None else instance.project
+        # Torn down before the port is handed out again
+        result = await self.executor.run(server, challenge.destroy_command(server, project))
+        if result is None:
+            log.warning(f"[{server.hostname}]\tdestroy.sh of the replaced {challenge.name} {project} failed")
+        if instance.port is not None:
+            await self.executor.cluster.free_port(server, instance.port)
+
+    async def load(self):
+        # Pool instances survive a restart, pick the running ones up again
+        instances = await self.executor.config.database.instances_of(POOL_PREFIX)
+        for name, pool_id, instance in instances:
+            challenge = self.executor.config.challenges.get(name)
+            if challenge is None:
+                continue
+            if instance.state == "running":
+                self.pool(challenge).ready.append(pool_id)
+            else:
+                self.spawn(self.remove(challenge, pool_id))
+        log.info(f"picked up {sum(len(pool.ready) for pool in self.pools.values())} pool instances")
+
+    def top_up(self):
+        now = time.monotonic()
+        for challenge in self.executor.config.challenges.values():
+            pool = self.pool(challenge)
+            # A removed challenge gives its pool back
+            target = 0 if challenge.removed else pool.target(now)
+            missing = target - len(pool.ready) - pool.filling
+            for _ in range(missing):
+                pool.filling += 1
+                self.spawn(self.fill(pool))
+            # Shrink by one instance per round, so a short lull doesn't throw
+            # the whole pool away
+            if len(pool.ready) > target:
+                self.spawn(self.remove(challenge, pool.ready.popleft()))
+
+    async def run(self):
+        await self.load()
+        while True:
+            try:
+                self.top_up()
+            except Exception as e:
+                LOOP_FAILURES.inc("pools")
+                log.warning(f"Something went wrong while topping up the pools: {e}")
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except TimeoutError:
+                pass
+
+    def stats(self) -> dict[str, dict]:
+        now = time.monotonic()
+        stats = {}
+        for name, pool in self.pools.items():
+            stats[name] = {
+                "target": pool.target(now),
+                "ready": len(pool.ready),
+                "filling": pool.filling,
+                "starts_per_minute": pool.rate(now) * 60,
+                "claim_p50": percentile(pool.claims, 0.5),
+                "claim_p95": percentile(pool.claims, 0.95),
+                "cold_start_p50": percentile(pool.cold_starts, 0.5),
+                "cold_start_p95": percentile(pool.cold_starts, 0.95),
+            }
+        return stats
@@ -17,3 +17,51 @@ class Port:
             log.warning(f"Hardcoded port on the host specified in '{ports}' for challenge {challenge_name}, " +
                         "WILL cause problems when deploying and running out of ports")
         self.port = parts[-1]
+
+
+class PortAllocator:
+    # One byte per port in [first, last], allocation continues from the last
+    # handed out port and wraps around, so a freed port isn't reused right away
+    def __init__(self, first: int, last: int) -> None:
+        if first > last:
+            raise ValueError(f"empty port range {first}-{last}")
+        self.first = first
+        self.last = last
+        self.used = bytearray(last - first + 1)
+        self.count = 0
+        self.cursor = 0
+
+    def __contains__(self, port: int) -> bool:
+        return self.first <= port <= self.last and self.used[port - self.first] == 1
+
+    def available(self) -> int:
+        return len(self.used) - self.count
+
+    def alloc(self) -> int | None:
+        index = self.used.find(0, self.cursor)
+        if index == -1:
+            index = self.used.find(0, 0, self.cursor)
+        if index == -1:
+            return None
+        self.used[index] = 1
+        self.count += 1
+        self.cursor = (index + 1) % len(self.used)
+        return self.first + index
+
+    def reserve(self, port: int) -> bool:
+        # Marks a port taken by something else, e.g. an instance from before
+        # a restart. Returns False if it was already taken.
+        if not self.first <= port <= self.last:
+            return False
+        if self.used[port - self.first] == 1:
+            return False
+        self.used[port - self.first] = 1
+        self.count += 1
+        return True
+
+    def free(self, port: int):
+        if port not in self:
+            log.warning(f"free_port: double free detected on port {port}")
+            return
+        self.used[port - self.first] = 0
+        self.count -= 1
@@ -0,0 +1,78 @@
+import asyncio
+import random
+
+from logging import getLogger
+
+from webapp.database import ChallengeState
+from webapp.metrics import LOOP_FAILURES, LOOP_SECONDS
+
+log = getLogger(__name__)
+
+# Instances in these states are expected to be up on their server
+PROBED_STATES = ["starting", "running"]
+
+
+class Prober:
+    def __init__(self, config, executor, interval: float = 30, rate: float = 20,
+                 concurrency: int = 8, jitter: float = 0.2) -> None:
+        self.config = config
+        self.executor = executor
+        self.interval = interval
+        self.rate = rate
+        self.jitter = jitter
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.tasks = set()
+
+    async def probe(self, challenge, user_id: str, instance):
+        state = ChallengeState(self.config.database, challenge.name, user_id)
+        server = self.config.servers[instance.server]
+        async with self.semaphore:
+            try:
+                result = await challenge.probe(self.executor, server, instance.port)
+                if result is None or len(result) == 0:
+                    log.info(f"[{server.hostname}]\tprobe of {challenge.name} {user_id} failed")
+                    return
+                # A start or stop that began meanwhile owns the state
+                if user_id in await challenge.working_set.members():
+                    return
+                # A probe never takes a start back, run.sh may still be going
+                await challenge.parse_test_output(result, state, downgrade=instance.state != "starting")
+            except Exception as e:
+                log.warning(f"[{server.hostname}]\tprobing {challenge.name} {user_id} failed: {e}")
+
+    async def probe_all(self):
+        instances = await self.config.database.instances(PROBED_STATES)
+        random.shuffle(instances)
+        log.info(f"probing {len(instances)} instances")
+
+        # Users being started or stopped, by any replica in cluster mode
+        busy = {}
+        for name, user_id, instance in instances:
+            challenge = self.config.challenges.get(name)
+            if challenge is None or instance.port is None:
+                continue
+            if name not in busy:
+                busy[name] = await challenge.working_set.members()
+            if user_id in busy[name]:
+                continue
+            if instance.server is None or instance.server >= len(self.config.servers):
+                continue
+
+            task = asyncio.create_task(self.probe(challenge, user_id, instance))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            # Spread the probes out instead of hitting every server at once
+            await asyncio.sleep(1 / self.rate)
+
+    async def run(self):
+        # Start at a random offset so probing doesn't line up with the other
+        # periodic work started at the same time
+        await asyncio.sleep(random.uniform(0, self.interval * self.jitter))
+        while True:
+            try:
+                with LOOP_SECONDS.time("probe"):
+                    await self.probe_all()
+            except Exception as e:
+                LOOP_FAILURES.inc("probe")
+                log.warning(f"Something went wrong while probing instances: {e}")
+            await asyncio.sleep(self.interval * random.uniform(1 - self.jitter, 1 + self.jitter))
@@ -0,0 +1,185 @@
+import asyncio
+import time
+
+from logging import getLogger
+from typing import NamedTuple
+
+from webapp.metrics import LOOP_FAILURES, LOOP_SECONDS
+from webapp.warmup import WARMUP_PROJECT
+
+log = getLogger(__name__)
+
+
+class Project(NamedTuple):
+    challenge: str
+    name: str
+    running: bool
+
+
+class Inventory:
+    def __init__(self) -> None:
+        # hostname -> {(challenge, project): Project}
+        self.servers = {}
+        self.taken_at = None
+
+    def locate(self, challenge: str, project: str) -> list[str]:
+        return [hostname for hostname, projects in self.servers.items()
+                if (challenge, project) in projects]
+
+
+class Reconciler:
+    def __init__(self, executor, options: dict) -> None:
+        self.executor = executor
+        self.interval = options.get("interval", 300)
+        # Tear down compose projects of known challenges without a row,
+        # after they showed up in two rounds in a row
+        self.gc_orphans = options.get("gc_orphans", False)
+        self.inventory = Inventory()
+        self.orphans = set()
+        self.lock = asyncio.Lock()
+
+    def challenge_dirs(self) -> dict[str, str]:
+        # "<challenge path>/Source" -> challenge name
+        return {f"{challenge.path.strip('/')}/Source": name
+                for name, challenge in self.executor.config.challenges.items()}
+
+    def identify(self, config_files: str, dirs: dict[str, str]) -> str | None:
+        # The compose file lives in <server path or a release>/<challenge path>/Source,
+        # match on the longest suffix that is a known challenge
+        parts = config_files.split(",")[0].split("/")[:-1]
+        for start in range(len(parts)):
+            name = dirs.get("/".join(parts[start:]))
+            if name is not None:
+                return name
+        return None
+
+    async def refresh(self) -> Inventory:
+        listing = await self.executor.current_challenges()
+        dirs = self.challenge_dirs()
+        inventory = Inventory()
+        for hostname, projects in listing.items():
+            if projects is None:
+                continue
+            found = {}
+            for project in projects:
+                if project.get("Name") == WARMUP_PROJECT:
+                    continue
+                challenge = self.identify(project.get("ConfigFiles", ""), dirs)
+                if challenge is None:
+                    continue
+                found[(challenge, project["Name"])] = Project(
+                    challenge, project["Name"], "running" in project.get("Status", ""))
+            inventory.servers[hostname] = found
+        inventory.taken_at = time.time()
+        self.inventory = inventory
+        return inventory
+
+    async def reconcile(self):
+        async with self.lock:
+            await self.diff()
+
+    async def diff(self):
+        servers = self.executor.config.servers
+        challenges = self.executor.config.challenges
+        # Users being started or stopped, by any replica in cluster mode.
+        # Read before the rows and the rows before the listing, so the
+        # listing is never older than what it is compared with.
+        busy = {name: await challenge.working_set.members() for name, challenge in list(challenges.items())}
+        rows = await self.executor.config.database.instances()
+        inventory = await self.refresh()
+
+        changes = []
+        known = set()
+        for name, user_id, instance in rows:
+            project = user_id if instance.project is None else instance.project
+            challenge = challenges.get(name)
+            if challenge is None or user_id in busy[name]:
+                # Being started or stopped right now, the listing may be outdated
+                if instance.server is not None and instance.server < len(servers):
+                    known.add((servers[instance.server].hostname, name, project))
+                continue
+
+            recorded = None
+            if instance.server is not None and instance.server < len(servers):
+                recorded = servers[instance.server].hostname
+            if recorded is not None and recorded not in inventory.servers:
+                # The server didn't answer, nothing to compare with
+                known.add((recorded, name, project))
+                continue
+
+            found = None
+            if recorded is not None and (name, project) in inventory.servers[recorded]:
+                found = recorded
+            else:
+                hostnames = inventory.locate(name, project)
+                if len(hostnames) > 0:
+                    found = hostnames[0]
+
+            if found is None:
+                if instance.state == "running":
+                    changes.append((name, user_id, {"state": "stopped",
+                                                    "reason": "challenge not found on a server"}))
+                continue
+
+            known.add((found, name, project))
+            updates = {}
+            if found != recorded:
+                updates["server"] = next(i for i, server in enumerate(servers)
+                                         if server.hostname == found)
+                # The port moves along with the instance
+                if instance.port is not None:
+                    if recorded is not None:
+                        await self.executor.cluster.move_port(servers[instance.server],
+                                                              servers[updates["server"]], instance.port)
+                    else:
+                        servers[updates["server"]].ports.reserve(instance.port)
+            running = inventory.servers[found][(name, project)].running
+            if instance.state == "running" and not running:
+                updates["state"] = "stopped"
+                updates["reason"] = "containers exited"
+            elif instance.state == "stopped" and running:
+                updates["state"] = "running"
+                updates["reason"] = ""
+            if len(updates) > 0:
+                changes.append((name, user_id, updates))
+
+        await self.executor.config.database.update_many(changes)
+
+        orphans = {(hostname, project.challenge, project.name)
+                   for hostname, projects in inventory.servers.items()
+                   for project in projects.values()} - known
+        log.info(f"reconciled {len(rows)} instances on {len(inventory.servers)} servers: " +
+                 f"{len(changes)} fixed, {len(orphans)} orphaned projects")
+        if self.gc_orphans:
+            await self.collect(orphans & self.orphans)
+        elif len(orphans) > 0:
+            log.info(f"orphaned projects: {sorted(orphans)[:10]}")
+        self.orphans = orphans
+
+    async def collect(self, orphans: set):
+        # One command per server tearing down all of its orphans
+        challenges = self.executor.config.challenges
+        per_server = {}
+        for hostname, challenge, project in orphans:
+            per_server.setdefault(hostname, []).append((challenges[challenge], project))
+
+        async def collect_on(server, group):
+            cmd = " ; ".join(f"( {challenge.destroy_command(server, project)} ) >/dev/null 2>&1"
+                             for challenge, project in group)
+            log.info(f"[{server.hostname}]\tremoving {len(group)} orphaned projects")
+            if await self.executor.run(server, cmd) is None:
+                log.warning(f"[{server.hostname}]\tremoving orphaned projects failed")
+
+        await asyncio.gather(*[collect_on(server, per_server[server.hostname])
+                               for server in self.executor.config.servers
+                               if server.hostname in per_server])
+
+    async def run(self):
+        while True:
+            try:
+                with LOOP_SECONDS.time("reconcile"):
+                    await self.reconcile()
+            except Exception as e:
+                LOOP_FAILURES.inc("reconcile")
+                log.warning(f"Something went wrong while reconciling instances: {e}")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,161 @@
+import asyncio
+import os
+import time
+
+from logging import getLogger
+
+from webapp.index import challenge_dir, scan
+from webapp.metrics import LOOP_FAILURES, LOOP_SECONDS
+
+log = getLogger(__name__)
+
+
+def summary(changes: dict) -> str:
+    parts = [f"{len(names)} {kind} {what}"
+             for kind in ("servers", "challenges")
+             for what, names in changes[kind].items() if len(names) > 0]
+    return ", ".join(parts) or "nothing changed"
+
+
+class ConfigWatcher:
+    # Notices edits of config.toml and the challenge repo and applies them to
+    # the config in place. Polls instead of waiting for filesystem events:
+    # only file stats are read, the same way the challenge index tells a
+    # changed challenge directory.
+    def __init__(self, config, interval: float = 30) -> None:
+        self.config = config
+        # seconds between checks, 0 only checks when forced
+        self.interval = interval
+        self.lock = asyncio.Lock()
+        # (mtime of config.toml, fingerprint of every challenge directory)
+        self.seen = None
+
+    def fingerprint(self) -> tuple[int | None, dict[str, str]]:
+        config = self.config
+        depths = {len(challenge_dir(config.challenge_path, challenge).split("/"))
+                  for challenge in list(config.challenges.values())}
+        try:
+            mtime = os.stat(config.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        return mtime, scan(config.challenge_path, depths)
+
+    async def check(self, force: bool = False) -> dict | None:
+        # The changes made, None when nothing changed since the last check
+        async with self.lock:
+            seen = await asyncio.to_thread(self.fingerprint)
+            if self.seen is None and not force:
+                self.seen = seen
+                return None
+            if (seen == self.seen or self.interval <= 0) and not force:
+                return None
+
+            # Parsing may take a while, the config in use is only touched
+            # once it is done
+            servers, challenges = await asyncio.to_thread(self.config.load)
+            dirs = {} if self.seen is None else self.seen[1]
+            self.seen = seen
+            changes = self.config.apply(servers, challenges)
+            changes["files"] = sorted(rel for rel in dirs.keys() | seen[1].keys()
+                                      if dirs.get(rel) != seen[1].get(rel))
+            log.info(f"reloaded {self.config.path} and {self.config.challenge_path}: {summary(changes)}")
+            return changes
+
+    async def run(self):
+        if self.interval <= 0:
+            return
+        await self.check()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                with LOOP_SECONDS.time("reload"):
+                    await self.check()
+            except Exception as e:
+                LOOP_FAILURES.inc("reload")
+                log.warning(f"Something went wrong while reloading the config: {e}")
+
+
+class Reloader:
+    # The watcher of the executor, which also brings the servers up to date
+    # with what changed. Every replica reloads its config, only the leader
+    # syncs.
+    def __init__(self, executor, options: dict) -> None:
+        self.executor = executor
+        self.watcher = ConfigWatcher(executor.config, options.get("interval", 30))
+        # seconds between syncs of every server whether anything changed or
+        # not, repairing servers changed behind our back, 0 is never
+        self.resync = options.get("resync", 300)
+        self.synced_at = time.monotonic()
+
+    async def reload(self, force: bool = False) -> dict:
+        changes = await self.watcher.check(force)
+        if changes is not None:
+            await self.apply(changes)
+        synced = await self.sync(changes)
+        if changes is None:
+            changes = {"servers": {}, "challenges": {}, "files": []}
+        changes["synced"] = synced
+        return changes
+
+    async def apply(self, changes: dict):
+        executor = self.executor
+        config = executor.config
+        servers = {server.hostname: server for server in config.servers}
+
+        for name in changes["challenges"]["added"]:
+            executor.cluster.track(config.challenges[name])
+        for name in changes["challenges"]["removed"]:
+            log.info(f"[{name}]\tremoved, running instances are left until they are stopped")
+
+        for hostname in changes["servers"]["changed"]:
+            # Commands in flight finish on the old lanes, new ones queue on
+            # lanes of the new size. A server that moved is synced again.
+            executor.schedulers.pop(hostname, None)
+            executor.python_paths.pop(hostname, None)
+            executor.sync.results.pop(hostname, None)
+        for hostname in changes["servers"]["added"]:
+            server = servers[hostname]
+            if executor.cluster.enabled:
+                await executor.cluster.load_ports(server)
+            await executor.reserve_listening(server, set())
+        for hostname in changes["servers"]["removed"]:
+            log.info(f"[{hostname}]\tdraining, running instances are left until they are stopped")
+
+        if len(changes["servers"]["added"]) + len(changes["servers"]["changed"]) > 0:
+            await executor.placement.refresh()
+
+    async def sync(self, changes: dict | None) -> list[str]:
+        # The sync sends the difference to what a server has, so a changed
+        # challenge only costs its own files. Servers that failed or never
+        # synced are retried.
+        executor = self.executor
+        if not executor.cluster.leader:
+            return []
+        servers = [server for server in executor.config.servers if not server.draining]
+        full = changes is not None and len(changes["files"]) > 0
+        if self.resync > 0 and time.monotonic() - self.synced_at >= self.resync:
+            full = True
+        if not full:
+            results = executor.sync.results
+            servers = [server for server in servers
+                       if server.hostname not in results or not results[server.hostname].ok]
+        else:
+            self.synced_at = time.monotonic()
+        if len(servers) > 0:
+            await executor.create_enviroment(servers)
+        return [server.hostname for server in servers]
+
+    async def run(self):
+        # Without polling there is still the resync
+        period = self.watcher.interval if self.watcher.interval > 0 else self.resync
+        if period <= 0:
+            return
+        await self.watcher.check()
+        while True:
+            await asyncio.sleep(period)
+            try:
+                with LOOP_SECONDS.time("reload"):
+                    await self.reload()
+            except Exception as e:
+                LOOP_FAILURES.inc("reload")
+                log.warning(f"Something went wrong while reloading the config: {e}")
@@ -1,5 +1,6 @@
 from fabric import Connection
 from logging import getLogger
+from webapp.port import PortAllocator
 
 log = getLogger(__name__)
 
@@ -8,40 +9,65 @@ START_PORT_RANGE = 1024
 
 
 class Server:
-    def __init__(self, hostname, ip, port, user, path):
+    def __init__(self, hostname, ip, port, user, path, max_sessions=8, probe_sessions=2,
+                 ports=(START_PORT_RANGE, END_PORT_RANGE - 1)):
         self.hostname = hostname
         self.ip = ip
         self.port = port
         self.user = user
         self.path = path
-        self.portlist = set()
-        self.last_alloced_port = START_PORT_RANGE
-        self.connection = None    
+        # Commands in flight at most, of which probe_sessions are reserved
+        # for cheap status probes
+        self.max_sessions = max_sessions
+        self.probe_sessions = probe_sessions
+        self.ports = PortAllocator(*ports)
+        self.keyfile = None
+        self._connection = None
+        # No new instances go here while the ones running on it are left
+        # alone, set with drain = true or by removing the server from
+        # config.toml while running. Removed servers stay in config.servers,
+        # instances refer to their server by index.
+        self.draining = False
+        # asyncssh only, off skips checking the host key of the server
+        self.host_key_check = True
 
     def connect(self, keyfile: str):
-        self.connection = Connection(f"{self.user}@{self.ip}:{self.port}", connect_kwargs={
-            "key_filename": keyfile
-        })
-    
-    def increment_port(self):
-        self.last_alloced_port += 1
-        if self.last_alloced_port >= END_PORT_RANGE:
-            self.last_alloced_port = START_PORT_RANGE
-        return self.last_alloced_port
-    
-    def alloc_port(self):
-        self.last_alloced_port = self.increment_port()
-        
-        while self.last_alloced_port in self.portlist:
-            self.increment_port()
-        
-        self.portlist.add(self.last_alloced_port)
-        return self.last_alloced_port
+        # Only remembers the key, see connection
+        self.keyfile = keyfile
+        self._connection = None
+
+    @property
+    def connection(self) -> Connection:
+        # Created on first use, setting up a Connection reads the ssh config
+        # and there may be many servers
+        if self._connection is None:
+            self._connection = Connection(f"{self.user}@{self.ip}:{self.port}", connect_kwargs={
+                "key_filename": self.keyfile
+            })
+        return self._connection
+
+    def update(self, other) -> list[str]:
+        # Takes over the settings of the same server read again from
+        # config.toml, returns what changed
+        changed = [name for name in ("ip", "port", "user", "path", "max_sessions", "probe_sessions",
+                                     "draining", "host_key_check")
+                   if getattr(self, name) != getattr(other, name)]
+        for name in changed:
+            setattr(self, name, getattr(other, name))
+        if len({"ip", "port", "user"} & set(changed)) > 0:
+            self._connection = None
+        if (other.ports.first, other.ports.last) != (self.ports.first, self.ports.last):
+            log.warning(f"[{self.hostname}]\tchanging the port range needs a restart")
+        return changed
+
+    def alloc_port(self) -> int | None:
+        return self.ports.alloc()
+
+    def free_ports(self) -> int:
+        return self.ports.available()
 
     def free_port(self, port):
-        if port in self.portlist:
-            log.warning(f"free_port: double free detected on port {port}")
-        self.portlist.remove(port)
+        self.ports.free(port)
 
 
 def parse_servers(hosts):
@@ -71,5 +97,29 @@ def parse_servers(hosts):
         if 'path' in host:
             path = str(host['path'])
 
-        servers.append(Server(hostname, host['ip'], port, user, path))
+        max_sessions = default.get("max_sessions", 8)
+        if 'max_sessions' in host:
+            max_sessions = int(host['max_sessions'])
+
+        probe_sessions = default.get("probe_sessions", 2)
+        if 'probe_sessions' in host:
+            probe_sessions = int(host['probe_sessions'])
+
+        ports = default.get("ports", [START_PORT_RANGE, END_PORT_RANGE - 1])
+        if 'ports' in host:
+            ports = host['ports']
+        if len(ports) != 2 or int(ports[0]) > int(ports[1]):
+            log.warning(f"host {hostname} has an invalid port range {ports}, skipping...")
+            continue
+
+        if probe_sessions >= max_sessions:
+            log.warning(f"host {hostname} reserves all {max_sessions} sessions for probes, " +
+                        "leaving one for other commands")
+            probe_sessions = max_sessions - 1
+
+        server = Server(hostname, host['ip'], port, user, path,
+                        max_sessions, probe_sessions, (int(ports[0]), int(ports[1])))
+        server.draining = bool(host.get("drain", False))
+        server.host_key_check = bool(host.get("host_key_check", default.get("host_key_check", True)))
+        servers.append(server)
     return servers
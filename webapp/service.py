@@ -0,0 +1,455 @@
+import asyncio
+import json
+import math
+import os
+import stat
+
+from asyncio import create_task
+from logging import getLogger
+
+from webapp import metrics
+from webapp.admission import Rejected
+from webapp.challenge import stop_many
+from webapp.database import ChallengeState, Instance
+
+log = getLogger(__name__)
+
+# Operations API workers may ask of the executor service
+OPS = {"start", "stop", "extend", "refresh", "touch", "pools", "batch_start", "batch_stop",
+       "report", "metrics", "reload"}
+
+# Bytes a single request or reply may take, /metrics is the largest
+LIMIT = 64 * 1024 * 1024
+
+background_tasks = set()
+
+
+def spawn(coro):
+    task = create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+def describe(config, challenge, instance) -> dict:
+    r = {
+        "state": 'not started',
+    }
+    if instance is not None:
+        # An API worker's config may not know a server added by a reload yet
+        if instance.server is not None and instance.server < len(config.servers):
+            server_ip = config.servers[ instance.server ].ip
+        else:
+            server_ip = ""
+        r['state'] = instance.state
+        if instance.state == "running":
+            r['url'] = challenge.url.replace("{{PORT}}", str(instance.port)).replace("{{IP}}", server_ip)
+        if instance.state == "failed":
+            r['reason'] = instance.reason
+        if instance.checked_at is not None:
+            r['checked_at'] = instance.checked_at
+        if instance.expires_at is not None:
+            r['expires_at'] = instance.expires_at
+    return r
+
+
+async def select(config, instances: list, user_id: str | None = None, challenge: str | None = None):
+    # Answers from a single query, pairs without a row come back as None
+    challenges = config.challenges
+    rows = await config.database.select([(name, user) for user, name in instances], user_id, challenge)
+    found = {(user, name): instance for name, user, instance in rows}
+    for user, name in instances:
+        found.setdefault((user, name), None)
+    return [(user, challenges[name], instance) for (user, name), instance in found.items()
+            if name in challenges]
+
+
+class Service:
+    # Everything the API asks of the executor. Runs in the process of the
+    # executor, API workers in other processes reach it through a
+    # ServiceServer. Results are plain JSON, they are sent as they are.
+    def __init__(self, config, executor, prober=None) -> None:
+        self.config = config
+        self.executor = executor
+        self.prober = prober
+        # worker -> request histogram it last reported
+        self.reports = {}
+
+    async def start(self, name: str, user_id: str, fresh: bool = False):
+        # Always answers {"state": ...}, like /status
+        executor = self.executor
+        challenge = self.config.challenges[name]
+        # Gone from the challenge repo, running instances can still be stopped
+        if challenge.removed:
+            return {"state": "failed", "reason": f"Challenge '{name}' not found"}
+
+        # The prober keeps the state up to date, only probe on request
+        if fresh:
+            await challenge.retrieve_state(executor, user_id)
+
+        state = await ChallengeState(self.config.database, name, user_id).get()
+        if state == "running":
+            await challenge.working_set.remove(user_id)
+            return {"state": "running"}
+
+        if await challenge.working_set.contains_or_insert(user_id):
+            if await executor.pools.claim(challenge, user_id):
+                await challenge.working_set.remove(user_id)
+                return {"state": "running"}
+
+            try:
+                ticket = await executor.starts.submit(challenge, user_id)
+            except Rejected:
+                await challenge.working_set.remove(user_id)
+                raise
+            return {"state": "starting", "position": ticket.position, "eta": ticket.eta}
+        ticket = executor.starts.ticket(challenge, user_id)
+        if ticket is not None:
+            return {"state": "starting", "position": ticket.position, "eta": ticket.eta}
+        # Being stopped, or started by another replica
+        return {"state": "busy"}
+
+    async def stop(self, name: str, user_id: str, fresh: bool = False):
+        challenge = self.config.challenges[name]
+        # The prober keeps the state up to date, only probe on request
+        if fresh:
+            await challenge.retrieve_state(self.executor, user_id)
+
+        state = await ChallengeState(self.config.database, name, user_id).get()
+        if state != "running":
+            await challenge.working_set.remove(user_id)
+            return ["not running"]
+
+        if await challenge.working_set.contains_or_insert(user_id):
+            spawn(challenge.stop(self.executor, user_id))
+            return ["stopping"]
+        return ["still working on it"]
+
+    async def extend(self, name: str, user_id: str):
+        challenge = self.config.challenges[name]
+        state = ChallengeState(self.config.database, name, user_id)
+        instance = await state.fetch()
+        if instance is None or instance.state not in ("starting", "running"):
+            return ["not running"]
+
+        expires_at = await self.executor.lifetime.extend(state, challenge, instance)
+        return {"expires_at": expires_at}
+
+    async def refresh(self, name: str, user_id: str):
+        await self.config.challenges[name].retrieve_state(self.executor, user_id)
+
+    async def touch(self, name: str, user_id: str):
+        state = ChallengeState(self.config.database, name, user_id)
+        await self.executor.lifetime.touch(state, self.config.challenges[name], await state.fetch())
+
+    async def pools(self):
+        return self.executor.pools.stats()
+
+    async def batch_start(self, instances: list):
+        # Only explicitly named pairs are started, filters select existing rows.
+        # Unlike stops, starts are not chained into one command per server:
+        # each one goes through the start queue, so a batch counts against
+        # the same limits and quotas as single starts, and is placed on its
+        # own. A chain of run.sh would also run one after another and hold a
+        # session of the server until the last one is up.
+        executor = self.executor
+        challenges = self.config.challenges
+        rows = await self.config.database.select([(name, user_id) for user_id, name in instances])
+        states = {(user_id, name): instance.state for name, user_id, instance in rows}
+
+        results = []
+        for user_id, name in instances:
+            if name not in challenges or challenges[name].removed:
+                results.append({"user_id": user_id, "challenge": name, "result": "not found"})
+                continue
+            challenge = challenges[name]
+            if states.get((user_id, name)) == "running":
+                result = "running"
+            elif not await challenge.working_set.contains_or_insert(user_id):
+                result = "still working on it"
+            elif await executor.pools.claim(challenge, user_id):
+                await challenge.working_set.remove(user_id)
+                result = "running"
+            else:
+                try:
+                    ticket = await executor.starts.submit(challenge, user_id)
+                except Rejected as e:
+                    await challenge.working_set.remove(user_id)
+                    results.append({"user_id": user_id, "challenge": name, "result": "rejected",
+                                    "reason": e.reason, "retry_after": max(1, math.ceil(e.retry_after))})
+                    continue
+                results.append({"user_id": user_id, "challenge": name, "result": "starting",
+                                "position": ticket.position, "eta": ticket.eta})
+                continue
+            results.append({"user_id": user_id, "challenge": name, "result": result})
+        return results
+
+    async def batch_stop(self, instances: list, user_id: str | None = None, challenge: str | None = None):
+        targets = []
+        results = []
+        for user, target, instance in await select(self.config, instances, user_id, challenge):
+            if instance is None or instance.state != "running":
+                result = "not running"
+            elif not await target.working_set.contains_or_insert(user):
+                result = "still working on it"
+            else:
+                targets.append((target, user, instance))
+                result = "stopping"
+            results.append({"user_id": user, "challenge": target.name, "result": result})
+
+        if len(targets) > 0:
+            spawn(stop_many(self.executor, targets))
+        return results
+
+    def follow(self, bus):
+        # The bus is this process's own, nothing to forward
+        pass
+
+    async def report(self, worker: str, requests: list):
+        # The request histogram of an API worker, /metrics adds them up
+        self.reports[worker] = requests
+
+    def collect_gauges(self):
+        # Sizes are read when scraped instead of being kept up to date on every change
+        config = self.config
+        executor = self.executor
+        metrics.WORKING_SET.reset()
+        for name, challenge in config.challenges.items():
+            metrics.WORKING_SET.set(len(challenge.working_set.challenges), name)
+        metrics.BACKGROUND_TASKS.set(len(background_tasks), "api")
+        metrics.START_QUEUE.set(executor.starts.queued(), "queued")
+        metrics.START_QUEUE.set(executor.starts.running(), "running")
+        metrics.BACKGROUND_TASKS.set(len(executor.pools.tasks), "pools")
+        if self.prober is not None:
+            metrics.BACKGROUND_TASKS.set(len(self.prober.tasks), "prober")
+        metrics.SSH_COMMANDS_ACTIVE.reset()
+        for hostname, lanes in executor.queue_depths().items():
+            for lane, (waiting, running) in lanes.items():
+                metrics.SSH_COMMANDS_ACTIVE.set(waiting, hostname, lane, "waiting")
+                metrics.SSH_COMMANDS_ACTIVE.set(running, hostname, lane, "running")
+        metrics.POOL_READY.reset()
+        for name, pool in executor.pools.pools.items():
+            metrics.POOL_READY.set(len(pool.ready), name)
+        metrics.PORTS_FREE.reset()
+        for server in config.servers:
+            metrics.PORTS_FREE.set(server.free_ports(), server.hostname)
+        if config.database.cache is not None:
+            metrics.CACHE_ENTRIES.set(len(config.database.cache))
+        metrics.EVENT_SUBSCRIBERS.set(config.database.events.count)
+
+    async def reload(self):
+        return await self.executor.reloader.reload(force=True)
+
+    async def metrics(self) -> str:
+        self.collect_gauges()
+        if len(self.reports) > 0:
+            metrics.HTTP_REQUESTS.merge(self.reports.values())
+        return metrics.render()
+
+
+class ServiceServer:
+    # Serves a Service to the API workers over a Unix socket, one JSON
+    # request or reply per line. Requests on a connection are answered as
+    # they finish, not in order. A connection that asks for "events" gets
+    # every state change instead, which the workers hand to their
+    # /events subscribers.
+    def __init__(self, service: Service, path: str) -> None:
+        self.service = service
+        self.path = path
+        self.listening = asyncio.Event()
+
+    async def run(self):
+        try:
+            if stat.S_ISSOCK(os.stat(self.path).st_mode):
+                os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        # Anyone who can connect can start and stop instances, the socket is
+        # only accessible to us from the moment it is created
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self.handle, self.path, limit=LIMIT)
+        finally:
+            os.umask(umask)
+        log.info(f"executor service listening on {self.path}")
+        self.listening.set()
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        answers = set()
+        try:
+            while line := await reader.readline():
+                request = json.loads(line)
+                if request["op"] == "events":
+                    await self.events(writer)
+                    return
+                task = create_task(self.answer(request, writer))
+                answers.add(task)
+                task.add_done_callback(answers.discard)
+        except (ConnectionError, ValueError) as e:
+            log.warning(f"Dropping connection of an API worker: {e}")
+        finally:
+            writer.close()
+
+    async def answer(self, request: dict, writer):
+        reply = {"id": request.get("id")}
+        try:
+            if request["op"] not in OPS:
+                raise ValueError(f"unknown operation {request['op']}")
+            reply["result"] = await getattr(self.service, request["op"])(**request.get("args", {}))
+        except Rejected as e:
+            reply["rejected"] = [e.reason, e.retry_after]
+        except Exception as e:
+            log.warning(f"Operation {request['op']} of an API worker failed: {e}")
+            reply["error"] = str(e)
+        # Notifications are not answered
+        if reply["id"] is not None and not writer.is_closing():
+            writer.write(json.dumps(reply).encode() + b"\n")
+
+    async def events(self, writer):
+        bus = self.service.config.database.events
+        with bus.subscribe() as subscriber:
+            while True:
+                # Instances are tuples, they arrive as lists
+                writer.write(json.dumps(await subscriber.next()).encode() + b"\n")
+                await writer.drain()
+
+
+class ServiceError(Exception):
+    pass
+
+
+class ServiceClient:
+    # What an API worker has instead of a Service, forwards every call to
+    # the ServiceServer of the executor process over a single connection
+    def __init__(self, path: str, report_interval: float = 5) -> None:
+        self.path = path
+        self.report_interval = report_interval
+        self.worker = str(os.getpid())
+        self.reader = None
+        self.writer = None
+        self.lock = None
+        # request id -> future of the reply
+        self.pending = {}
+        self.sequence = 0
+        self.reporter = None
+        self.follower = None
+
+    async def connect(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.writer is not None:
+                return
+            self.reader, self.writer = await asyncio.open_unix_connection(self.path, limit=LIMIT)
+            create_task(self.receive(self.reader, self.writer))
+            if self.reporter is None:
+                self.reporter = create_task(self.report_loop())
+
+    async def receive(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                reply = json.loads(line)
+                future = self.pending.pop(reply["id"], None)
+                if future is not None and not future.done():
+                    future.set_result(reply)
+        except (ConnectionError, ValueError) as e:
+            log.warning(f"Lost the connection to the executor service: {e}")
+        finally:
+            writer.close()
+            if self.writer is writer:
+                self.reader = self.writer = None
+            pending, self.pending = self.pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ServiceError("lost the connection to the executor service"))
+
+    async def call(self, op: str, **args):
+        await self.connect()
+        self.sequence += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[self.sequence] = future
+        self.writer.write(json.dumps({"id": self.sequence, "op": op, "args": args}).encode() + b"\n")
+        reply = await future
+        if "rejected" in reply:
+            raise Rejected(*reply["rejected"])
+        if "error" in reply:
+            raise ServiceError(reply["error"])
+        return reply["result"]
+
+    async def notify(self, op: str, **args):
+        await self.connect()
+        self.writer.write(json.dumps({"id": None, "op": op, "args": args}).encode() + b"\n")
+
+    async def start(self, name: str, user_id: str, fresh: bool = False):
+        return await self.call("start", name=name, user_id=user_id, fresh=fresh)
+
+    async def stop(self, name: str, user_id: str, fresh: bool = False):
+        return await self.call("stop", name=name, user_id=user_id, fresh=fresh)
+
+    async def extend(self, name: str, user_id: str):
+        return await self.call("extend", name=name, user_id=user_id)
+
+    async def refresh(self, name: str, user_id: str):
+        return await self.call("refresh", name=name, user_id=user_id)
+
+    async def touch(self, name: str, user_id: str):
+        # /status doesn't wait for the write
+        await self.notify("touch", name=name, user_id=user_id)
+
+    async def pools(self):
+        return await self.call("pools")
+
+    async def batch_start(self, instances: list):
+        return await self.call("batch_start", instances=instances)
+
+    async def batch_stop(self, instances: list, user_id: str | None = None, challenge: str | None = None):
+        return await self.call("batch_stop", instances=instances, user_id=user_id, challenge=challenge)
+
+    async def reload(self):
+        return await self.call("reload")
+
+    async def report(self):
+        await self.notify("report", worker=self.worker, requests=metrics.HTTP_REQUESTS.dump())
+
+    async def metrics(self) -> str:
+        # Reported first, so the worker that is scraped is up to date
+        await self.report()
+        return await self.call("metrics")
+
+    async def report_loop(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            try:
+                await self.report()
+            except OSError as e:
+                log.warning(f"Reporting metrics to the executor service failed: {e}")
+
+    def follow(self, bus):
+        # Forwards the state changes of the executor to this worker's
+        # /events subscribers, from the first subscriber on
+        if self.follower is None:
+            self.follower = create_task(self.forward(bus))
+
+    async def forward(self, bus):
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path, limit=LIMIT)
+                try:
+                    writer.write(b'{"op": "events"}\n')
+                    while line := await reader.readline():
+                        event = json.loads(line)
+                        if event["type"] == "resync":
+                            bus.resync()
+                            continue
+                        instance = event["instance"]
+                        bus.publish(event["challenge"], event["user_id"],
+                                    None if instance is None else Instance(*instance))
+                finally:
+                    writer.close()
+            except (OSError, ValueError) as e:
+                log.warning(f"Lost the events of the executor service: {e}")
+            # Whatever happened until we are back is missed
+            bus.resync()
+            await asyncio.sleep(1)
@@ -0,0 +1,449 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import tarfile
+import time
+
+from logging import getLogger
+from shlex import quote
+from typing import NamedTuple
+
+log = getLogger(__name__)
+
+# Files written next to the challenges on every server, describing what was
+# synced there last
+MANIFEST = ".instancer-manifest"
+DIGEST = ".instancer-digest"
+
+# tarfile stream mode and the matching tar -x flag on the server per codec
+CODECS = {
+    "none": ("w|", ""),
+    "gz": ("w|gz", "z"),
+    "bz2": ("w|bz2", "j"),
+    "xz": ("w|xz", "J"),
+}
+
+# Release the challenges of a server from before releases are moved to
+LEGACY = "legacy"
+
+# Paths removed per command while syncing, keeps the command line short
+REMOVE_CHUNK = 200
+
+
+class TreeHasher:
+    def __init__(self) -> None:
+        # absolute path -> (mtime_ns, size, mode, digest), so unchanged files
+        # are not read again on every sync
+        self.cache = {}
+
+    def hash_file(self, path: str, st: os.stat_result) -> str:
+        cached = self.cache.get(path)
+        if cached is not None and cached[:3] == (st.st_mtime_ns, st.st_size, st.st_mode):
+            return cached[3]
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(1 << 20):
+                digest.update(chunk)
+        entry = f"{digest.hexdigest()} {st.st_mode & 0o7777:o}"
+        self.cache[path] = (st.st_mtime_ns, st.st_size, st.st_mode, entry)
+        return entry
+
+    def manifest(self, base_dir: str) -> dict[str, str]:
+        # relative path -> "<sha256> <mode>" for files, "-> <target>" for
+        # symlinks and "dir <mode>" for directories
+        manifest = {}
+        seen = set()
+        for root, dirs, files in os.walk(base_dir):
+            dirs.sort()
+            for name in dirs + sorted(files):
+                path = os.path.join(root, name)
+                rel = os.path.relpath(path, base_dir)
+                if rel in (MANIFEST, DIGEST):
+                    continue
+                st = os.lstat(path)
+                if os.path.islink(path):
+                    manifest[rel] = f"-> {os.readlink(path)}"
+                elif os.path.isdir(path):
+                    manifest[rel] = f"dir {st.st_mode & 0o7777:o}"
+                else:
+                    manifest[rel] = self.hash_file(path, st)
+                    seen.add(path)
+
+        for path in list(self.cache):
+            if path not in seen:
+                del self.cache[path]
+        return manifest
+
+
+def encode_manifest(manifest: dict[str, str]) -> str:
+    return "".join(f"{entry}\t{path}\n" for path, entry in sorted(manifest.items()))
+
+
+def decode_manifest(data: str | None) -> dict[str, str]:
+    manifest = {}
+    if data is None:
+        return manifest
+    for line in data.splitlines():
+        entry, _, path = line.partition("\t")
+        if len(path) > 0:
+            manifest[path] = entry
+    return manifest
+
+
+def manifest_digest(manifest: dict[str, str]) -> str:
+    return hashlib.sha256(encode_manifest(manifest).encode()).hexdigest()[:16]
+
+
+def subtree_digest(manifest: dict[str, str], prefix: str) -> str:
+    # Digest of everything below one directory, e.g. a single challenge
+    prefix = prefix.rstrip("/") + "/"
+    subtree = {path: entry for path, entry in manifest.items() if path.startswith(prefix)}
+    return manifest_digest(subtree)
+
+
+def entry_kind(entry: str) -> str:
+    if entry.startswith("dir "):
+        return "dir"
+    if entry.startswith("-> "):
+        return "link"
+    return "file"
+
+
+def diff_manifests(local: dict[str, str], remote: dict[str, str]) -> tuple[list[str], list[str]]:
+    # Returns the paths to send and the paths to delete on the remote. A path
+    # whose type changed is deleted first, so a file can become a directory.
+    changed = [path for path, entry in local.items() if remote.get(path) != entry]
+    removed = [path for path, entry in remote.items()
+               if path not in local or entry_kind(entry) != entry_kind(local[path])]
+    return changed, removed
+
+
+def write_delta(base_dir: str, manifest: dict[str, str], changed: list[str], fileobj,
+                codec: str = "none", level: int = 6):
+    # Streams a tar with the changed entries plus the new manifest and digest
+    encoded = encode_manifest(manifest).encode()
+    digest = manifest_digest(manifest).encode()
+
+    mode, _ = CODECS[codec]
+    kwargs = {"compresslevel": level} if codec in ("gz", "bz2") else {}
+    with tarfile.open(fileobj=fileobj, mode=mode, **kwargs) as tar:
+        for path in sorted(changed):
+            tar.add(os.path.join(base_dir, path), arcname=path, recursive=False)
+        for name, data in [(MANIFEST, encoded), (DIGEST, digest)]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(data))
+
+
+class Throttle:
+    # Caps the bytes/sec written to fileobj, called from the producer thread
+    def __init__(self, fileobj, rate: float, chunk: int = 64 * 1024) -> None:
+        self.fileobj = fileobj
+        self.rate = rate
+        self.chunk = chunk
+        self.sent = 0
+        self.start = time.monotonic()
+
+    def write(self, data: bytes) -> int:
+        for i in range(0, len(data), self.chunk):
+            part = data[i:i + self.chunk]
+            self.fileobj.write(part)
+            self.sent += len(part)
+            ahead = self.sent / self.rate - (time.monotonic() - self.start)
+            if ahead > 0:
+                time.sleep(ahead)
+        return len(data)
+
+
+class SyncResult(NamedTuple):
+    ok: bool
+    # where the server got the data from: "instancer", the hostname of the
+    # peer that forwarded it, or "up to date"
+    source: str
+    error: str
+    seconds: float
+
+
+class Release:
+    # The challenges live in <path>.releases/<digest>, <path> itself is a
+    # symlink to the current release that is swapped atomically, so running
+    # challenges never see a half-extracted tree.
+    def __init__(self, server, digest: str) -> None:
+        self.digest = digest
+        self.path = server.path.rstrip("/")
+        self.releases = f"{self.path}.releases"
+        self.release = f"{self.releases}/{digest}"
+        self.staging = f"{self.releases}/.staging-{digest}"
+        self.delta = f"{self.releases}/.delta-{digest}"
+
+
+class ChallengeSync:
+    def __init__(self, executor, options: dict) -> None:
+        self.executor = executor
+        self.keep_releases = options.get("keep_releases", 3)
+        self.codec = options.get("codec", "gz")
+        self.level = options.get("level", 1)
+        self.stream = options.get("stream", True)
+        self.bandwidth = options.get("bandwidth", 0)
+        # "direct" uploads to every server, "tree" uploads to a few seeds
+        # which forward the data to the other servers
+        self.distribution = options.get("distribution", "direct")
+        self.seeds = options.get("seeds", 1)
+        self.node_keyfile = options.get("node_keyfile")
+        # Servers receiving data from the instancer at the same time
+        self.uploads = asyncio.Semaphore(options.get("parallel", 4))
+        self.hasher = TreeHasher()
+        # hostname -> outcome of the last sync of that server
+        self.results = {}
+
+    async def run(self, server, cmd) -> str:
+        result = await self.executor.run(server, cmd)
+        if result is None:
+            raise RuntimeError(f"'{cmd}' failed")
+        return result
+
+    def report(self, server, ok: bool, source: str, start: float, error: str = ""):
+        self.results[server.hostname] = SyncResult(ok, source, error, time.monotonic() - start)
+        if ok:
+            log.info(f"[{server.hostname}]\tsynced from {source}")
+        else:
+            log.warning(f"[{server.hostname}] Failed to setup server: {error}")
+
+    def producer(self, base_dir, manifest, changed):
+        def produce(writer):
+            if self.bandwidth > 0:
+                writer = Throttle(writer, self.bandwidth)
+            write_delta(base_dir, manifest, changed, writer, self.codec, self.level)
+        return produce
+
+    async def sync(self, base_dir: str, servers: list) -> dict[str, str]:
+        log.info(f"Hashing {base_dir}")
+        manifest = await asyncio.to_thread(self.hasher.manifest, base_dir)
+        digest = manifest_digest(manifest)
+
+        log.info(f"Syncing {base_dir} ({digest}) to {len(servers)} servers")
+        if self.distribution == "tree":
+            await self.sync_tree(base_dir, manifest, digest, servers)
+        else:
+            await asyncio.gather(
+                *[self.sync_server(server, base_dir, manifest, digest) for server in servers]
+            )
+        return manifest
+
+    async def status(self, server, release: Release) -> tuple[str, bool]:
+        # The digest currently synced to the server, and whether the release
+        # we are about to send already exists there
+        out = await self.run(server, " ; ".join([
+            f"echo digest=$(cat {quote(release.path)}/{DIGEST} 2>/dev/null)",
+            f"[ -d {quote(release.release)} ] && echo release=yes || echo release=no",
+        ]))
+        values = dict(line.partition("=")[::2] for line in out.splitlines())
+        return values.get("digest", ""), values.get("release") == "yes"
+
+    async def remote_manifest(self, server, release: Release) -> dict[str, str]:
+        return decode_manifest(
+            await self.run(server, f"cat {quote(release.path)}/{MANIFEST} 2>/dev/null || true"))
+
+    async def stage(self, server, release: Release, has_base: bool, removed: list[str]):
+        # Start from a copy of the current release and apply the delta
+        if has_base:
+            base = f"cp -a {quote(release.path)}/. {quote(release.staging)}"
+        else:
+            base = f"mkdir {quote(release.staging)}"
+        await self.run(server, f"mkdir -p {quote(release.releases)} && " +
+                       f"rm -rf {quote(release.staging)} && {base}")
+
+        for i in range(0, len(removed), REMOVE_CHUNK):
+            paths = " ".join(quote(p) for p in removed[i:i + REMOVE_CHUNK])
+            await self.run(server, f"cd {quote(release.staging)} && rm -rf -- {paths}")
+
+    async def upload(self, server, release: Release, produce, unpack: bool):
+        # Either unpack the archive while it arrives, or land it in a file on
+        # the server first
+        _, flag = CODECS[self.codec]
+        if unpack:
+            cmd = f"tar -x{flag}f - --directory {quote(release.staging)}"
+        else:
+            cmd = f"mkdir -p {quote(release.releases)} && cat > {quote(release.delta)}"
+
+        log.info(f"[{server.hostname}]\tsending {self.codec} delta")
+        async with self.uploads:
+            if await self.executor.stream(server, cmd, produce) is None:
+                raise RuntimeError(f"'{cmd}' failed")
+
+    async def unpack(self, server, release: Release):
+        _, flag = CODECS[self.codec]
+        await self.run(server, f"tar -x{flag}f {quote(release.delta)} --directory {quote(release.staging)} && " +
+                       f"rm -f {quote(release.delta)}")
+
+    async def activate(self, server, release: Release, staged: bool = True):
+        steps = []
+        if staged:
+            steps.append(f"mv {quote(release.staging)} {quote(release.release)}")
+        path = quote(release.path)
+        legacy = quote(f"{release.releases}/{LEGACY}")
+        steps += [
+            f"ln -sfn {quote(release.release)} {path}.link",
+            # A server from before releases has the challenges in path
+            # itself, they are moved aside as a release of their own
+            f"if [ -d {path} ] && [ ! -L {path} ]; then mv -T {path} {legacy}; fi",
+            f"{{ mv -Tf {path}.link {path} || ln -sfn {quote(release.release)} {path}; }}",
+            f"touch {quote(release.release)}",
+        ]
+        await self.run(server, " && ".join(steps))
+        log.info(f"[{server.hostname}]\tswitched to release {release.digest}")
+        try:
+            await self.prune(server, release)
+        except Exception as e:
+            log.warning(f"[{server.hostname}]\tpruning old releases failed: {e}")
+
+    async def prune(self, server, release: Release):
+        # Old releases are kept for a while, and for as long as a compose
+        # project started from them is around
+        listing = await self.run(server, f"ls -1t {quote(release.releases)}")
+        projects = json.loads(await self.run(server, "docker compose ls --all --format json") or "[]")
+        prefix = f"{release.releases}/"
+        used = set()
+        for project in projects:
+            for config_file in project.get("ConfigFiles", "").split(","):
+                if config_file.startswith(prefix):
+                    used.add(config_file[len(prefix):].split("/")[0])
+                elif config_file.startswith(f"{release.path}/"):
+                    # Started through the symlink, any release may be the one
+                    log.info(f"[{server.hostname}]\tnot pruning releases, {project.get('Name')} "
+                             f"does not tell which it uses")
+                    return
+        old = [name for name in listing.split()[self.keep_releases:]
+               if name not in used and name != release.digest]
+        if len(old) > 0:
+            await self.run(server, f"cd {quote(release.releases)} && rm -rf -- " +
+                           " ".join(quote(name) for name in old))
+            log.info(f"[{server.hostname}]\tpruned {len(old)} releases")
+
+    async def sync_server(self, server, base_dir, manifest, digest):
+        start = time.monotonic()
+        release = Release(server, digest)
+        try:
+            current, exists = await self.status(server, release)
+            if current == digest:
+                self.report(server, True, "up to date", start)
+                return
+            if exists:
+                await self.activate(server, release, staged=False)
+                self.report(server, True, "instancer", start)
+                return
+
+            remote = await self.remote_manifest(server, release)
+            changed, removed = diff_manifests(manifest, remote)
+            log.info(f"[{server.hostname}]\tsending {len(changed)} changed entries, " +
+                     f"removing {len(removed)}")
+
+            await self.stage(server, release, len(remote) > 0, removed)
+            produce = self.producer(base_dir, manifest, changed)
+            await self.upload(server, release, produce, unpack=self.stream)
+            if not self.stream:
+                await self.unpack(server, release)
+            await self.activate(server, release)
+            self.report(server, True, "instancer", start)
+        except Exception as e:
+            self.report(server, False, "instancer", start, str(e))
+
+    async def forward(self, source, target, digest: str):
+        # Copies the delta from one server to another over SSH between them
+        source_release = Release(source, digest)
+        target_release = Release(target, digest)
+        ssh = ["ssh", "-o", "BatchMode=yes", "-o", "StrictHostKeyChecking=accept-new",
+               "-p", str(target.port)]
+        if self.node_keyfile is not None:
+            ssh += ["-i", self.node_keyfile]
+        ssh.append(f"{target.user}@{target.ip}")
+        remote = f"mkdir -p {quote(target_release.releases)} && cat > {quote(target_release.delta)}"
+        await self.run(source, " ".join(quote(arg) for arg in ssh) +
+                       f" {quote(remote)} < {quote(source_release.delta)}")
+
+    async def sync_tree(self, base_dir, manifest, digest, servers):
+        starts = {server.hostname: time.monotonic() for server in servers}
+        statuses = await asyncio.gather(
+            *[self.status(server, Release(server, digest)) for server in servers],
+            return_exceptions=True
+        )
+
+        # Servers on the same release need the same delta, so every group
+        # gets its own tree
+        groups = {}
+        existing = []
+        for server, status in zip(servers, statuses):
+            if isinstance(status, Exception):
+                self.report(server, False, "instancer", starts[server.hostname], str(status))
+            elif status[0] == digest:
+                self.report(server, True, "up to date", starts[server.hostname])
+            elif status[1]:
+                existing.append(server)
+            else:
+                groups.setdefault(status[0], []).append(server)
+
+        await asyncio.gather(
+            *[self.sync_server(server, base_dir, manifest, digest) for server in existing],
+            *[self.sync_group(base_dir, manifest, digest, group, starts) for group in groups.values()]
+        )
+
+    async def sync_group(self, base_dir, manifest, digest, group, starts):
+        try:
+            remote = await self.remote_manifest(group[0], Release(group[0], digest))
+        except Exception as e:
+            for server in group:
+                self.report(server, False, "instancer", starts[server.hostname], str(e))
+            return
+        changed, removed = diff_manifests(manifest, remote)
+        produce = self.producer(base_dir, manifest, changed)
+        log.info(f"Sending {len(changed)} changed entries to {len(group)} servers " +
+                 f"through {self.seeds} seeds")
+
+        pending = list(group)
+        received = []
+
+        async def spread(source):
+            # Every server that has the delta keeps forwarding it to servers
+            # that don't, so the number of senders doubles every round
+            tasks = []
+            while len(pending) > 0:
+                target = pending.pop(0)
+                try:
+                    await self.forward(source, target, digest)
+                    received.append((target, source.hostname))
+                    tasks.append(asyncio.create_task(spread(target)))
+                except Exception as e:
+                    log.warning(f"[{target.hostname}]\tforward from {source.hostname} failed: {e}")
+                    tasks.append(asyncio.create_task(direct(target)))
+            await asyncio.gather(*tasks)
+
+        async def direct(server):
+            try:
+                await self.upload(server, Release(server, digest), produce, unpack=False)
+                received.append((server, "instancer"))
+            except Exception as e:
+                self.report(server, False, "instancer", starts[server.hostname], str(e))
+                return
+            await spread(server)
+
+        seeds = [pending.pop(0) for _ in range(min(self.seeds, len(pending)))]
+        await asyncio.gather(*[direct(seed) for seed in seeds])
+        # Only left over when every seed failed
+        while len(pending) > 0:
+            await direct(pending.pop(0))
+
+        async def apply(server, source):
+            release = Release(server, digest)
+            try:
+                await self.stage(server, release, len(remote) > 0, removed)
+                await self.unpack(server, release)
+                await self.activate(server, release)
+                self.report(server, True, source, starts[server.hostname])
+            except Exception as e:
+                self.report(server, False, source, starts[server.hostname], str(e))
+
+        await asyncio.gather(*[apply(server, source) for server, source in received])
@@ -0,0 +1,113 @@
+import asyncio
+import time
+
+from logging import getLogger
+from shlex import quote
+
+from webapp.sync import subtree_digest
+
+log = getLogger(__name__)
+
+# Compose project the images are built under. Instances run under their own
+# project, but share the pulled images and the build cache with it.
+WARMUP_PROJECT = "instancer-warmup"
+
+
+class WarmUp:
+    def __init__(self, executor, options: dict) -> None:
+        self.executor = executor
+        self.enabled = options.get("enabled", True)
+        # builds running at once on a single server
+        self.per_server = options.get("per_server", 1)
+        self.timeout = options.get("timeout", 1800)
+        self.semaphores = {}
+        # (hostname, challenge name) -> content digest the images were built for
+        self.ready = {}
+        # challenge name -> content digest of the last sync
+        self.digests = {}
+        self.loaded = set()
+        self.task = None
+
+    def is_warm(self, server, challenge) -> bool:
+        digest = self.ready.get((server.hostname, challenge.name))
+        return digest is not None and digest == self.digests.get(challenge.name)
+
+    def markers(self, server) -> str:
+        # The digests are also kept on the server, so a restart doesn't build
+        # everything again
+        return f"{server.path.rstrip('/')}.warm"
+
+    def semaphore(self, server) -> asyncio.Semaphore:
+        semaphore = self.semaphores.get(server.hostname)
+        if semaphore is None:
+            semaphore = self.semaphores[server.hostname] = asyncio.Semaphore(self.per_server)
+        return semaphore
+
+    async def load(self, server):
+        if server.hostname in self.loaded:
+            return
+        out = await self.executor.run(
+            server, f"cd {quote(self.markers(server))} 2>/dev/null && grep -H . -- * || true")
+        if out is None:
+            return
+        for line in out.splitlines():
+            name, _, digest = line.partition(":")
+            self.ready[(server.hostname, name)] = digest.strip()
+        self.loaded.add(server.hostname)
+
+    async def build(self, server, challenge, digest: str):
+        source = f"{server.path.rstrip('/')}/{challenge.path}/Source"
+        compose = f"COMPOSE_PROJECT_NAME={WARMUP_PROJECT} docker compose"
+        cmd = " && ".join([
+            f"cd {quote(source)}",
+            f"{compose} pull --quiet --ignore-pull-failures",
+            f"{compose} build --quiet",
+            f"mkdir -p {quote(self.markers(server))}",
+            f"echo {digest} > {quote(self.markers(server) + '/' + challenge.name)}",
+        ])
+        async with self.semaphore(server):
+            # Checked again, an earlier round may have built it meanwhile
+            if self.ready.get((server.hostname, challenge.name)) == digest:
+                return
+            start = time.monotonic()
+            result = await self.executor.run(server, cmd, timeout=self.timeout)
+        if result is None:
+            log.warning(f"[{server.hostname}]\twarming up {challenge.name} failed")
+            return
+        self.ready[(server.hostname, challenge.name)] = digest
+        log.info(f"[{server.hostname}]\twarmed up {challenge.name} in {time.monotonic() - start:.1f}s")
+
+    async def warm_server(self, server):
+        try:
+            await self.load(server)
+        except Exception as e:
+            log.warning(f"[{server.hostname}]\treading warm-up markers failed: {e}")
+        builds = []
+        for challenge in self.executor.config.challenges.values():
+            digest = self.digests.get(challenge.name)
+            if digest is None or challenge.removed or self.ready.get((server.hostname, challenge.name)) == digest:
+                continue
+            builds.append(self.build(server, challenge, digest))
+        if len(builds) > 0:
+            log.info(f"[{server.hostname}]\twarming up {len(builds)} challenges")
+        await asyncio.gather(*builds, return_exceptions=True)
+
+    def schedule(self, manifest: dict[str, str], servers: list):
+        # Runs in the background, starts are placed on warm servers where
+        # possible while this is going on
+        if not self.enabled:
+            return
+        for challenge in self.executor.config.challenges.values():
+            self.digests[challenge.name] = subtree_digest(manifest, challenge.path)
+        if self.task is not None and not self.task.done():
+            log.info("warm-up from the previous sync is still running, catching up next sync")
+            return
+        self.task = asyncio.create_task(self.warm(servers))
+
+    async def warm(self, servers: list):
+        start = time.monotonic()
+        await asyncio.gather(*[self.warm_server(server) for server in servers])
+        warm = sum(self.is_warm(server, challenge) for server in servers
+                   for challenge in self.executor.config.challenges.values())
+        log.info(f"warm-up done in {time.monotonic() - start:.1f}s, " +
+                 f"{warm} of {len(servers) * len(self.executor.config.challenges)} warm")
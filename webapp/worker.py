@@ -0,0 +1,85 @@
+import asyncio
+import logging
+
+from logging import getLogger
+from multiprocessing import get_context
+
+from hypercorn.asyncio.run import worker_serve
+from hypercorn.config import Config as HypercornConfig
+from hypercorn.utils import wrap_app
+
+from webapp.api import app
+from webapp.config import Config
+from webapp.reload import ConfigWatcher
+from webapp.service import ServiceClient
+
+log = getLogger(__name__)
+
+
+def hypercorn_config(api: dict) -> HypercornConfig:
+    hypercorn = HypercornConfig()
+    hypercorn.bind = [f"{api['ip']}:{api['port']}"]
+    hypercorn.workers = api.get("workers", 1)
+    return hypercorn
+
+
+def serve_api(config_path: str, socket_path: str, hypercorn: HypercornConfig, sockets):
+    # Entry point of an API worker process. It answers reads from the
+    # database itself and asks the executor service for everything else.
+    logging.basicConfig(level=logging.INFO)
+    config = Config(config_path, api_worker=True)
+    # The worker has a copy of the config of its own, kept up to date the
+    # same way the executor's is
+    watcher = ConfigWatcher(config, config.reload.get("interval", 30))
+    app.extra = {
+        "config": config,
+        "service": ServiceClient(socket_path),
+        "watcher": watcher,
+    }
+
+    async def run():
+        watching = asyncio.create_task(watcher.run())
+        try:
+            await worker_serve(wrap_app(app, hypercorn.wsgi_max_body_size, None), hypercorn,
+                               sockets=sockets)
+        finally:
+            watching.cancel()
+
+    asyncio.run(run())
+
+
+class ApiWorkers:
+    def __init__(self, config_path: str, api: dict) -> None:
+        self.config_path = config_path
+        self.socket_path = api.get("socket", "instancer.sock")
+        self.hypercorn = hypercorn_config(api)
+        # Bound once here and shared by every worker, so a restarted worker
+        # listens on the same sockets
+        self.sockets = self.hypercorn.create_sockets()
+        self.context = get_context("spawn")
+        self.processes = []
+
+    def spawn(self):
+        process = self.context.Process(target=serve_api, daemon=True, args=(
+            self.config_path, self.socket_path, self.hypercorn, self.sockets))
+        process.start()
+        return process
+
+    async def run(self, listening: asyncio.Event):
+        # Started once the executor service accepts connections, and
+        # restarted when they die
+        await listening.wait()
+        self.processes = [self.spawn() for _ in range(self.hypercorn.workers)]
+        log.info(f"started {len(self.processes)} API workers")
+        while True:
+            await asyncio.sleep(1)
+            for idx, process in enumerate(self.processes):
+                if not process.is_alive():
+                    log.warning(f"API worker {process.pid} exited with {process.exitcode}, restarting it")
+                    self.processes[idx] = self.spawn()
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join(5)